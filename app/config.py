@@ -13,6 +13,132 @@ class Config:
     TELEGRAM_ADMIN_ID = os.getenv("TELEGRAM_ADMIN_ID")
     REDIS_URL = os.getenv("REDIS_URL")
 
+    # Cache danh bạ user Notion: file local (mặc định tắt vì roster chứa mật khẩu Garmin, đặt đường dẫn để bật,
+    # vd. data/notion_users.json), thời gian tin tưởng cache không cần hỏi Notion (giây),
+    # tuổi tối đa trước khi buộc tải lại toàn bộ (giây)
+    NOTION_USERS_CACHE_PATH = os.getenv("NOTION_USERS_CACHE_PATH", "")
+    NOTION_USERS_TRUST_TTL = int(os.getenv("NOTION_USERS_TRUST_TTL", "300"))
+    NOTION_USERS_MAX_AGE = int(os.getenv("NOTION_USERS_MAX_AGE", "86400"))
+
+    # Registry prompt Notion: file snapshot (để trống để tắt), timeout khi đã có snapshot dự phòng (giây),
+    # tuổi tối đa trước khi tải lại toàn bộ database (giây)
+    NOTION_PROMPTS_CACHE_PATH = os.getenv("NOTION_PROMPTS_CACHE_PATH", os.path.join("data", "notion_prompts.json"))
+    NOTION_PROMPTS_TIMEOUT = float(os.getenv("NOTION_PROMPTS_TIMEOUT", "4"))
+    NOTION_PROMPTS_MAX_AGE = int(os.getenv("NOTION_PROMPTS_MAX_AGE", "86400"))
+
+    # Giới hạn số request Garmin chạy song song cho mỗi user (tránh 429) và timeout mỗi endpoint (giây)
+    GARMIN_MAX_CONCURRENCY = int(os.getenv("GARMIN_MAX_CONCURRENCY", "4"))
+    GARMIN_ENDPOINT_TIMEOUT = float(os.getenv("GARMIN_ENDPOINT_TIMEOUT", "20"))
+    # Làm mới OAuth2 token Garmin khi còn ít hơn N giây trước khi hết hạn
+    GARMIN_TOKEN_REFRESH_MARGIN = int(os.getenv("GARMIN_TOKEN_REFRESH_MARGIN", "300"))
+
+    # Mode serve (webhook server thường trực): địa chỉ (mặc định chỉ nghe local; nghe công khai bắt buộc có secret),
+    # cổng, secret Bearer, kích thước body tối đa (bytes) và thời gian chờ job đang chạy khi tắt (giây)
+    SERVE_HOST = os.getenv("SERVE_HOST", "127.0.0.1")
+    SERVE_PORT = int(os.getenv("SERVE_PORT") or os.getenv("PORT") or "8080")
+    SERVE_SECRET = os.getenv("SERVE_SECRET")
+    SERVE_MAX_BODY = int(os.getenv("SERVE_MAX_BODY", "65536"))
+    SERVE_DRAIN_TIMEOUT = float(os.getenv("SERVE_DRAIN_TIMEOUT", "300"))
+
+    # Hàng đợi job Redis Streams (mode worker): Redis riêng (mặc định REDIS_URL), prefix key, consumer group,
+    # độ dài tối đa stream; số lần giao tối đa trước khi vào dead-letter, thời gian job im lặng trước khi
+    # worker khác nhận lại và thời gian chờ retry (giây); thời gian gộp job trùng (user, mode) (giây);
+    # số job mỗi worker chạy đồng thời và thời gian chờ lock user (giây); thời gian worker dùng lại
+    # AQI / prompts đã tải giữa các job (giây).
+    # JOB_QUEUE_ENABLED=true: mode serve đưa job vào hàng đợi thay vì chạy trong process (CLI dùng --enqueue)
+    JOB_QUEUE_URL = os.getenv("JOB_QUEUE_URL") or REDIS_URL
+    JOB_QUEUE_ENABLED = os.getenv("JOB_QUEUE_ENABLED", "false").lower() in ("1", "true", "yes")
+    JOB_QUEUE_PREFIX = os.getenv("JOB_QUEUE_PREFIX", "jobs")
+    JOB_QUEUE_GROUP = os.getenv("JOB_QUEUE_GROUP", "workers")
+    JOB_QUEUE_MAXLEN = int(os.getenv("JOB_QUEUE_MAXLEN", "10000"))
+    JOB_MAX_DELIVERIES = int(os.getenv("JOB_MAX_DELIVERIES", "3"))
+    JOB_VISIBILITY_TIMEOUT = float(os.getenv("JOB_VISIBILITY_TIMEOUT", "120"))
+    JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", "30"))
+    JOB_COALESCE_TTL = int(os.getenv("JOB_COALESCE_TTL", "3600"))
+    JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "4"))
+    JOB_LOCK_WAIT = float(os.getenv("JOB_LOCK_WAIT", "60"))
+    JOB_SHARED_TTL = float(os.getenv("JOB_SHARED_TTL", "300"))
+
+    # Số user được xử lý đồng thời trong một lần chạy (giới hạn toàn cục)
+    MAX_CONCURRENT_USERS = int(os.getenv("MAX_CONCURRENT_USERS", "5"))
+
+    # Store SQLite lưu dữ liệu Garmin theo ngày (để trống GARMIN_STORE_PATH để tắt)
+    GARMIN_STORE_PATH = os.getenv("GARMIN_STORE_PATH", os.path.join("data", "garmin_store.sqlite3"))
+    GARMIN_STORE_SETTLE_HOURS = float(os.getenv("GARMIN_STORE_SETTLE_HOURS", "6"))
+    # Số ngày tối đa kéo lại trong mode sync
+    SYNC_DAYS_BACK = int(os.getenv("SYNC_DAYS_BACK", "7"))
+
+    # Cache kết quả tool của /ask agent (LRU trong process + Redis), TTL tính bằng giây
+    TOOL_CACHE_MAX_ENTRIES = int(os.getenv("TOOL_CACHE_MAX_ENTRIES", "256"))
+    TOOL_CACHE_TTL_TODAY = int(os.getenv("TOOL_CACHE_TTL_TODAY", "600"))
+    TOOL_CACHE_TTL_PAST = int(os.getenv("TOOL_CACHE_TTL_PAST", "259200"))
+    TOOL_CACHE_TTL_DEFAULT = int(os.getenv("TOOL_CACHE_TTL_DEFAULT", "3600"))
+
+    # Payload tool nhỏ hơn ngưỡng (ký tự) và không phải chuỗi time-series dài sẽ được tóm tắt cục bộ, không gọi MODEL_WORKER
+    WORKER_MIN_PAYLOAD_CHARS = int(os.getenv("WORKER_MIN_PAYLOAD_CHARS", "2000"))
+    WORKER_MIN_SERIES_POINTS = int(os.getenv("WORKER_MIN_SERIES_POINTS", "30"))
+
+    # Số điểm tối đa của mỗi chuỗi time-series gửi cho LLM (0 = không giảm) và thuật toán giảm: lttb | minmax | change
+    SERIES_POINT_BUDGET = int(os.getenv("SERIES_POINT_BUDGET", "120"))
+    SERIES_DOWNSAMPLERS = ("lttb", "minmax", "change")
+    SERIES_DOWNSAMPLER = os.getenv("SERIES_DOWNSAMPLER", "lttb").strip().lower()
+    if SERIES_DOWNSAMPLER not in SERIES_DOWNSAMPLERS:
+        print(f"WARNING: SERIES_DOWNSAMPLER='{SERIES_DOWNSAMPLER}' không hợp lệ ({' | '.join(SERIES_DOWNSAMPLERS)}), dùng lttb.")
+        SERIES_DOWNSAMPLER = "lttb"
+    # Số điểm mốc Body Battery kèm theo biểu đồ 24h của báo cáo
+    BB_KEY_POINTS = int(os.getenv("BB_KEY_POINTS", "8"))
+
+    # LLM proxy (OpenAI-compatible): client dùng chung, timeout (giây) và số lần retry
+    LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://khoitran1999-claude-server.hf.space/v1")
+    LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "180"))
+    LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+    LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+    LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+    LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+
+    # Stream báo cáo AI vào Telegram bằng cách sửa dần 1 tin nhắn (giây giữa 2 lần sửa)
+    REPORT_STREAMING = os.getenv("REPORT_STREAMING", "true").lower() in ("1", "true", "yes")
+    TELEGRAM_STREAM_EDIT_INTERVAL = float(os.getenv("TELEGRAM_STREAM_EDIT_INTERVAL", "1.5"))
+
+    # Voice note: encode Opus qua ffmpeg (để trống = tìm trong PATH, không có thì gửi WAV)
+    FFMPEG_PATH = os.getenv("FFMPEG_PATH")
+    VOICE_NOTE_BITRATE = os.getenv("VOICE_NOTE_BITRATE", "32k")
+
+    # Cache audio TTS theo nội dung (text, voice, model): thư mục + giới hạn dung lượng đĩa (bytes);
+    # clip nhỏ hơn TTS_CACHE_REDIS_MAX_BYTES được lưu thêm vào Redis trong TTS_CACHE_REDIS_TTL giây
+    TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "data/tts_cache")
+    TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+    TTS_CACHE_REDIS_MAX_BYTES = int(os.getenv("TTS_CACHE_REDIS_MAX_BYTES", str(256 * 1024)))
+    TTS_CACHE_REDIS_TTL = int(os.getenv("TTS_CACHE_REDIS_TTL", str(7 * 24 * 3600)))
+
+    # TTS theo đoạn: chia kịch bản tại ranh giới câu (tối đa TTS_CHUNK_CHARS ký tự/đoạn), tổng hợp song song
+    TTS_CHUNKED = os.getenv("TTS_CHUNKED", "true").lower() in ("1", "true", "yes")
+    TTS_CHUNK_CHARS = int(os.getenv("TTS_CHUNK_CHARS", "400"))
+    TTS_MAX_PARALLEL = int(os.getenv("TTS_MAX_PARALLEL", "4"))
+    TTS_CHUNK_GAP_SECONDS = float(os.getenv("TTS_CHUNK_GAP_SECONDS", "0.15"))
+
+    # Bộ lập lịch Gemini Key: request/phút mỗi key, cooldown (giây) khi 429 (nhân đôi khi lặp lại, tối đa MAX),
+    # thời gian chờ tối đa khi mọi key đang nghỉ, hệ số EWMA và latency mặc định của key chưa có số liệu
+    GEMINI_KEY_RPM = float(os.getenv("GEMINI_KEY_RPM", "10"))
+    GEMINI_KEY_COOLDOWN = float(os.getenv("GEMINI_KEY_COOLDOWN", "60"))
+    GEMINI_KEY_MAX_COOLDOWN = float(os.getenv("GEMINI_KEY_MAX_COOLDOWN", "900"))
+    GEMINI_KEY_MAX_WAIT = float(os.getenv("GEMINI_KEY_MAX_WAIT", "30"))
+    GEMINI_KEY_EWMA_ALPHA = float(os.getenv("GEMINI_KEY_EWMA_ALPHA", "0.3"))
+    GEMINI_KEY_DEFAULT_LATENCY = float(os.getenv("GEMINI_KEY_DEFAULT_LATENCY", "5"))
+
+    # Telegram Bot dùng chung: kích thước connection pool và timeout (giây)
+    TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "16"))
+    TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "10"))
+    TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "15"))
+    TELEGRAM_MEDIA_TIMEOUT = float(os.getenv("TELEGRAM_MEDIA_TIMEOUT", "60"))
+
+    # Hàng đợi gửi Telegram: giới hạn msg/s toàn cục và theo chat (burst), số lần retry báo cáo, số worker
+    TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+    TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+    TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+    TELEGRAM_SEND_RETRIES = int(os.getenv("TELEGRAM_SEND_RETRIES", "3"))
+    TELEGRAM_OUTBOX_WORKERS = int(os.getenv("TELEGRAM_OUTBOX_WORKERS", "16"))
+
     # Load 9Router Key (không fallback về GEMINI_API_KEY)
     ROUTER9_API_KEY = os.getenv("ROUTER9_API_KEY")
     ROUTER9_COMBOS_MODEL = os.getenv("ROUTER9_COMBOS_MODEL")
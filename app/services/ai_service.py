@@ -1,77 +1,43 @@
 import os
+import re
 import json
 import pytz
 import time
-import struct
 import random
+import numpy as np
 from datetime import datetime
-from typing import Optional, Dict
 from google import genai
 from google.genai import types
 from app.config import Config
 from app.services.redis_service import redis_service
+from app.services.timeseries_store import timeseries_store
+from app.services.tool_cache import tool_cache
+from app.services.tts_cache import tts_cache
+from app.services.key_scheduler import GeminiKeyManager, gemini_key_manager
+from app.services.prompt_service import compile_template
+from app.utils.series_analytics import summarize_tool_payload
+from app.utils.downsampling import downsample
+from app.utils.audio import parse_audio_mime_type, encode_voice_note
 
-class GeminiKeyManager:
-    """
-    Quản lý danh sách API Key Gemini cho TTS
-    """
-    def __init__(self):
-        self.keys = []
-        self._load_keys()
-        self.current_index = 0
-
-    def _load_keys(self):
-        self.keys = Config.GEMINI_API_KEYS
-        print(f"Loaded {len(self.keys)} Gemini Keys from Config.")
-
-    def get_current_key(self):
-        if not self.keys:
-            return None
-        return self.keys[self.current_index]
-
-    def rotate_key(self):
-        if not self.keys:
-            return None
-        self.current_index = (self.current_index + 1) % len(self.keys)
-        return self.get_current_key()
-
-    def get_key_count(self):
-        return len(self.keys)
-
-    def execute_with_retry(self, worker_func, default_return=None, verbose_label="Service"):
-        max_attempts = self.get_key_count() * 2
-        if max_attempts == 0:
-            print(f"[{verbose_label}] Warning: No API Keys available to execute.")
-            return default_return
-
-        for attempt in range(max_attempts):
-            current_api_key = self.get_current_key()
-            try:
-                result = worker_func(current_api_key)
-                self.rotate_key()
-                return result
-
-            except Exception as e:
-                error_msg = str(e)
-                print(f"[{verbose_label}] Error (Key ...{current_api_key[-5:] if current_api_key else 'None'}): {error_msg}")
-
-                if "429" in error_msg or "RESOURCE_EXHAUSTED" in error_msg or "quota" in error_msg.lower():
-                    self.rotate_key()
-                    time.sleep(1)
-                else:
-                    self.rotate_key()
-                    time.sleep(2)
+import requests
+from app.services.llm_client import llm_clients
 
-        return default_return
+USER_NOTE_SUFFIX = "\n\n- **Ghi chú hôm nay từ người dùng:** {user_note}"
 
-import requests
-from openai import OpenAI
+def render_prompt_template(text, user_note_str=None, **values):
+    """
+    Render template prompt (phân tích sẵn 1 lần, cache theo nội dung).
+    Có ghi chú người dùng mà template chưa có {user_note}/{user_notes} thì tự thêm dòng ghi chú.
+    """
+    template = compile_template(text)
+    if user_note_str and not template.uses("user_note", "user_notes"):
+        template = compile_template(text + USER_NOTE_SUFFIX)
+    return template.render(**values)
 
 def strip_thinking(text):
     """Remove thinking block prefix from AI responses through proxy."""
     if not text:
         return text
-    import re
     # 1. Remove content between thinking/thought/think tags (thinking blocks)
     cleaned = re.sub(r'<thinking>.*?</thinking>', '', text, flags=re.DOTALL)
     cleaned = re.sub(r'<thought>.*?</thought>', '', cleaned, flags=re.DOTALL)
@@ -88,28 +54,83 @@ def strip_thinking(text):
     cleaned = cleaned.strip()
     return cleaned
 
-def call_ai_api(api_key, model_name, prompt):
-    client = OpenAI(
-        base_url="https://khoitran1999-claude-server.hf.space/v1",
-        api_key=api_key
-    )
+_THINKING_TAGS = ("thinking", "thought", "think")
+_CLOSED_THINKING_RE = re.compile(r'<(thinking|thought|think)>.*?</\1>', re.DOTALL)
+_OPEN_THINKING_RE = re.compile(r'<(?:thinking|thought|think)>')
+_PLAIN_THINKING_PREFIX_RE = re.compile(r'^(?:<thought>|<thinking>|<think>|thought|thinking|think)\b', re.IGNORECASE)
 
-    response = client.chat.completions.create(
-        model=model_name,
-        messages=[{"role": "user", "content": prompt}],
-        stream=False
-    )
+class ThinkingStreamFilter:
+    """
+    Lọc thinking block trên text đang stream: trả về phần text đã chắc chắn hiển thị được.
+    Phần từ thẻ mở chưa đóng (hoặc một thẻ đang gõ dở ở cuối) trở đi sẽ được giữ lại
+    cho tới khi nhận đủ. Các block đã đóng chỉ quét một lần rồi được bỏ khỏi buffer.
+    """
+    def __init__(self):
+        self._pending = ""
+        self._visible = ""
+
+    def feed(self, delta):
+        self._pending += delta
+        # Bỏ các block đã đóng, phần text đứng trước chúng đã an toàn để hiển thị
+        while True:
+            match = _CLOSED_THINKING_RE.search(self._pending)
+            if not match:
+                break
+            self._visible += self._pending[:match.start()]
+            self._pending = self._pending[match.end():]
+
+        safe = self._pending
+        open_match = _OPEN_THINKING_RE.search(safe)
+        if open_match:
+            safe = safe[:open_match.start()]
+        else:
+            # Thẻ mở đang gõ dở ở cuối buffer (ví dụ "<thi")
+            tail = safe.rfind("<")
+            if tail != -1 and any(f"<{tag}>".startswith(safe[tail:]) for tag in _THINKING_TAGS):
+                safe = safe[:tail]
+        return self.visible_text(self._visible + safe)
+
+    @staticmethod
+    def visible_text(text):
+        stripped = text.lstrip()
+        if _PLAIN_THINKING_PREFIX_RE.match(stripped):
+            cleaned = strip_thinking(stripped)
+            # Chưa thấy ranh giới nội dung thật thì chưa hiển thị gì
+            return "" if _PLAIN_THINKING_PREFIX_RE.match(cleaned) else cleaned
+        return stripped
+
+def call_ai_api(api_key, model_name, prompt, on_text=None):
+    """
+    Gọi LLM với một prompt. Nếu có `on_text`, dùng chế độ stream và gọi `on_text(text_hiển_thị)`
+    mỗi khi nhận thêm token (đã lọc thinking block); kết quả trả về luôn là bản đầy đủ đã làm sạch.
+    """
+    messages = [{"role": "user", "content": prompt}]
+
+    if on_text is None:
+        response = llm_clients.chat_completion(api_key, model_name, messages, stream=False)
+        content = response.choices[0].message.content
+    else:
+        stream_filter = ThinkingStreamFilter()
+        parts = []
+        last_visible = ""
+        for delta in llm_clients.stream_chat_completion(api_key, model_name, messages):
+            parts.append(delta)
+            visible = stream_filter.feed(delta)
+            if visible and visible != last_visible:
+                last_visible = visible
+                try:
+                    on_text(visible)
+                except Exception as e:
+                    print(f"⚠️ Lỗi callback stream: {e}")
+        content = "".join(parts)
 
-    content = response.choices[0].message.content
     if not content:
         raise Exception("Empty response from AI model")
     return strip_thinking(content)
 
-# Khởi tạo Global Instance
-gemini_key_manager = GeminiKeyManager()
 
 
-def get_ai_advice(today, r_data, r_score, l_data, user_config, prompt_template=None, mode="daily", aqi_data=None, user_note=None):
+def get_ai_advice(today, r_data, r_score, l_data, user_config, prompt_template=None, mode="daily", aqi_data=None, user_note=None, on_text=None):
     """
     Gọi AI để lấy lời khuyên. Tự động xoay key khi gặp lỗi Quota.
     """
@@ -178,13 +199,10 @@ def get_ai_advice(today, r_data, r_score, l_data, user_config, prompt_template=N
             user_tmplt = prompt_template.get("user_template", "")
             model_to_use = prompt_template.get("model", default_model)
 
-            if user_note_str and "{user_note}" not in user_tmplt and "{user_notes}" not in user_tmplt:
-                user_tmplt += "\n\n- **Ghi chú hôm nay từ người dùng:** {user_note}"
-
             # Format User Template only (System Prompt is usually static or minimal)
             # If system prompt specifically needs formatting, add it here.
             # Assuming currently only user_template needs dynamic data.
-            formatted_user_part = user_tmplt.format(
+            formatted_user_part = render_prompt_template(user_tmplt, user_note_str,
                 user_label=user_label,
                 goal=goal,
                 injury=injury,
@@ -217,12 +235,7 @@ def get_ai_advice(today, r_data, r_score, l_data, user_config, prompt_template=N
     elif prompt_template and isinstance(prompt_template, str):
          # Old behavior / Fallback if string passed
          try:
-            if user_note_str and "{user_note}" not in prompt_template and "{user_notes}" not in prompt_template:
-                prompt_template_modified = prompt_template + "\n\n- **Ghi chú hôm nay từ người dùng:** {user_note}"
-            else:
-                prompt_template_modified = prompt_template
-
-            formatted_prompt = prompt_template_modified.format(
+            formatted_prompt = render_prompt_template(prompt_template, user_note_str,
                 user_label=user_label,
                 goal=goal,
                 injury=injury,
@@ -348,7 +361,7 @@ def get_ai_advice(today, r_data, r_score, l_data, user_config, prompt_template=N
     # --- GỌI API TRỰC TIẾP (Không Retry Key) ---
     try:
         if Config.ROUTER9_API_KEY:
-            ai_report = call_ai_api(Config.ROUTER9_API_KEY, model_to_use, prompt)
+            ai_report = call_ai_api(Config.ROUTER9_API_KEY, model_to_use, prompt, on_text=on_text)
             if ai_report and email:
                 report_with_time = f"--- [Thời gian báo cáo: {current_now}] ---\n{ai_report}"
                 redis_service.save_ai_context(email, mode, report_with_time)
@@ -360,7 +373,7 @@ def get_ai_advice(today, r_data, r_score, l_data, user_config, prompt_template=N
         print(f"[{user_label}] AI Error: {str(e)}")
         return "AI Coach đang bận hoặc gặp lỗi. Vui lòng thử lại sau."
 
-def get_battery_analysis_advice(today, r_data, user_config, prompt_template=None, aqi_data=None, user_note=None):
+def get_battery_analysis_advice(today, r_data, user_config, prompt_template=None, aqi_data=None, user_note=None, on_text=None):
     """
     Gọi AI để phân tích năng lượng (Body Battery & Stress) trong ngày.
     """
@@ -402,10 +415,7 @@ def get_battery_analysis_advice(today, r_data, user_config, prompt_template=None
             user_tmplt = prompt_template.get("user_template", "")
             model_to_use = prompt_template.get("model", default_model)
 
-            if user_note_str and "{user_note}" not in user_tmplt and "{user_notes}" not in user_tmplt:
-                user_tmplt += "\n\n- **Ghi chú hôm nay từ người dùng:** {user_note}"
-
-            formatted_user_part = user_tmplt.format(
+            formatted_user_part = render_prompt_template(user_tmplt, user_note_str,
                 user_label=user_label,
                 goal=goal,
                 user_note=user_note_str or "Không có",
@@ -422,12 +432,7 @@ def get_battery_analysis_advice(today, r_data, user_config, prompt_template=None
             formatted_prompt = None
     elif prompt_template and isinstance(prompt_template, str):
          try:
-            if user_note_str and "{user_note}" not in prompt_template and "{user_notes}" not in prompt_template:
-                prompt_template_modified = prompt_template + "\n\n- **Ghi chú hôm nay từ người dùng:** {user_note}"
-            else:
-                prompt_template_modified = prompt_template
-
-            formatted_prompt = prompt_template_modified.format(
+            formatted_prompt = render_prompt_template(prompt_template, user_note_str,
                 user_label=user_label,
                 goal=goal,
                 user_note=user_note_str or "Không có",
@@ -482,7 +487,7 @@ def get_battery_analysis_advice(today, r_data, user_config, prompt_template=None
 
     try:
         if Config.ROUTER9_API_KEY:
-            ai_report = call_ai_api(Config.ROUTER9_API_KEY, model_to_use, prompt)
+            ai_report = call_ai_api(Config.ROUTER9_API_KEY, model_to_use, prompt, on_text=on_text)
             if ai_report and email:
                 report_with_time = f"--- [Thời gian báo cáo: {current_now}] ---\n{ai_report}"
                 redis_service.save_ai_context(email, mode, report_with_time)
@@ -493,7 +498,7 @@ def get_battery_analysis_advice(today, r_data, user_config, prompt_template=None
     except Exception as e:
         print(f"[{user_label}] AI Error: {str(e)}")
         return "AI Coach đang bận hoặc gặp lỗi. Vui lòng thử lại sau."
-def get_workout_analysis_advice(activity_data_list, user_config, prompt_template=None, aqi_data=None, user_note=None):
+def get_workout_analysis_advice(activity_data_list, user_config, prompt_template=None, aqi_data=None, user_note=None, on_text=None):
     """
     Phân tích chi tiết (Time-series) các bài tập trong 24h.
     """
@@ -539,10 +544,7 @@ def get_workout_analysis_advice(activity_data_list, user_config, prompt_template
             user_tmplt = prompt_template.get("user_template", "")
             model_to_use = prompt_template.get("model", default_model)
 
-            if user_note_str and "{user_note}" not in user_tmplt and "{user_notes}" not in user_tmplt:
-                user_tmplt += "\n\n- **Ghi chú hôm nay từ người dùng:** {user_note}"
-
-            formatted_user = user_tmplt.format(
+            formatted_user = render_prompt_template(user_tmplt, user_note_str,
                 user_label=user_label,
                 goal=goal,
                 user_note=user_note_str or "Không có",
@@ -558,12 +560,7 @@ def get_workout_analysis_advice(activity_data_list, user_config, prompt_template
 
     elif prompt_template and isinstance(prompt_template, str):
         try:
-            if user_note_str and "{user_note}" not in prompt_template and "{user_notes}" not in prompt_template:
-                prompt_template_modified = prompt_template + "\n\n- **Ghi chú hôm nay từ người dùng:** {user_note}"
-            else:
-                prompt_template_modified = prompt_template
-
-            formatted_prompt = prompt_template_modified.format(
+            formatted_prompt = render_prompt_template(prompt_template, user_note_str,
                 user_label=user_label,
                 goal=goal,
                 user_note=user_note_str or "Không có",
@@ -629,7 +626,7 @@ def get_workout_analysis_advice(activity_data_list, user_config, prompt_template
 
     try:
         if Config.ROUTER9_API_KEY:
-            ai_report = call_ai_api(Config.ROUTER9_API_KEY, model_to_use, prompt)
+            ai_report = call_ai_api(Config.ROUTER9_API_KEY, model_to_use, prompt, on_text=on_text)
             if ai_report and email:
                 report_with_time = f"--- [Thời gian báo cáo: {current_now}] ---\n{ai_report}"
                 redis_service.save_ai_context(email, mode, report_with_time)
@@ -661,7 +658,7 @@ def get_speech_script(original_text, user_config, prompt_template=None, mode="da
              user_tmplt = prompt_template.get("user_template", "")
              model_to_use = prompt_template.get("model", default_model)
              
-             formatted_user = user_tmplt.format(
+             formatted_user = render_prompt_template(user_tmplt, None,
                 user_label=user_label,
                 context_str=context_str,
                 original_text=original_text
@@ -673,7 +670,7 @@ def get_speech_script(original_text, user_config, prompt_template=None, mode="da
 
     elif prompt_template and isinstance(prompt_template, str):
         try:
-            formatted_prompt = prompt_template.format(
+            formatted_prompt = render_prompt_template(prompt_template, None,
                 user_label=user_label,
                 context_str=context_str,
                 original_text=original_text
@@ -704,51 +701,32 @@ def get_speech_script(original_text, user_config, prompt_template=None, mode="da
         print(f"[{user_label}] AI Error: {str(e)}")
         return "Xin chào, đây là báo cáo sức khỏe của bạn. Hãy kiểm tra tin nhắn văn bản để biết chi tiết."
 
-def parse_audio_mime_type(mime_type: str) -> Dict[str, Optional[int]]:
-    """Parses bits per sample and rate from an audio MIME type string."""
-    bits_per_sample = 16
-    rate = 24000
-    parts = mime_type.split(";")
-    for param in parts:
-        param = param.strip()
-        if param.lower().startswith("rate="):
-            try:
-                rate_str = param.split("=", 1)[1]
-                rate = int(rate_str)
-            except (ValueError, IndexError):
-                pass 
-        elif param.startswith("audio/L"):
-            try:
-                bits_per_sample = int(param.split("L", 1)[1])
-            except (ValueError, IndexError):
-                pass
-    return {"bits_per_sample": bits_per_sample, "rate": rate}
-
-def convert_to_wav(audio_data: bytes, mime_type: str) -> bytes:
-    """Generates a WAV file header for the given audio data and parameters."""
-    parameters = parse_audio_mime_type(mime_type)
-    bits_per_sample = parameters["bits_per_sample"]
-    sample_rate = parameters["rate"]
-    num_channels = 1
-    data_size = len(audio_data)
-    bytes_per_sample = bits_per_sample // 8
-    block_align = num_channels * bytes_per_sample
-    byte_rate = sample_rate * block_align
-    chunk_size = 36 + data_size
-
-    header = struct.pack(
-        "<4sI4s4sIHHIIHH4sI",
-        b"RIFF", chunk_size, b"WAVE", b"fmt ", 16, 1, num_channels, 
-        sample_rate, byte_rate, block_align, bits_per_sample, b"data", data_size
-    )
-    return header + audio_data
+TTS_MODEL = "gemini-2.5-flash-preview-tts"
+_SENTENCE_END_RE = re.compile(r'(?<=[.!?…:;])\s+|\n+')
 
-async def generate_audio_from_text(text, output_file, voice="Sadachbia"):
+def split_script_into_chunks(text, max_chars=None):
     """
-    Tạo file WAV dùng Gemini TTS.
+    Chia kịch bản nói tại ranh giới câu thành các đoạn <= max_chars ký tự (gộp câu ngắn),
+    để tổng hợp giọng nói song song.
+    """
+    max_chars = max_chars or Config.TTS_CHUNK_CHARS
+    sentences = [s.strip() for s in _SENTENCE_END_RE.split(text or "") if s and s.strip()]
+    chunks = []
+    current = ""
+    for sentence in sentences:
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+def synthesize_pcm(api_key, text, voice="Sadachbia", model_name=TTS_MODEL):
+    """
+    Gọi Gemini TTS (stream) cho một đoạn text. Trả về (pcm_bytes, mime_type).
     """
-    print(f"Generating voice with Gemini ({voice})...")
-        
     generate_content_config = types.GenerateContentConfig(
         temperature=1,
         response_modalities=["audio"],
@@ -760,113 +738,172 @@ async def generate_audio_from_text(text, output_file, voice="Sadachbia"):
             )
         ),
     )
-    
-    model_name = "gemini-2.5-flash-preview-tts"
-
-    # --- ROTATION LOGIC for TTS (Refactored) ---
-    def worker(api_key):
-        client = genai.Client(api_key=api_key)
-        contents = [
-            types.Content(
-                role="user",
-                parts=[types.Part.from_text(text=text)],
-            ),
-        ]
-        
-        all_raw_bytes = bytearray()
-        mime_type = None
-
-        for chunk in client.models.generate_content_stream(
-            model=model_name,
-            contents=contents,
-            config=generate_content_config,
-        ):
-            if (chunk.candidates is None
-                or chunk.candidates[0].content is None
-                or chunk.candidates[0].content.parts is None):
-                continue
-            
-            part = chunk.candidates[0].content.parts[0]
-            if part.inline_data and part.inline_data.data:
-                if not mime_type:
-                    mime_type = part.inline_data.mime_type
-                all_raw_bytes.extend(part.inline_data.data)
-
-        if len(all_raw_bytes) > 0:
-            final_mime_type = mime_type if mime_type else "audio/L16;rate=24000"
-            wav_data = convert_to_wav(all_raw_bytes, final_mime_type)
-
-            final_output_file = output_file
-            if not final_output_file.lower().endswith(".wav"):
-                    final_output_file = final_output_file.rsplit('.', 1)[0] + ".wav"
-            
-            # Write file
-            with open(final_output_file, "wb") as f:
-                f.write(wav_data)
-            print(f"Audio saved to {final_output_file}")
-            return True
-        else:
-             raise Exception("Stream finished but no audio data collected.")
+    client = genai.Client(api_key=api_key)
+    contents = [
+        types.Content(
+            role="user",
+            parts=[types.Part.from_text(text=text)],
+        ),
+    ]
 
-    return gemini_key_manager.execute_with_retry(
-        worker_func=worker,
-        default_return=False,
-        verbose_label="Gemini TTS"
-    )
+    all_raw_bytes = bytearray()
+    mime_type = None
+
+    for chunk in client.models.generate_content_stream(
+        model=model_name,
+        contents=contents,
+        config=generate_content_config,
+    ):
+        if (chunk.candidates is None
+            or chunk.candidates[0].content is None
+            or chunk.candidates[0].content.parts is None):
+            continue
+
+        part = chunk.candidates[0].content.parts[0]
+        if part.inline_data and part.inline_data.data:
+            if not mime_type:
+                mime_type = part.inline_data.mime_type
+            all_raw_bytes.extend(part.inline_data.data)
+
+    if len(all_raw_bytes) == 0:
+        raise Exception("Stream finished but no audio data collected.")
+    return bytes(all_raw_bytes), mime_type or "audio/L16;rate=24000"
 
-def filter_time_series(values_list, start_time=None, end_time=None, downsample_factor=5):
+def _silence(mime_type, seconds):
+    params = parse_audio_mime_type(mime_type)
+    frame_bytes = params["bits_per_sample"] // 8
+    return b"\x00" * (int(params["rate"] * seconds) * frame_bytes)
+
+async def generate_audio_from_text(text, voice="Sadachbia"):
     """
-    Lọc danh sách time-series [[ts_ms, val], ...] theo khung giờ HH:MM và giảm tải số lượng điểm dữ liệu.
+    Tạo voice note dùng Gemini TTS, encode trong bộ nhớ (OGG/Opus nếu có ffmpeg, ngược lại WAV).
+    Kịch bản dài được chia theo câu và tổng hợp song song trên nhiều key, rồi ghép PCM theo thứ tự.
+    Trả về dict {data, filename, mime_type, duration} hoặc None nếu lỗi.
     """
-    import pytz
-    from datetime import datetime
+    print(f"Generating voice with Gemini ({voice})...")
+    model_name = TTS_MODEL
+
+    import asyncio
+    cache_key = tts_cache.make_key(text, voice, model_name)
+    cached_clip = await asyncio.to_thread(tts_cache.get, cache_key)
+    if cached_clip:
+        print(f"💾 TTS cache hit ({cached_clip['filename']}), bỏ qua Gemini TTS.")
+        return cached_clip
 
+    chunks = split_script_into_chunks(text) if Config.TTS_CHUNKED else [text]
+    if not chunks:
+        return None
+    parallel = max(1, min(Config.TTS_MAX_PARALLEL, gemini_key_manager.get_key_count() or 1))
+    semaphore = asyncio.Semaphore(parallel)
+
+    # --- KEY SCHEDULER cho TTS: mỗi đoạn chạy trên key khỏe nhất còn quota ---
+    async def synthesize_chunk(index, chunk_text):
+        async with semaphore:
+            return await gemini_key_manager.aexecute(
+                lambda api_key: synthesize_pcm(api_key, chunk_text, voice, model_name),
+                default_return=None,
+                verbose_label=f"Gemini TTS {index + 1}/{len(chunks)}"
+            )
+
+    started = time.monotonic()
+    results = await asyncio.gather(*(synthesize_chunk(i, c) for i, c in enumerate(chunks)))
+    if any(r is None for r in results):
+        print("⚠️ Gemini TTS: Có đoạn không tạo được audio, bỏ qua Voice Note.")
+        return None
+
+    mime_type = results[0][1]
+    gap = _silence(mime_type, Config.TTS_CHUNK_GAP_SECONDS) if len(results) > 1 else b""
+    pcm = gap.join(r[0] for r in results)
+    print(f"🎙️ TTS xong {len(chunks)} đoạn (song song {parallel}) trong {time.monotonic() - started:.1f}s")
+
+    clip = await asyncio.to_thread(encode_voice_note, pcm, mime_type)
+    print(f"Audio encoded: {clip['filename']} {len(clip['data']) // 1024}KB (PCM {len(pcm) // 1024}KB)")
+    await asyncio.to_thread(tts_cache.set, cache_key, clip)
+    return clip
+
+# Timezone và nhãn HH:MM dùng chung (tránh tạo lại trong vòng lặp nóng)
+VN_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
+_MINUTE_LABELS = [f"{m // 60:02d}:{m % 60:02d}" for m in range(1440)]
+
+def _parse_hhmm(value):
+    if not value:
+        return None
+    try:
+        parts = value.split(":")
+        return int(parts[0]) * 60 + int(parts[1])
+    except Exception:
+        return None
+
+def _local_minutes_of_day(ts_ms):
+    """
+    Quy đổi mảng timestamp (ms, UTC) sang phút trong ngày theo giờ VN, tính hàng loạt.
+    Offset được lấy từ VN_TZ; nếu offset thay đổi trong khoảng dữ liệu thì tính từng phần tử.
+    """
+    seconds = np.floor(ts_ms / 1000.0).astype(np.int64)
+    first = datetime.fromtimestamp(int(seconds.min()), VN_TZ).utcoffset().total_seconds()
+    last = datetime.fromtimestamp(int(seconds.max()), VN_TZ).utcoffset().total_seconds()
+    if first == last:
+        offsets = int(first)
+    else:
+        offsets = np.array([datetime.fromtimestamp(int(sec), VN_TZ).utcoffset().total_seconds() for sec in seconds], dtype=np.int64)
+    return ((seconds + offsets) // 60) % 1440
+
+def filter_time_series(values_list, start_time=None, end_time=None, point_budget=None, method=None):
+    """
+    Lọc danh sách time-series [[ts_ms, val], ...] theo khung giờ HH:MM và giảm về tối đa
+    `point_budget` điểm (mặc định Config.SERIES_POINT_BUDGET, 0 = giữ nguyên) bằng bộ
+    downsampler `method` (mặc định Config.SERIES_DOWNSAMPLER) để giữ đỉnh/đáy mà vẫn tiết kiệm token.
+    """
     if not values_list:
         return []
 
-    start_min = None
-    end_min = None
-    if start_time:
-        try:
-            parts = start_time.split(":")
-            start_min = int(parts[0]) * 60 + int(parts[1])
-        except Exception: pass
-    if end_time:
-        try:
-            parts = end_time.split(":")
-            end_min = int(parts[0]) * 60 + int(parts[1])
-        except Exception: pass
-
-    vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
-    filtered = []
+    start_min = _parse_hhmm(start_time)
+    end_min = _parse_hhmm(end_time)
 
+    timestamps = []
+    values = []
     for item in values_list:
-        if not isinstance(item, (list, tuple)):
+        if not isinstance(item, (list, tuple)) or len(item) < 2:
             continue
-        if len(item) < 2:
-            continue
-        ts_ms = item[0]
         # In some Garmin endpoints (e.g. get_all_day_stress), body battery values
         # have type at index 1 and value at index 2 (e.g. [timestamp_ms, 'MEASURED', 25, 2.0])
         val = item[2] if len(item) >= 3 and isinstance(item[1], str) else item[1]
         if val is None or not isinstance(val, (int, float)) or val < 0:
             continue
+        timestamps.append(item[0])
+        values.append(val)
 
-        dt = datetime.fromtimestamp(ts_ms / 1000, vn_tz)
-        time_str = dt.strftime("%H:%M")
-        item_min = dt.hour * 60 + dt.minute
+    if not timestamps:
+        return []
 
-        if start_min is not None and item_min < start_min:
-            continue
-        if end_min is not None and item_min > end_min:
-            continue
+    ts_ms = np.asarray(timestamps, dtype=np.float64)
+    minutes = _local_minutes_of_day(ts_ms)
 
-        filtered.append({"time": time_str, "value": val})
+    mask = np.ones(len(minutes), dtype=bool)
+    if start_min is not None:
+        mask &= minutes >= start_min
+    if end_min is not None:
+        mask &= minutes <= end_min
+    selected = np.flatnonzero(mask)
 
-    if not start_time and not end_time and len(filtered) > 100:
-        filtered = filtered[::downsample_factor]
+    if point_budget is None:
+        point_budget = Config.SERIES_POINT_BUDGET
+    if point_budget and len(selected) > point_budget:
+        kept = downsample(ts_ms[selected], np.asarray(values, dtype=np.float64)[selected], point_budget, method or Config.SERIES_DOWNSAMPLER)
+        selected = selected[kept]
 
-    return filtered
+    return [
+        {"time": _MINUTE_LABELS[minute], "value": values[idx]}
+        for idx, minute in zip(selected.tolist(), minutes[selected].tolist())
+    ]
+
+def _series_budget(args):
+    """
+    Số điểm tối đa cho chuỗi time-series của tool: không có `task` thì payload được phân tích cục bộ
+    (summarize_tool_payload) nên giữ nguyên độ phân giải (giảm mẫu làm lệch trung bình / thời gian theo vùng);
+    có `task` thì payload gửi cho MODEL_WORKER nên giảm theo SERIES_POINT_BUDGET.
+    """
+    return None if args.get("task") else 0
 
 GARMIN_TOOLS = [
     {
@@ -1445,9 +1482,9 @@ def execute_garmin_tool(client, name: str, args: dict, user_label: str = "User")
             return json.dumps({"sleep_analysis": sleep_desc}, ensure_ascii=False)
 
         elif name == "get_stress_trend":
-            stress_data = client.get_all_day_stress(date_str) or {}
+            stress_data = timeseries_store.fetch(client, "get_all_day_stress", date_str, user_label) or {}
             stress_values = stress_data.get("stressValuesArray") or []
-            filtered_stress = filter_time_series(stress_values, args.get("start_time"), args.get("end_time"), downsample_factor=5)
+            filtered_stress = filter_time_series(stress_values, args.get("start_time"), args.get("end_time"), point_budget=_series_budget(args))
 
             avg_stress = stress_data.get('avgStress') or stress_data.get('averageStressLevel')
             stress_duration = stress_data.get('stressDuration')
@@ -1460,10 +1497,10 @@ def execute_garmin_tool(client, name: str, args: dict, user_label: str = "User")
 
         elif name == "get_body_battery_trend":
             # Use get_body_battery which contains correct charged/drained and clean 2-item bb values
-            bb_data_list = client.get_body_battery(date_str) or []
+            bb_data_list = timeseries_store.fetch(client, "get_body_battery", date_str, user_label) or []
             bb_data = bb_data_list[0] if bb_data_list else {}
             bb_values = bb_data.get("bodyBatteryValuesArray") or []
-            filtered_bb = filter_time_series(bb_values, args.get("start_time"), args.get("end_time"), downsample_factor=5)
+            filtered_bb = filter_time_series(bb_values, args.get("start_time"), args.get("end_time"), point_budget=_series_budget(args))
 
             events = client.get_body_battery_events(date_str) or []
             naps = [e for e in events if e.get('eventType') == 'NAP']
@@ -1661,9 +1698,9 @@ def execute_garmin_tool(client, name: str, args: dict, user_label: str = "User")
             }, ensure_ascii=False)
 
         elif name == "get_heart_rates":
-            hr_data = client.get_heart_rates(date_str) or {}
+            hr_data = timeseries_store.fetch(client, "get_heart_rates", date_str, user_label) or {}
             hr_values = hr_data.get("heartRateValues") or []
-            filtered_hr = filter_time_series(hr_values, args.get("start_time"), args.get("end_time"), downsample_factor=5)
+            filtered_hr = filter_time_series(hr_values, args.get("start_time"), args.get("end_time"), point_budget=_series_budget(args))
             return json.dumps({
                 "restingHeartRate": hr_data.get("restingHeartRate"),
                 "maxHeartRate": hr_data.get("maxHeartRate"),
@@ -1673,7 +1710,7 @@ def execute_garmin_tool(client, name: str, args: dict, user_label: str = "User")
             }, ensure_ascii=False)
 
         elif name == "get_steps_trend":
-            steps_data = client.get_steps_data(date_str) or []
+            steps_data = timeseries_store.fetch(client, "get_steps_data", date_str, user_label) or []
             results = []
 
             start_t = args.get("start_time")
@@ -1791,44 +1828,81 @@ def execute_garmin_tool(client, name: str, args: dict, user_label: str = "User")
         return json.dumps({"error": f"Lỗi khi truy xuất dữ liệu {name}: {str(e)}"}, ensure_ascii=False)
 
 def call_ai_api_raw(api_key, model_name, messages, tools=None):
-    from openai import OpenAI
-    client = OpenAI(
-        base_url="https://khoitran1999-claude-server.hf.space/v1",
-        api_key=api_key
-    )
-    kwargs = {
-        "model": model_name,
-        "messages": messages,
-        "stream": False
-    }
+    kwargs = {"stream": False}
     if tools:
         kwargs["tools"] = tools
 
-    response = client.chat.completions.create(**kwargs)
+    response = llm_clients.chat_completion(api_key, model_name, messages, **kwargs)
     return response.choices[0].message
 
 async def call_ai_api_raw_async(api_key, model_name, messages, tools=None):
-    from openai import AsyncOpenAI
-    client = AsyncOpenAI(
-        base_url="https://khoitran1999-claude-server.hf.space/v1",
-        api_key=api_key
-    )
-    kwargs = {
-        "model": model_name,
-        "messages": messages,
-        "stream": False
-    }
+    kwargs = {"stream": False}
     if tools:
         kwargs["tools"] = tools
 
-    response = await client.chat.completions.create(**kwargs)
+    response = await llm_clients.achat_completion(api_key, model_name, messages, **kwargs)
     return response.choices[0].message
 
+# Thống kê số lần gọi / bỏ qua MODEL_WORKER trong process
+worker_stats = {"calls": 0, "avoided": 0}
+
+def _longest_series(data):
+    """Độ dài list dài nhất trong payload (để nhận diện chuỗi time-series)."""
+    if isinstance(data, list):
+        return max([len(data)] + [_longest_series(v) for v in data[:5]])
+    if isinstance(data, dict):
+        return max([0] + [_longest_series(v) for v in data.values()])
+    return 0
+
+def needs_worker(raw_data_str, data=None):
+    """
+    Chỉ cần MODEL_WORKER khi payload lớn: vượt ngưỡng ký tự hoặc chứa chuỗi time-series dài.
+    """
+    if len(raw_data_str) >= Config.WORKER_MIN_PAYLOAD_CHARS:
+        return True
+    return data is not None and _longest_series(data) >= Config.WORKER_MIN_SERIES_POINTS
+
+def summarize_small_payload(tool_name, data, max_lines=40):
+    """
+    Tóm tắt tất định cho payload nhỏ: liệt kê các trường có giá trị dạng "- key: value".
+    """
+    lines = []
+
+    def walk(value, path):
+        if len(lines) >= max_lines:
+            return
+        if isinstance(value, dict):
+            for k, v in value.items():
+                walk(v, f"{path}.{k}" if path else str(k))
+        elif isinstance(value, list):
+            if value and all(not isinstance(v, (dict, list)) for v in value):
+                lines.append(f"- {path}: {', '.join(str(v) for v in value)}")
+            else:
+                for idx, v in enumerate(value, 1):
+                    walk(v, f"{path}[{idx}]" if path else f"[{idx}]")
+        elif value not in (None, ""):
+            lines.append(f"- {path}: {value}")
+
+    walk(data, "")
+    if not lines:
+        return f"Dữ liệu {tool_name}: không ghi nhận được chỉ số nào."
+    return f"Dữ liệu {tool_name}:\n" + "\n".join(lines)
+
+def _is_tool_error(raw_data_str):
+    """Kiểm tra payload tool có phải là lỗi (không nên cache) hay không."""
+    import json
+    try:
+        data = json.loads(raw_data_str)
+    except Exception:
+        return False
+    return isinstance(data, dict) and "error" in data
+
 async def process_data_with_worker(tool_name: str, tool_args: dict, raw_data_str: str, user_label: str = "User") -> str:
     """
     Sử dụng MODEL_WORKER để xử lý và tóm tắt dữ liệu Garmin Connect thô trước khi trả về cho MODEL_BRAIN.
     """
     import json
+    data = None
     try:
         data = json.loads(raw_data_str)
         if isinstance(data, dict) and "error" in data:
@@ -1836,10 +1910,24 @@ async def process_data_with_worker(tool_name: str, tool_args: dict, raw_data_str
     except Exception:
         pass
 
+    task = tool_args.get("task")
+
+    # Time-series lớn không có task riêng: phân tích cục bộ bằng NumPy thay cho MODEL_WORKER
+    if not task and data is not None:
+        local_summary = summarize_tool_payload(tool_name, data)
+        if local_summary:
+            worker_stats["avoided"] += 1
+            print(f"[{user_label}] ⚡ Local analytics for {tool_name} (avoided {worker_stats['avoided']}).")
+            return local_summary
+
+    # Payload nhỏ không có task riêng: tóm tắt cục bộ, bỏ qua một vòng gọi LLM
+    if not task and data is not None and not needs_worker(raw_data_str, data):
+        worker_stats["avoided"] += 1
+        print(f"[{user_label}] ⚡ Skip MODEL_WORKER for small {tool_name} payload ({len(raw_data_str)} chars, avoided {worker_stats['avoided']}).")
+        return summarize_small_payload(tool_name, data)
+
     if not Config.ROUTER9_API_KEY:
         return raw_data_str
-
-    task = tool_args.get("task")
     if task:
         instruction_prompt = f"""
         Nhiệm vụ cụ thể của bạn được yêu cầu từ MODEL_BRAIN:
@@ -1876,6 +1964,7 @@ async def process_data_with_worker(tool_name: str, tool_args: dict, raw_data_str
     """
 
     try:
+        worker_stats["calls"] += 1
         print(f"[{user_label}] 🤖 Sending raw data of {tool_name} to MODEL_WORKER for preprocessing...")
         messages = [
             {"role": "system", "content": "You are a professional Garmin health data analyst. Answer in Vietnamese."},
@@ -1984,7 +2073,7 @@ YÊU CẦU:
         model_to_use = prompt_template.get("model", default_model)
         if user_tmplt:
             try:
-                user_query = user_tmplt.format(
+                user_query = render_prompt_template(user_tmplt, None,
                     user_label=user_label,
                     help_doc=help_doc,
                     chat_history=history_str,
@@ -2000,6 +2089,14 @@ YÊU CẦU:
     # 4. Gọi AI với Tool Calling loop
     try:
         if Config.ROUTER9_API_KEY:
+            # Watermark đồng bộ thiết bị: khóa cache kết quả tool (đổi khi thiết bị upload dữ liệu mới)
+            import asyncio
+            sync_watermark = 0
+            if garmin_client:
+                from app.services.garmin_service import get_device_watermark
+                sync_watermark, _, _ = await asyncio.to_thread(get_device_watermark, garmin_client, user_label)
+            cache_user_key = email or tele_id
+
             max_iterations = 5
             for iteration in range(max_iterations):
                 print(f"[{user_label}] Calling LLM (iteration {iteration+1})...")
@@ -2047,12 +2144,32 @@ YÊU CẦU:
 
                         print(f"[{user_label}] 🛠️ AI requests tool: {tool_name} with args {tool_args}")
 
-                        # 1. Fetch Garmin Connect raw data in a non-blocking thread
-                        import asyncio
-                        raw_result = await asyncio.to_thread(execute_garmin_tool, garmin_client, tool_name, tool_args, user_label)
-
-                        # 2. Process raw data with MODEL_WORKER LLM
-                        processed_result = await process_data_with_worker(tool_name, tool_args, raw_result, user_label)
+                        # 0. Tra cache (raw JSON + tóm tắt của MODEL_WORKER theo task); cache đọc/ghi Redis đồng bộ
+                        # nên chạy trong thread để các tool song song không chặn event loop
+                        cache_key = tool_cache.make_key(cache_user_key, tool_name, tool_args, sync_watermark)
+                        cached = await asyncio.to_thread(tool_cache.get, cache_key) or {}
+                        summaries = dict(cached.get("summaries") or {})
+                        task_key = tool_args.get("task") or ""
+
+                        if task_key in summaries:
+                            await asyncio.to_thread(tool_cache.record, "hits")
+                            print(f"[{user_label}] ⚡ Tool cache hit: {tool_name}")
+                            processed_result = summaries[task_key]
+                        else:
+                            raw_result = cached.get("raw")
+                            if raw_result is not None:
+                                await asyncio.to_thread(tool_cache.record, "raw_hits")
+                            else:
+                                await asyncio.to_thread(tool_cache.record, "misses")
+                                # 1. Fetch Garmin Connect raw data in a non-blocking thread
+                                raw_result = await asyncio.to_thread(execute_garmin_tool, garmin_client, tool_name, tool_args, user_label)
+
+                            # 2. Process raw data with MODEL_WORKER LLM
+                            processed_result = await process_data_with_worker(tool_name, tool_args, raw_result, user_label)
+
+                            if not _is_tool_error(raw_result):
+                                summaries[task_key] = processed_result
+                                await asyncio.to_thread(tool_cache.set, cache_key, {"raw": raw_result, "summaries": summaries}, tool_cache.ttl_for(tool_args, current_date_str))
 
                         return {
                             "role": "tool",
@@ -2062,7 +2179,6 @@ YÊU CẦU:
                         }
 
                     # Execute all requested tools in parallel
-                    import asyncio
                     tool_tasks = [run_single_tool_pipeline(tc) for tc in response_msg.tool_calls]
                     tool_responses = await asyncio.gather(*tool_tasks)
 
@@ -2074,6 +2190,7 @@ YÊU CẦU:
                 else:
                     # Final answer received
                     ai_reply = strip_thinking(response_msg.content)
+                    print(f"[{user_label}] 📊 Tool cache hit-rate: {tool_cache.hit_rate():.0%} ({tool_cache.stats})")
                     if ai_reply:
                         redis_service.save_chat_message(tele_id, "user", question, limit=10)
                         redis_service.save_chat_message(tele_id, "assistant", ai_reply, limit=10)
@@ -1,17 +1,52 @@
 from datetime import timedelta, datetime, date
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 import pytz
+from app.config import Config
+from app.services.timeseries_store import timeseries_store, client_user_key
+from app.services.garmin_session import garmin_session_pool, is_auth_error
+from app.utils.downsampling import downsample
 from app.utils.metrics import calculate_readiness_score, calculate_trimp_banister, seconds_to_text
 
 # Cấu hình cửa sổ quét (7 ngày cho Acute Load)
 DAYS_WINDOW = 7
 
-def get_time_series_stress_bb(client, date_iso, activities, user_label="User"):
+def fetch_garmin_concurrently(calls, user_label="User", max_workers=None, timeout=None):
+    """
+    Gọi song song nhiều endpoint Garmin độc lập bằng thread pool có giới hạn.
+    `calls` là dict {key: (func, *args)}. Trả về dict {key: result}; endpoint lỗi hoặc
+    quá timeout sẽ không có mặt trong kết quả (đã log lỗi).
+    """
+    max_workers = max_workers or Config.GARMIN_MAX_CONCURRENCY
+    timeout = timeout or Config.GARMIN_ENDPOINT_TIMEOUT
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(calls) or 1)))
+    futures = {key: executor.submit(func, *args) for key, (func, *args) in calls.items()}
+    results = {}
+
+    try:
+        for key, future in futures.items():
+            try:
+                results[key] = future.result(timeout=timeout)
+            except FuturesTimeoutError:
+                future.cancel()
+                print(f"[{user_label}] ⏱️ Garmin endpoint '{key}' quá {timeout}s, bỏ qua.")
+            except Exception as e:
+                print(f"[{user_label}] ⚠️ Lỗi gọi Garmin endpoint '{key}': {e}")
+    finally:
+        # Không chờ các request bị treo, để chúng tự kết thúc ở background
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return results
+
+def get_time_series_stress_bb(client, date_iso, activities, user_label="User", all_day_stress=None):
     """
     Rút gọn biểu đồ Stress và Body Battery thành các block 2h để tiết kiệm token cho AI,
     kèm theo mapping các hoạt động thể dục vào từng block.
+    Có thể truyền sẵn `all_day_stress` (đã fetch trước) để tránh gọi lại API.
     """
     try:
-        all_day_stress = client.get_all_day_stress(date_iso)
+        if all_day_stress is None:
+            all_day_stress = timeseries_store.fetch(client, "get_all_day_stress", date_iso, user_label)
         if not all_day_stress:
             return "Không có dữ liệu biểu đồ."
 
@@ -25,6 +60,7 @@ def get_time_series_stress_bb(client, date_iso, activities, user_label="User"):
 
         # 12 blocks, index 0 to 11 (0=0-2h, 1=2-4h...)
         blocks = {i: {"stress_sum": 0, "stress_count": 0, "bb_first": None, "bb_last": None, "activity_names": []} for i in range(12)}
+        bb_points = []
 
         # 1. Gán activities vào blocks
         for act in activities:
@@ -57,6 +93,7 @@ def get_time_series_stress_bb(client, date_iso, activities, user_label="User"):
                     b["stress_sum"] += val
                     b["stress_count"] += 1
                 elif val_type == "bb":
+                    bb_points.append((ts_ms, val))
                     if b["bb_first"] is None:
                         b["bb_first"] = val
                     b["bb_last"] = val
@@ -89,6 +126,14 @@ def get_time_series_stress_bb(client, date_iso, activities, user_label="User"):
             if parts:
                 lines.append(f"  [{time_label}] {' | '.join(parts)}")
 
+        # 3. Các điểm mốc Body Battery (đỉnh/đáy/điểm gãy) bằng LTTB, gọn hơn nhiều so với cả chuỗi
+        if len(bb_points) >= 2:
+            bb_ts = [p[0] for p in bb_points]
+            bb_levels = [p[1] for p in bb_points]
+            key_idx = downsample(bb_ts, bb_levels, Config.BB_KEY_POINTS, "lttb")
+            marks = [f"{datetime.fromtimestamp(bb_ts[i] / 1000, vn_tz).strftime('%H:%M')} {bb_levels[i]}" for i in key_idx.tolist()]
+            lines.append(f"  [Mốc Pin] {' → '.join(marks)}")
+
         if not lines:
             return "Không có dữ liệu biểu đồ."
 
@@ -97,39 +142,74 @@ def get_time_series_stress_bb(client, date_iso, activities, user_label="User"):
          print(f"[{user_label}] ⚠️ Lỗi xử lý timeseries 24h: {e}")
          return "Lỗi lấy biểu đồ 24h."
 
-def check_garmin_sync_status(client, max_age_hours=1.0, user_label="User"):
+def _to_epoch_ms(value):
+    """Chuẩn hóa timestamp Garmin (epoch ms hoặc chuỗi ISO GMT) về epoch ms."""
+    if not value:
+        return 0
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        dt = datetime.fromisoformat(str(value).replace("Z", "").split(".")[0])
+        return int(pytz.utc.localize(dt).timestamp() * 1000)
+    except ValueError:
+        return 0
+
+def call_with_reauth(client, method_name, *args, user_label="User"):
     """
-    Kiểm tra xem thiết bị có được sync trong khoảng thời gian cho phép hay không.
-    Trả về: (is_fresh: bool, message: str)
+    Gọi `client.<method_name>(*args)`; token bị từ chối (401) thì bỏ session khỏi pool,
+    đăng nhập lại 1 lần rồi gọi lại.
     """
-    print(f"[{user_label}] ⌚ Checking device sync freshness (Max Age: {max_age_hours}h)...")
-    
-    last_sync_ts = 0
+    try:
+        return getattr(client, method_name)(*args)
+    except Exception as e:
+        if not is_auth_error(e) or not garmin_session_pool.reauthenticate(client, user_label):
+            raise
+        return getattr(client, method_name)(*args)
+
+def get_device_watermark(client, user_label="User"):
+    """
+    Lấy thời điểm thiết bị upload dữ liệu gần nhất (watermark, epoch ms).
+    Trả về: (watermark_ms, device_name, source). watermark_ms = 0 nếu không xác định được.
+    """
+    watermark_ms = 0
     device_name = "Unknown Device"
     source = "None"
 
     # --- CÁCH 1: Check Last Used Device (Ưu tiên số 1) ---
+    # Là request Garmin đầu tiên của mọi luồng (report / sync / hỏi đáp) nên cũng là nơi phát hiện token bị thu hồi
     try:
-        last_used = client.get_device_last_used()
+        last_used = call_with_reauth(client, "get_device_last_used", user_label=user_label)
         if last_used:
-            last_sync_ts = last_used.get("lastUsedDeviceUploadTime", 0)
-            if last_sync_ts > 0: last_sync_ts = last_sync_ts / 1000
+            watermark_ms = _to_epoch_ms(last_used.get("lastUsedDeviceUploadTime"))
             device_name = last_used.get("lastUsedDeviceName") or last_used.get("deviceName")
             source = "LastUsed"
     except Exception as e:
         print(f"[{user_label}] ⚠️ Check Last Used Error: {e}")
 
     # --- CÁCH 2: Check User Summary (Fallback) ---
-    if last_sync_ts == 0:
+    if watermark_ms == 0:
         try:
             today_iso = date.today().isoformat()
             summary = client.get_user_summary(today_iso)
-            last_sync_ts = summary.get("lastSyncTimestampGMT", 0)
-            if last_sync_ts > 0: last_sync_ts = last_sync_ts / 1000
+            watermark_ms = _to_epoch_ms(summary.get("lastSyncTimestampGMT"))
             source = "UserSummary"
         except Exception:
             pass
 
+    # Ghi nhận để TimeSeriesStore biết dữ liệu nào đã materialise còn mới
+    timeseries_store.note_watermark(client_user_key(client), watermark_ms)
+    return watermark_ms, device_name, source
+
+def check_garmin_sync_status(client, max_age_hours=1.0, user_label="User"):
+    """
+    Kiểm tra xem thiết bị có được sync trong khoảng thời gian cho phép hay không.
+    Trả về: (is_fresh: bool, message: str)
+    """
+    print(f"[{user_label}] ⌚ Checking device sync freshness (Max Age: {max_age_hours}h)...")
+
+    watermark_ms, device_name, source = get_device_watermark(client, user_label)
+    last_sync_ts = watermark_ms / 1000 if watermark_ms > 0 else 0
+
     # --- EVALUATE ---
     if last_sync_ts == 0:
         return False, "Không tìm thấy dữ liệu đồng bộ nào."
@@ -156,33 +236,39 @@ def get_sleep_analysis(client, date_str, user_label="User"):
     """
     try:
         sleep_data = client.get_sleep_data(date_str)
-        dto = sleep_data.get('dailySleepDTO', {})
-        
-        if not dto:
-            return 0, "Không có dữ liệu giấc ngủ chi tiết (Chưa đồng bộ)."
-
-        deep = dto.get('deepSleepSeconds') or 0
-        light = dto.get('lightSleepSeconds') or 0
-        rem = dto.get('remSleepSeconds') or 0
-        awake = dto.get('awakeSleepSeconds') or 0
-        
-        # Tính tổng ngủ THỰC TẾ (Không tính Awake)
-        real_sleep_sec = deep + light + rem
-        real_sleep_hours = real_sleep_sec / 3600
-
-        sleep_text = (
-            f"Tổng ngủ thực: {seconds_to_text(real_sleep_sec)} (đã trừ lúc thức).\n"
-            f"   - Ngủ sâu (Deep): {seconds_to_text(deep)}\n"
-            f"   - Ngủ nông (Light): {seconds_to_text(light)}\n"
-            f"   - Ngủ mơ (REM): {seconds_to_text(rem)}\n"
-            f"   - Thời gian thức: {seconds_to_text(awake)}"
-        )
-        return real_sleep_hours, sleep_text
-
+        return summarize_sleep_data(sleep_data)
     except Exception as e:
         print(f"[{user_label}] ⚠️ Lỗi lấy chi tiết giấc ngủ: {e}")
         return 0, "Không lấy được chi tiết giấc ngủ."
 
+def summarize_sleep_data(sleep_data):
+    """
+    Tạo text mô tả giấc ngủ từ payload `get_sleep_data` đã có sẵn.
+    Trả về: (real_sleep_hours, sleep_description_text)
+    """
+    dto = sleep_data.get('dailySleepDTO', {})
+
+    if not dto:
+        return 0, "Không có dữ liệu giấc ngủ chi tiết (Chưa đồng bộ)."
+
+    deep = dto.get('deepSleepSeconds') or 0
+    light = dto.get('lightSleepSeconds') or 0
+    rem = dto.get('remSleepSeconds') or 0
+    awake = dto.get('awakeSleepSeconds') or 0
+
+    # Tính tổng ngủ THỰC TẾ (Không tính Awake)
+    real_sleep_sec = deep + light + rem
+    real_sleep_hours = real_sleep_sec / 3600
+
+    sleep_text = (
+        f"Tổng ngủ thực: {seconds_to_text(real_sleep_sec)} (đã trừ lúc thức).\n"
+        f"   - Ngủ sâu (Deep): {seconds_to_text(deep)}\n"
+        f"   - Ngủ nông (Light): {seconds_to_text(light)}\n"
+        f"   - Ngủ mơ (REM): {seconds_to_text(rem)}\n"
+        f"   - Thời gian thức: {seconds_to_text(awake)}"
+    )
+    return real_sleep_hours, sleep_text
+
 def get_processed_data(client, today, user_label="User"):
     print(f"[{user_label}] 🔄 Đang thu thập dữ liệu Garmin...")
     
@@ -193,44 +279,64 @@ def get_processed_data(client, today, user_label="User"):
         "timeseries_text": "Không có dữ liệu"
     }
     date_iso = today.isoformat()
+    start_date = today - timedelta(days=DAYS_WINDOW - 1)
+
+    # --- 0. Fan-out: gọi song song các endpoint độc lập ---
+    fetched = fetch_garmin_concurrently({
+        "summary": (timeseries_store.fetch, client, "get_user_summary", date_iso, user_label),
+        "sleep": (timeseries_store.fetch, client, "get_sleep_data", date_iso, user_label),
+        "spo2": (timeseries_store.fetch, client, "get_spo2_data", date_iso, user_label),
+        "respiration": (timeseries_store.fetch, client, "get_respiration_data", date_iso, user_label),
+        "hrv": (timeseries_store.fetch, client, "get_hrv_data", date_iso, user_label),
+        "training_status": (timeseries_store.fetch, client, "get_training_status", date_iso, user_label),
+        "activities": (timeseries_store.fetch_activities, client, start_date.isoformat(), date_iso, user_label),
+        "all_day_stress": (timeseries_store.fetch, client, "get_all_day_stress", date_iso, user_label),
+    }, user_label)
 
     # --- A. Lấy chỉ số cơ bản ---
     try:
-        summary = client.get_user_summary(date_iso)
-        stats = summary.get('stats', summary)
-        
-        # Handle None values explicitly using 'or 0'
-        readiness_data['rhr'] = stats.get('restingHeartRate') or 0
-        readiness_data['stress'] = stats.get('averageStressLevel') or 0
-        
-        bb_val = summary.get('stats_and_body', {}).get('bodyBatteryMostRecentValue')
-        if bb_val is None: bb_val = stats.get('bodyBatteryMostRecentValue') or 0
-        readiness_data['body_battery'] = bb_val
-        
-        events = stats.get('bodyBatteryActivityEventList') or []
-        if events:
-            for e in events:
-                if e.get('eventType') == 'NAP':
-                    readiness_data['nap_seconds'] += (e.get('durationInMilliseconds') or 0) / 1000
+        summary = fetched.get("summary")
+        if summary:
+            stats = summary.get('stats', summary)
+
+            # Handle None values explicitly using 'or 0'
+            readiness_data['rhr'] = stats.get('restingHeartRate') or 0
+            readiness_data['stress'] = stats.get('averageStressLevel') or 0
+
+            bb_val = summary.get('stats_and_body', {}).get('bodyBatteryMostRecentValue')
+            if bb_val is None: bb_val = stats.get('bodyBatteryMostRecentValue') or 0
+            readiness_data['body_battery'] = bb_val
+
+            events = stats.get('bodyBatteryActivityEventList') or []
+            if events:
+                for e in events:
+                    if e.get('eventType') == 'NAP':
+                        readiness_data['nap_seconds'] += (e.get('durationInMilliseconds') or 0) / 1000
                 
     except Exception as e:
         print(f"[{user_label}] ⚠️ Lỗi lấy User Summary: {e}")
 
     # --- B. Phân tích giấc ngủ sâu ---
-    real_hours, sleep_desc = get_sleep_analysis(client, date_iso, user_label)
+    try:
+        if "sleep" not in fetched:
+            raise ValueError("sleep data unavailable")
+        real_hours, sleep_desc = summarize_sleep_data(fetched["sleep"])
+    except Exception as e:
+        print(f"[{user_label}] ⚠️ Lỗi lấy chi tiết giấc ngủ: {e}")
+        real_hours, sleep_desc = 0, "Không lấy được chi tiết giấc ngủ."
     readiness_data['sleep_hours'] = real_hours
     readiness_data['sleep_text'] = sleep_desc
 
     # --- B2. SpO2 & Respiration ---
     try:
         # SpO2
-        spo2_data = get_spo2_data(client, date_iso) or {}
+        spo2_data = fetched.get("spo2") or {}
         readiness_data['avg_spo2'] = spo2_data.get('averageSpO2')
         readiness_data['min_spo2'] = spo2_data.get('lowestSpO2')
         readiness_data['last_spo2'] = spo2_data.get('latestSpO2')
 
         # Respiration
-        resp_data = get_respiration_data(client, date_iso) or {}
+        resp_data = fetched.get("respiration") or {}
         readiness_data['avg_waking_resp'] = resp_data.get('avgWakingRespirationValue')
         readiness_data['avg_sleep_resp'] = resp_data.get('avgSleepRespirationValue')
         readiness_data['min_resp'] = resp_data.get('lowestRespirationValue')
@@ -241,11 +347,11 @@ def get_processed_data(client, today, user_label="User"):
 
     # --- B3. HRV & Training Status ---
     try:
-        hrv_data = get_hrv_data(client, date_iso) or {}
+        hrv_data = fetched.get("hrv") or {}
         readiness_data['hrv_status'] = hrv_data.get('hrvStatus')
         readiness_data['last_night_hrv'] = hrv_data.get('lastNightAvg')
 
-        ts_data = get_training_status(client, date_iso) or {}
+        ts_data = fetched.get("training_status") or {}
         readiness_data['training_status'] = ts_data.get('trainingStatus')
 
     except Exception as e:
@@ -258,8 +364,9 @@ def get_processed_data(client, today, user_label="User"):
     today_activities = []
 
     try:
-        start_date = today - timedelta(days=DAYS_WINDOW - 1)
-        activities = client.get_activities_by_date(start_date.isoformat(), date_iso, "")
+        if "activities" not in fetched:
+            raise ValueError("activities unavailable")
+        activities = fetched["activities"] or []
 
         current_max_hr = 185
         rhr_input = readiness_data['rhr'] if readiness_data['rhr'] > 30 else 55
@@ -298,7 +405,12 @@ def get_processed_data(client, today, user_label="User"):
 
     # --- D. Biểu đồ mảng (Timeseries) có tích hợp Activity ---
     try:
-        readiness_data['timeseries_text'] = get_time_series_stress_bb(client, date_iso, today_activities, user_label)
+        if "all_day_stress" in fetched:
+            readiness_data['timeseries_text'] = get_time_series_stress_bb(
+                client, date_iso, today_activities, user_label, all_day_stress=fetched["all_day_stress"] or {}
+            )
+        else:
+            readiness_data['timeseries_text'] = "Lỗi lấy biểu đồ 24h."
     except Exception as e:
         print(f"[{user_label}] ⚠️ Lỗi lấy Timeseries: {e}")
 
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import base64
+import threading
+from garminconnect import Garmin, GarminConnectAuthenticationError
+from app.config import Config
+
+def is_auth_error(exc):
+    """
+    Lỗi do token Garmin bị từ chối (hết hạn / bị thu hồi): GarminConnectAuthenticationError hoặc HTTP 401.
+    """
+    if isinstance(exc, GarminConnectAuthenticationError):
+        return True
+    response = getattr(exc, "response", None)
+    if response is None:
+        response = getattr(getattr(exc, "error", None), "response", None)
+    return getattr(response, "status_code", None) == 401
+
+class GarminSessionPool:
+    """
+    Giữ các Garmin client đã đăng nhập theo email để tái sử dụng giữa các handler
+    (cùng HTTP session / connection pool), làm mới OAuth2 token trước khi hết hạn
+    và chỉ đăng nhập lại bằng password khi thật sự cần.
+    """
+    def __init__(self):
+        self._sessions = {}
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self.stats = {"logins": 0, "reuses": 0, "refreshes": 0}
+
+    def _lock_for(self, email):
+        with self._locks_guard:
+            if email not in self._locks:
+                self._locks[email] = threading.Lock()
+            return self._locks[email]
+
+    @staticmethod
+    def _token_dir(email):
+        return os.path.join(os.getcwd(), "tokens", email)
+
+    def get_client(self, email, password, name="User"):
+        """
+        Trả về Garmin client đã đăng nhập cho `email`, dùng lại session đang ấm nếu có.
+        """
+        with self._lock_for(email):
+            session = self._sessions.get(email)
+            if session and session["password"] == password:
+                if self._ensure_fresh(session["client"], email, name):
+                    self.stats["reuses"] += 1
+                    print(f"[{name}] ♻️ Dùng lại Garmin session đang mở.")
+                    return session["client"]
+                self._sessions.pop(email, None)
+
+            client = self._login(email, password, name)
+            self._sessions[email] = {"client": client, "password": password, "logged_in_at": time.time()}
+            self.stats["logins"] += 1
+            return client
+
+    def invalidate(self, email):
+        """
+        Bỏ session của `email` (ví dụ khi gặp lỗi 401) để lần sau đăng nhập lại.
+        """
+        with self._lock_for(email):
+            self._sessions.pop(email, None)
+
+    def reauthenticate(self, client, name="User"):
+        """
+        Token của `client` bị từ chối: bỏ session khỏi pool rồi đăng nhập lại 1 lần bằng password
+        ngay trên client đó (handler đang giữ client dùng tiếp được). Trả về True nếu thành công.
+        """
+        email = getattr(client, "username", None)
+        password = getattr(client, "password", None)
+        if not email or not password:
+            return False
+        self.invalidate(email)
+        with self._lock_for(email):
+            print(f"[{name}] 🔐 Token Garmin bị từ chối, đăng nhập lại bằng Password...")
+            try:
+                client.login()
+            except Exception as e:
+                print(f"[{name}] ❌ Đăng nhập lại Garmin thất bại: {e}")
+                return False
+            try:
+                client.garth.dump(self._token_dir(email))
+            except Exception as save_err:
+                print(f"[{name}] ⚠️ Lỗi lưu Token: {save_err}")
+            self._sessions[email] = {"client": client, "password": password, "logged_in_at": time.time()}
+            self.stats["logins"] += 1
+        return True
+
+    def _ensure_fresh(self, client, email, name):
+        """
+        Làm mới OAuth2 token nếu sắp hết hạn. Trả về False nếu session không còn dùng được.
+        """
+        garth = getattr(client, "garth", None)
+        token = getattr(garth, "oauth2_token", None)
+        expires_at = getattr(token, "expires_at", None)
+        if not isinstance(expires_at, (int, float)):
+            # Phiên bản garminconnect tự refresh token khi gọi request
+            return True
+
+        if expires_at - time.time() > Config.GARMIN_TOKEN_REFRESH_MARGIN:
+            return True
+
+        try:
+            garth.refresh_oauth2()
+            self.stats["refreshes"] += 1
+            print(f"[{name}] 🔁 Đã làm mới OAuth2 token Garmin.")
+            try:
+                garth.dump(self._token_dir(email))
+            except Exception as save_err:
+                print(f"[{name}] ⚠️ Lỗi lưu Token: {save_err}")
+            return True
+        except Exception as e:
+            print(f"[{name}] ⚠️ Không làm mới được OAuth2 token: {e}. Đăng nhập lại.")
+            return False
+
+    def _login(self, email, password, name):
+        """
+        Đăng nhập Garmin có check token cache để tránh 429 (Too Many Requests).
+        """
+        # Hỗ trợ lấy Token từ GitHub Secrets (môi trường CI/CD không lưu được file)
+        env_token_key = f"GARMINTOKENS_{email.replace('@', '_').replace('.', '_').upper()}"
+        token_string = os.getenv(env_token_key) or os.getenv("GARMINTOKENS")
+
+        token_dir = self._token_dir(email)
+        os.makedirs(token_dir, exist_ok=True)
+        client = Garmin(email, password)
+
+        try:
+            if token_string:
+                # Ghi token từ GitHub Secret ra file để garminconnect đọc
+                try:
+                    # Ghi tạm chuỗi base64 gốc vào env để thư viện garminconnect tự xử lý (cách mới)
+                    os.environ["GARMINTOKENS"] = token_string
+                    client.login(tokenstore=token_string)
+                    print(f"[{name}] ✅ Đăng nhập Garmin bằng Token từ GitHub Secrets thành công.")
+                except Exception as e1:
+                    print(f"[{name}] ⚠️ Lỗi đọc trực tiếp token_string, thử decode ra file... {e1}")
+                    # Cách cũ: decode và lưu thành file oauth1 và oauth2
+                    try:
+                        tokens = json.loads(base64.b64decode(token_string).decode('utf-8'))
+                        with open(os.path.join(token_dir, "oauth1_token.json"), "w") as f1:
+                            json.dump(tokens[0], f1)
+                        with open(os.path.join(token_dir, "oauth2_token.json"), "w") as f2:
+                            json.dump(tokens[1], f2)
+                        client.login(tokenstore=token_dir)
+                        print(f"[{name}] ✅ Đăng nhập Garmin bằng Token decode từ Secrets thành công.")
+                    except Exception as e2:
+                        print(f"[{name}] ⚠️ Lỗi decode token: {e2}. Chuyển sang password.")
+                        raise e2
+            else:
+                client.login(tokenstore=token_dir)
+                print(f"[{name}] ✅ Đăng nhập Garmin bằng Token bảo lưu thành công.")
+        except Exception as e:
+            print(f"[{name}] ℹ️ Không dùng được Token. Chuyển sang đăng nhập Password...")
+            client.login()
+            try:
+                os.makedirs(token_dir, exist_ok=True)
+                client.garth.dump(token_dir)
+                print(f"[{name}] ✅ Đăng nhập Garmin thành công & đã lưu Token mới.")
+            except Exception as save_err:
+                print(f"[{name}] ⚠️ Lỗi lưu Token: {save_err}")
+        return client
+
+# Khởi tạo Global Instance
+garmin_session_pool = GarminSessionPool()
@@ -0,0 +1,410 @@
+import os
+import time
+import signal
+import socket
+import asyncio
+import redis.asyncio as aioredis
+from redis.exceptions import ResponseError
+from app.config import Config
+
+# Chỉ thêm job nếu chưa có job cùng (user, mode) đang chờ: KEYS = [stream, pending_key]
+# ARGV = [maxlen, coalesce_ttl, field1, value1, ...]; trả về {1, id} (job mới) hoặc {0, id} (đã gộp)
+_ENQUEUE_SCRIPT = """
+if KEYS[2] ~= '' then
+    local existing = redis.call('GET', KEYS[2])
+    if existing then return {0, existing} end
+end
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', unpack(ARGV, 3))
+if KEYS[2] ~= '' then
+    redis.call('SET', KEYS[2], id, 'EX', ARGV[2])
+end
+return {1, id}
+"""
+
+# Xóa / gia hạn key chỉ khi giá trị còn là của mình (lock, pending key)
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+# Đưa job về cuối hàng (số lần giao tính lại từ đầu), chuyển pending key sang id mới:
+# KEYS = [stream, pending_key], ARGV = [group, old_id, maxlen, field1, value1, ...]
+_REQUEUE_SCRIPT = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[3], '*', unpack(ARGV, 4))
+redis.call('XACK', KEYS[1], ARGV[1], ARGV[2])
+if KEYS[2] ~= '' and redis.call('GET', KEYS[2]) == ARGV[2] then
+    redis.call('SET', KEYS[2], id, 'KEEPTTL')
+end
+return id
+"""
+_EXTEND_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('PEXPIRE', KEYS[1], ARGV[2]) end
+return 0
+"""
+
+def encode_job(mode, tele_id=None, question=None, enqueued_at=None):
+    """
+    Fields của 1 entry trong stream (Redis Streams chỉ lưu chuỗi; None → "").
+    """
+    return {
+        "mode": mode,
+        "tele_id": str(tele_id) if tele_id not in (None, "") else "",
+        "question": question or "",
+        "enqueued_at": f"{enqueued_at if enqueued_at is not None else time.time():.3f}",
+    }
+
+def decode_job(fields):
+    """
+    Ngược lại của `encode_job`: trả về (mode, tele_id, question) với "" → None.
+    """
+    return fields.get("mode", ""), fields.get("tele_id") or None, fields.get("question") or None
+
+def _entries(response):
+    """
+    Chuẩn hóa kết quả XREADGROUP (RESP2: [[stream, entries]], RESP3: {stream: [entries]}).
+    """
+    if not response:
+        return []
+    if isinstance(response, dict):
+        return [entry for entries in response.values() for entry in entries]
+    return [entry for _, entries in response for entry in entries]
+
+class JobQueue:
+    """
+    Hàng đợi job trên Redis Streams + consumer group. Producer (`enqueue`) thêm {mode, tele_id, question}
+    vào stream; nhiều process `JobWorker` (trên nhiều máy) cùng đọc qua 1 consumer group, mỗi job
+    chỉ giao cho 1 worker và chỉ bị xóa khỏi danh sách pending khi worker XACK.
+
+    - Gộp job theo user: job không có câu hỏi trùng (tele_id, mode) với job đang chờ thì không thêm nữa.
+    - Retry: job lỗi (hoặc worker chết giữa chừng) vẫn pending và được worker khác nhận lại (XAUTOCLAIM)
+      sau `retry_backoff` / `visibility_timeout` giây.
+    - Job đã giao quá `max_deliveries` lần được chuyển sang stream dead-letter.
+    """
+    def __init__(self, url=None, prefix=None, group=None, max_deliveries=None, visibility_timeout=None,
+                 retry_backoff=None, coalesce_ttl=None, maxlen=None, client=None):
+        self.url = url if url is not None else Config.JOB_QUEUE_URL
+        self.prefix = prefix if prefix is not None else Config.JOB_QUEUE_PREFIX
+        self.group = group if group is not None else Config.JOB_QUEUE_GROUP
+        self.max_deliveries = max_deliveries if max_deliveries is not None else Config.JOB_MAX_DELIVERIES
+        self.visibility_timeout = visibility_timeout if visibility_timeout is not None else Config.JOB_VISIBILITY_TIMEOUT
+        self.retry_backoff = retry_backoff if retry_backoff is not None else Config.JOB_RETRY_BACKOFF
+        self.coalesce_ttl = coalesce_ttl if coalesce_ttl is not None else Config.JOB_COALESCE_TTL
+        self.maxlen = maxlen if maxlen is not None else Config.JOB_QUEUE_MAXLEN
+        self.stream = f"{self.prefix}:stream"
+        self.dead_stream = f"{self.prefix}:dead"
+        self._client = client
+        self._group_ready = False
+
+    @property
+    def client(self):
+        if self._client is None:
+            if not self.url:
+                raise RuntimeError("JOB_QUEUE_URL / REDIS_URL chưa cấu hình, không dùng được hàng đợi job.")
+            # socket_timeout phải dài hơn thời gian BLOCK của XREADGROUP
+            self._client = aioredis.Redis.from_url(
+                self.url, decode_responses=True, socket_connect_timeout=5.0, socket_timeout=30.0
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._group_ready = False
+
+    def pending_key(self, tele_id, mode):
+        return f"{self.prefix}:pending:{tele_id or '*'}:{mode}"
+
+    def lock_key(self, tele_id):
+        return f"{self.prefix}:lock:{tele_id}"
+
+    async def ensure_group(self):
+        if self._group_ready:
+            return
+        try:
+            await self.client.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+
+    async def enqueue(self, mode, tele_id=None, question=None):
+        """
+        Thêm 1 job. Trả về (message_id, created): created=False nếu đã gộp vào job đang chờ.
+        Job có câu hỏi (/ask) không bao giờ bị gộp.
+        """
+        await self.ensure_group()
+        fields = encode_job(mode, tele_id, question)
+        pending_key = "" if question else self.pending_key(fields["tele_id"], mode)
+        args = [self.maxlen, self.coalesce_ttl]
+        for name, value in fields.items():
+            args.extend((name, value))
+        created, message_id = await self.client.eval(_ENQUEUE_SCRIPT, 2, self.stream, pending_key, *args)
+        return message_id, bool(int(created))
+
+    async def read(self, consumer, count, block_ms=1000):
+        """
+        Đọc tối đa `count` job mới cho `consumer` (chờ tối đa `block_ms`).
+        """
+        await self.ensure_group()
+        response = await self.client.xreadgroup(
+            self.group, consumer, {self.stream: ">"}, count=count, block=block_ms
+        )
+        return _entries(response)
+
+    async def reclaim(self, consumer, count):
+        """
+        Nhận lại các job pending quá `visibility_timeout` (worker chết hoặc job lỗi chờ retry).
+        Job đã bị xóa khỏi stream thì ack luôn.
+        """
+        await self.ensure_group()
+        response = await self.client.xautoclaim(
+            self.stream, self.group, consumer, int(self.visibility_timeout * 1000), start_id="0-0", count=count
+        )
+        entries = response[1] if len(response) > 1 else []
+        deleted = list(response[2]) if len(response) > 2 else []
+        live = []
+        for message_id, fields in entries:
+            if fields is None:
+                deleted.append(message_id)
+            else:
+                live.append((message_id, fields))
+        if deleted:
+            await self.client.xack(self.stream, self.group, *deleted)
+        return live
+
+    async def deliveries(self, message_id):
+        rows = await self.client.xpending_range(self.stream, self.group, message_id, message_id, 1)
+        return int(rows[0]["times_delivered"]) if rows else 1
+
+    async def touch(self, consumer, message_id, idle_ms=0):
+        """
+        Đặt lại thời gian idle của job đang giữ (heartbeat). JUSTID nên không tăng số lần giao.
+        """
+        await self.client.xclaim(
+            self.stream, self.group, consumer, 0, [message_id], idle=int(idle_ms), justid=True
+        )
+
+    async def ack(self, message_id):
+        await self.client.xack(self.stream, self.group, message_id)
+
+    async def retry_later(self, consumer, message_id):
+        """
+        Giữ job ở trạng thái pending nhưng "già" sẵn để XAUTOCLAIM nhận lại sau `retry_backoff` giây.
+        """
+        idle_ms = max(self.visibility_timeout - self.retry_backoff, 0) * 1000
+        await self.touch(consumer, message_id, idle_ms)
+
+    async def requeue(self, message_id, fields):
+        """
+        Ack job hiện tại và thêm lại bản sao vào cuối stream (không tính là 1 lần lỗi).
+        """
+        pending_key = "" if fields.get("question") else self.pending_key(fields.get("tele_id"), fields.get("mode"))
+        args = [self.group, message_id, self.maxlen]
+        for name, value in fields.items():
+            args.extend((name, value))
+        return await self.client.eval(_REQUEUE_SCRIPT, 2, self.stream, pending_key, *args)
+
+    async def dead_letter(self, message_id, fields, deliveries, error):
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.xadd(self.dead_stream, dict(fields, source_id=message_id, deliveries=str(deliveries), error=str(error)[:1000]),
+                      maxlen=self.maxlen, approximate=True)
+            pipe.xack(self.stream, self.group, message_id)
+            await pipe.execute()
+
+    async def release_pending(self, fields, message_id):
+        """
+        Job đã bắt đầu chạy: yêu cầu mới cho cùng (user, mode) từ giờ được xếp hàng thay vì gộp.
+        """
+        if fields.get("question"):
+            return
+        await self.client.eval(_RELEASE_SCRIPT, 1, self.pending_key(fields.get("tele_id"), fields.get("mode")), message_id)
+
+    async def acquire_lock(self, tele_id, token, ttl_ms):
+        return bool(await self.client.set(self.lock_key(tele_id), token, nx=True, px=int(ttl_ms)))
+
+    async def extend_lock(self, tele_id, token, ttl_ms):
+        return bool(await self.client.eval(_EXTEND_SCRIPT, 1, self.lock_key(tele_id), token, int(ttl_ms)))
+
+    async def release_lock(self, tele_id, token):
+        await self.client.eval(_RELEASE_SCRIPT, 1, self.lock_key(tele_id), token)
+
+    async def info(self):
+        """
+        Độ dài stream, số job đang pending và số job trong dead-letter (để log/theo dõi).
+        """
+        await self.ensure_group()
+        pending = await self.client.xpending(self.stream, self.group)
+        return {
+            "length": await self.client.xlen(self.stream),
+            "pending": int(pending.get("pending", 0)) if isinstance(pending, dict) else int(pending[0]),
+            "dead": await self.client.xlen(self.dead_stream),
+        }
+
+class JobWorker:
+    """
+    1 consumer của `JobQueue`: chạy tối đa `concurrency` job cùng lúc bằng `dispatch(mode, tele_id, question)`.
+    Chạy nhiều process (mỗi process 1 consumer) để mở rộng theo số core / số máy.
+
+    Job của cùng 1 user chạy tuần tự giữa mọi worker nhờ lock Redis `{prefix}:lock:{tele_id}`; job đang chạy
+    được gia hạn lock và reset idle định kỳ nên không bị worker khác nhận lại dù chạy lâu.
+    """
+    def __init__(self, queue, dispatch, consumer=None, concurrency=None, block_ms=1000, lock_wait=None):
+        self.queue = queue
+        self.dispatch = dispatch
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.concurrency = max(1, concurrency if concurrency is not None else Config.JOB_WORKER_CONCURRENCY)
+        self.block_ms = block_ms
+        self.lock_wait = lock_wait if lock_wait is not None else Config.JOB_LOCK_WAIT
+        self._stop = asyncio.Event()
+        self._tasks = set()
+        self._next_reclaim = 0.0
+        self.stats = {"completed": 0, "retried": 0, "dead": 0, "reclaimed": 0, "deferred": 0}
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def _heartbeat_interval(self):
+        return max(self.queue.visibility_timeout / 3, 0.05)
+
+    async def _heartbeat(self, message_id, tele_id, token):
+        lock_ttl = self.queue.visibility_timeout * 1000
+        while True:
+            await asyncio.sleep(self._heartbeat_interval)
+            try:
+                await self.queue.touch(self.consumer, message_id)
+                if tele_id:
+                    await self.queue.extend_lock(tele_id, token, lock_ttl)
+            except Exception as e:
+                print(f"⚠️ JobWorker: Lỗi gia hạn job {message_id}: {e}")
+
+    async def _wait_for_user(self, tele_id, token):
+        """
+        Chờ lock của user (job trước của user này đang chạy ở worker khác). False nếu hết `lock_wait`.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.lock_wait
+        lock_ttl = self.queue.visibility_timeout * 1000
+        delay = 0.05
+        while not await self.queue.acquire_lock(tele_id, token, lock_ttl):
+            if loop.time() >= deadline or self._stop.is_set():
+                return False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+        return True
+
+    async def process(self, message_id, fields):
+        mode, tele_id, question = decode_job(fields)
+        label = f"job {message_id} {mode}" + (f" user={tele_id}" if tele_id else "")
+        deliveries = await self.queue.deliveries(message_id)
+        if deliveries > self.queue.max_deliveries:
+            await self.queue.dead_letter(message_id, fields, deliveries, "vượt số lần giao tối đa")
+            self.stats["dead"] += 1
+            print(f"☠️ Chuyển {label} sang dead-letter sau {deliveries - 1} lần giao.")
+            return
+
+        token = f"{self.consumer}:{message_id}"
+        if tele_id and not await self._wait_for_user(tele_id, token):
+            # Đưa job về cuối hàng, worker nào rảnh sẽ nhận lại (không tính là 1 lần lỗi)
+            await self.queue.requeue(message_id, fields)
+            self.stats["deferred"] += 1
+            print(f"⏸️ {label}: user đang có job khác chạy, hoãn lại.")
+            return
+
+        heartbeat = asyncio.create_task(self._heartbeat(message_id, tele_id, token))
+        started = time.monotonic()
+        try:
+            await self.queue.release_pending(fields, message_id)
+            print(f"▶️ Bắt đầu {label} (lần {deliveries})")
+            await self.dispatch(mode, tele_id, question)
+        except Exception as e:
+            if deliveries >= self.queue.max_deliveries:
+                await self.queue.dead_letter(message_id, fields, deliveries, e)
+                self.stats["dead"] += 1
+                print(f"☠️ {label} lỗi lần {deliveries}, chuyển sang dead-letter: {e}")
+            else:
+                await self.queue.retry_later(self.consumer, message_id)
+                self.stats["retried"] += 1
+                print(f"🔁 {label} lỗi lần {deliveries}, thử lại sau {self.queue.retry_backoff:.0f}s: {e}")
+        else:
+            await self.queue.ack(message_id)
+            self.stats["completed"] += 1
+            print(f"✅ Xong {label} sau {time.monotonic() - started:.1f}s")
+        finally:
+            heartbeat.cancel()
+            if tele_id:
+                try:
+                    await self.queue.release_lock(tele_id, token)
+                except Exception as e:
+                    print(f"⚠️ JobWorker: Lỗi nhả lock user {tele_id}: {e}")
+
+    def _spawn(self, message_id, fields):
+        task = asyncio.create_task(self._guarded(message_id, fields))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _guarded(self, message_id, fields):
+        try:
+            await self.process(message_id, fields)
+        except Exception as e:
+            # Lỗi Redis giữa chừng: job vẫn pending, sẽ được nhận lại sau visibility_timeout
+            print(f"⚠️ JobWorker: Lỗi xử lý job {message_id}: {e}")
+
+    async def run_once(self):
+        """
+        1 vòng: nhận lại job quá hạn (định kỳ) rồi đọc job mới cho các slot còn trống.
+        Trả về số job đã nhận.
+        """
+        free = self.concurrency - len(self._tasks)
+        if free <= 0:
+            await asyncio.wait(list(self._tasks), timeout=self.block_ms / 1000, return_when=asyncio.FIRST_COMPLETED)
+            return 0
+
+        entries = []
+        now = time.monotonic()
+        if now >= self._next_reclaim:
+            self._next_reclaim = now + min(self.queue.retry_backoff, self.queue.visibility_timeout) / 2
+            entries = await self.queue.reclaim(self.consumer, free)
+            self.stats["reclaimed"] += len(entries)
+        if not entries:
+            entries = await self.queue.read(self.consumer, free, self.block_ms)
+        for message_id, fields in entries:
+            self._spawn(message_id, fields)
+        return len(entries)
+
+    async def drain(self, timeout=None):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+    async def run(self, drain_timeout=None):
+        """
+        Chạy tới khi `stop()` được gọi; job chưa xong khi hết `drain_timeout` vẫn pending
+        và được worker khác nhận lại.
+        """
+        await self.queue.ensure_group()
+        print(f"👷 Worker {self.consumer} đang nghe {self.queue.stream} (group {self.queue.group}, {self.concurrency} slot)")
+        while not self._stop.is_set():
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"⚠️ JobWorker: Lỗi đọc hàng đợi: {e}")
+                await asyncio.sleep(1.0)
+        await self.drain(drain_timeout)
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def serve_forever(self, drain_timeout=None):
+        """
+        Chạy tới khi nhận SIGINT/SIGTERM rồi dừng nhận job và chờ job đang chạy.
+        """
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+        await self.run(drain_timeout if drain_timeout is not None else Config.SERVE_DRAIN_TIMEOUT)
+        print(f"🛑 Worker {self.consumer} đã dừng: {self.stats}")
+
+# Khởi tạo Global Instance
+job_queue = JobQueue()
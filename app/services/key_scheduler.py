@@ -0,0 +1,221 @@
+import re
+import time
+import asyncio
+import threading
+from app.config import Config
+
+def is_quota_error(error_msg):
+    lowered = error_msg.lower()
+    return "429" in error_msg or "RESOURCE_EXHAUSTED" in error_msg or "quota" in lowered
+
+def parse_retry_delay(error_msg):
+    """
+    Đọc thời gian chờ gợi ý trong lỗi 429 của Gemini ("retryDelay': '23s'" / "retry in 23.5s").
+    """
+    match = re.search(r"retry(?:Delay)?['\"]?\s*[:=]?\s*['\"]?(?:in\s+)?(\d+(?:\.\d+)?)\s*s", error_msg, re.IGNORECASE)
+    return float(match.group(1)) if match else None
+
+class KeyState:
+    """
+    Trạng thái của một API key: token bucket (số request/phút), cooldown khi hết quota,
+    latency trung bình trượt (EWMA) của các lần thành công và tỉ lệ thành công (EWMA).
+    """
+    def __init__(self, key, rate_per_minute, now):
+        self.key = key
+        self.capacity = max(1.0, float(rate_per_minute))
+        self.tokens = self.capacity
+        self.refill_per_second = self.capacity / 60.0
+        self.last_refill = now
+        self.cooldown_until = 0.0
+        self.latency_ewma = None
+        self.health = 1.0
+        self.in_flight = 0
+        self.consecutive_quota_errors = 0
+        self.consecutive_failures = 0
+        self.stats = {"success": 0, "quota": 0, "error": 0}
+
+    def refill(self, now):
+        elapsed = max(0.0, now - self.last_refill)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_per_second)
+        self.last_refill = now
+
+    def ready_in(self, now):
+        """
+        Số giây tới khi key dùng được (0 nếu dùng được ngay).
+        """
+        wait = max(0.0, self.cooldown_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.refill_per_second)
+        return wait
+
+    def score(self):
+        """
+        Điểm càng thấp càng tốt: latency kỳ vọng / sức khỏe, phạt thêm theo số request đang chạy.
+        """
+        latency = self.latency_ewma if self.latency_ewma is not None else Config.GEMINI_KEY_DEFAULT_LATENCY
+        return latency / max(self.health, 0.05) * (1 + self.in_flight)
+
+class GeminiKeyManager:
+    """
+    Bộ lập lịch API Key Gemini (dùng cho TTS): luôn chọn key khỏe nhất còn quota,
+    tạm nghỉ key bị 429 / RESOURCE_EXHAUSTED theo cooldown (tăng dần), giới hạn tốc độ
+    từng key bằng token bucket. Có cả API async (aexecute) và đồng bộ (execute_with_retry).
+    """
+    def __init__(self, keys=None, rate_per_minute=None):
+        self.keys = []
+        self._load_keys(keys)
+        self.rate_per_minute = rate_per_minute or Config.GEMINI_KEY_RPM
+        self._lock = threading.Lock()
+        now = time.monotonic()
+        self._states = [KeyState(k, self.rate_per_minute, now) for k in self.keys]
+
+    def _load_keys(self, keys=None):
+        self.keys = list(keys) if keys is not None else list(Config.GEMINI_API_KEYS)
+        if keys is None:
+            print(f"Loaded {len(self.keys)} Gemini Keys from Config.")
+
+    def get_key_count(self):
+        return len(self.keys)
+
+    def _try_acquire(self):
+        """
+        Chọn key tốt nhất đang sẵn sàng và trừ 1 token. Trả về (state, 0) hoặc (None, số giây cần chờ).
+        """
+        now = time.monotonic()
+        with self._lock:
+            best = None
+            wait = None
+            for state in self._states:
+                state.refill(now)
+                ready_in = state.ready_in(now)
+                if ready_in > 0:
+                    wait = ready_in if wait is None else min(wait, ready_in)
+                    continue
+                if best is None or state.score() < best.score():
+                    best = state
+            if best is None:
+                return None, wait or 0.1
+            best.tokens -= 1
+            best.in_flight += 1
+            return best, 0
+
+    def _record_success(self, state, latency):
+        alpha = Config.GEMINI_KEY_EWMA_ALPHA
+        with self._lock:
+            state.in_flight -= 1
+            state.latency_ewma = latency if state.latency_ewma is None else (1 - alpha) * state.latency_ewma + alpha * latency
+            state.health = (1 - alpha) * state.health + alpha
+            state.consecutive_quota_errors = 0
+            state.consecutive_failures = 0
+            state.stats["success"] += 1
+
+    def _record_failure(self, state, error_msg):
+        alpha = Config.GEMINI_KEY_EWMA_ALPHA
+        now = time.monotonic()
+        with self._lock:
+            state.in_flight -= 1
+            state.health = (1 - alpha) * state.health
+            state.consecutive_failures += 1
+            if is_quota_error(error_msg):
+                state.stats["quota"] += 1
+                state.consecutive_quota_errors += 1
+                suggested = parse_retry_delay(error_msg)
+                backoff = Config.GEMINI_KEY_COOLDOWN * (2 ** (state.consecutive_quota_errors - 1))
+                cooldown = min(max(suggested or 0, backoff), Config.GEMINI_KEY_MAX_COOLDOWN)
+                state.tokens = 0
+            else:
+                state.stats["error"] += 1
+                cooldown = min(2.0 * state.consecutive_failures, Config.GEMINI_KEY_MAX_COOLDOWN)
+            state.cooldown_until = max(state.cooldown_until, now + cooldown)
+            return cooldown
+
+    def _max_attempts(self):
+        return self.get_key_count() * 2
+
+    def _log_failure(self, verbose_label, state, error_msg, cooldown):
+        print(f"[{verbose_label}] Error (Key ...{state.key[-5:] if state.key else 'None'}): {error_msg} → nghỉ key {cooldown:.0f}s")
+
+    async def aexecute(self, worker_func, default_return=None, verbose_label="Service"):
+        """
+        Chạy `worker_func(api_key)` (hàm đồng bộ chạy trong thread, hoặc coroutine function)
+        trên key khỏe nhất; lỗi thì thử key khác. Chờ bằng asyncio.sleep, không chặn event loop.
+        """
+        max_attempts = self._max_attempts()
+        if max_attempts == 0:
+            print(f"[{verbose_label}] Warning: No API Keys available to execute.")
+            return default_return
+
+        for attempt in range(max_attempts):
+            state, wait = self._try_acquire()
+            while state is None:
+                if wait > Config.GEMINI_KEY_MAX_WAIT:
+                    print(f"[{verbose_label}] ⏳ Tất cả key đang nghỉ (còn {wait:.0f}s), bỏ qua.")
+                    return default_return
+                await asyncio.sleep(wait)
+                state, wait = self._try_acquire()
+
+            started = time.monotonic()
+            try:
+                if asyncio.iscoroutinefunction(worker_func):
+                    result = await worker_func(state.key)
+                else:
+                    result = await asyncio.to_thread(worker_func, state.key)
+                self._record_success(state, time.monotonic() - started)
+                return result
+            except Exception as e:
+                error_msg = str(e)
+                cooldown = self._record_failure(state, error_msg)
+                self._log_failure(verbose_label, state, error_msg, cooldown)
+
+        return default_return
+
+    def execute_with_retry(self, worker_func, default_return=None, verbose_label="Service"):
+        """
+        Phiên bản đồng bộ của `aexecute` cho code chạy trong thread.
+        """
+        max_attempts = self._max_attempts()
+        if max_attempts == 0:
+            print(f"[{verbose_label}] Warning: No API Keys available to execute.")
+            return default_return
+
+        for attempt in range(max_attempts):
+            state, wait = self._try_acquire()
+            while state is None:
+                if wait > Config.GEMINI_KEY_MAX_WAIT:
+                    print(f"[{verbose_label}] ⏳ Tất cả key đang nghỉ (còn {wait:.0f}s), bỏ qua.")
+                    return default_return
+                time.sleep(wait)
+                state, wait = self._try_acquire()
+
+            started = time.monotonic()
+            try:
+                result = worker_func(state.key)
+                self._record_success(state, time.monotonic() - started)
+                return result
+            except Exception as e:
+                error_msg = str(e)
+                cooldown = self._record_failure(state, error_msg)
+                self._log_failure(verbose_label, state, error_msg, cooldown)
+
+        return default_return
+
+    def snapshot(self):
+        """
+        Trạng thái từng key (để log/debug), key được che bớt.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "key": f"...{s.key[-5:]}",
+                    "health": round(s.health, 3),
+                    "latency_ewma": round(s.latency_ewma, 3) if s.latency_ewma is not None else None,
+                    "cooldown": round(max(0.0, s.cooldown_until - now), 1),
+                    "tokens": round(s.tokens, 2),
+                    **s.stats,
+                }
+                for s in self._states
+            ]
+
+# Khởi tạo Global Instance
+gemini_key_manager = GeminiKeyManager()
@@ -0,0 +1,192 @@
+import time
+import asyncio
+import threading
+import importlib.util
+import httpx
+from openai import OpenAI, AsyncOpenAI
+from app.config import Config
+
+# HTTP/2 chỉ bật khi có gói `h2` (httpx[http2]), nếu không httpx sẽ báo lỗi khi khởi tạo
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Biên trên (giây) của các bucket histogram latency
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 40, 80, float("inf"))
+
+class LatencyHistogram:
+    """
+    Histogram latency theo model (đếm theo bucket cố định + tổng thời gian, số lỗi).
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def record(self, model, seconds, ok=True):
+        with self._lock:
+            stats = self._models.setdefault(model, {"count": 0, "errors": 0, "total": 0.0, "max": 0.0, "counts": [0] * len(self.buckets)})
+            stats["count"] += 1
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            if not ok:
+                stats["errors"] += 1
+            for i, upper in enumerate(self.buckets):
+                if seconds <= upper:
+                    stats["counts"][i] += 1
+                    break
+
+    def percentile(self, model, q):
+        """
+        Ước lượng percentile `q` (0-1) bằng biên trên của bucket chứa nó.
+        """
+        with self._lock:
+            stats = self._models.get(model)
+            if not stats or stats["count"] == 0:
+                return None
+            target = q * stats["count"]
+            running = 0
+            for upper, count in zip(self.buckets, stats["counts"]):
+                running += count
+                if running >= target:
+                    return min(upper, stats["max"])
+            return stats["max"]
+
+    def snapshot(self):
+        with self._lock:
+            return {model: dict(stats, counts=list(stats["counts"])) for model, stats in self._models.items()}
+
+    def report(self):
+        lines = []
+        for model, stats in sorted(self.snapshot().items()):
+            avg = stats["total"] / stats["count"]
+            lines.append(
+                f"  {model}: {stats['count']} lượt, TB {avg:.2f}s, p50≤{self.percentile(model, 0.5):.2f}s, "
+                f"p95≤{self.percentile(model, 0.95):.2f}s, max {stats['max']:.2f}s, lỗi {stats['errors']}"
+            )
+        return "\n".join(lines)
+
+class LLMClientRegistry:
+    """
+    Giữ OpenAI / AsyncOpenAI client dùng chung (keep-alive, connection pool, HTTP/2 nếu có)
+    thay vì tạo client mới (và TLS handshake mới) cho mỗi lần gọi.
+    Client đồng bộ dùng chung giữa các thread; client async gắn với event loop đang chạy.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sync_clients = {}
+        self._async_clients = {}
+        self.latency = LatencyHistogram()
+
+    @staticmethod
+    def _timeout():
+        return httpx.Timeout(Config.LLM_TIMEOUT, connect=Config.LLM_CONNECT_TIMEOUT)
+
+    @staticmethod
+    def _limits():
+        return httpx.Limits(
+            max_connections=Config.LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=Config.LLM_MAX_CONNECTIONS,
+            keepalive_expiry=Config.LLM_KEEPALIVE_EXPIRY
+        )
+
+    def get_sync(self, api_key):
+        with self._lock:
+            client = self._sync_clients.get(api_key)
+            if client is None:
+                http_client = httpx.Client(http2=HTTP2_AVAILABLE, timeout=self._timeout(), limits=self._limits())
+                client = OpenAI(
+                    base_url=Config.LLM_BASE_URL,
+                    api_key=api_key,
+                    timeout=self._timeout(),
+                    max_retries=Config.LLM_MAX_RETRIES,
+                    http_client=http_client
+                )
+                self._sync_clients[api_key] = client
+            return client
+
+    def get_async(self, api_key):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            # Dọn client của các event loop đã đóng (mỗi asyncio.run tạo loop mới)
+            for key in [k for k in self._async_clients if k[1].is_closed()]:
+                self._async_clients.pop(key, None)
+
+            client = self._async_clients.get((api_key, loop))
+            if client is None:
+                http_client = httpx.AsyncClient(http2=HTTP2_AVAILABLE, timeout=self._timeout(), limits=self._limits())
+                client = AsyncOpenAI(
+                    base_url=Config.LLM_BASE_URL,
+                    api_key=api_key,
+                    timeout=self._timeout(),
+                    max_retries=Config.LLM_MAX_RETRIES,
+                    http_client=http_client
+                )
+                self._async_clients[(api_key, loop)] = client
+            return client
+
+    def chat_completion(self, api_key, model_name, messages, **kwargs):
+        started = time.perf_counter()
+        ok = False
+        try:
+            response = self.get_sync(api_key).chat.completions.create(model=model_name, messages=messages, **kwargs)
+            ok = True
+            return response
+        finally:
+            self.latency.record(model_name, time.perf_counter() - started, ok)
+
+    def stream_chat_completion(self, api_key, model_name, messages, **kwargs):
+        """
+        Gọi chat completion với stream=True, yield từng đoạn text (delta) ngay khi nhận được.
+        Latency ghi nhận là tổng thời gian tới khi stream kết thúc.
+        """
+        started = time.perf_counter()
+        ok = False
+        try:
+            stream = self.get_sync(api_key).chat.completions.create(model=model_name, messages=messages, stream=True, **kwargs)
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                text = getattr(delta, "content", None) if delta is not None else None
+                if text:
+                    yield text
+            ok = True
+        finally:
+            self.latency.record(model_name, time.perf_counter() - started, ok)
+
+    async def achat_completion(self, api_key, model_name, messages, **kwargs):
+        started = time.perf_counter()
+        ok = False
+        try:
+            response = await self.get_async(api_key).chat.completions.create(model=model_name, messages=messages, **kwargs)
+            ok = True
+            return response
+        finally:
+            self.latency.record(model_name, time.perf_counter() - started, ok)
+
+    async def aclose(self):
+        """
+        Đóng toàn bộ client (gọi khi kết thúc chương trình).
+        """
+        with self._lock:
+            sync_clients = list(self._sync_clients.values())
+            async_clients = list(self._async_clients.items())
+            self._sync_clients.clear()
+            self._async_clients.clear()
+
+        for client in sync_clients:
+            try:
+                client.close()
+            except Exception as e:
+                print(f"⚠️ LLM client: Lỗi đóng client: {e}")
+
+        loop = asyncio.get_running_loop()
+        for (_, client_loop), client in async_clients:
+            if client_loop is not loop:
+                continue
+            try:
+                await client.close()
+            except Exception as e:
+                print(f"⚠️ LLM client: Lỗi đóng client async: {e}")
+
+# Khởi tạo Global Instance
+llm_clients = LLMClientRegistry()
@@ -1,93 +1,354 @@
 import os
+import json
+import time
+import asyncio
+import contextlib
+from datetime import datetime
 import httpx
 from dotenv import load_dotenv
 
 from app.config import Config
 
-def get_users_from_notion():
-    """
-    Kết nối Notion, lấy danh sách user có trạng thái Active = True.
-    Trả về list các dict user.
-    """
-    token = Config.NOTION_TOKEN
-    database_id = Config.NOTION_DATABASE_ID
-
-    if not token or not database_id:
-        print("❌ Lỗi: Thiếu cấu hình NOTION_TOKEN hoặc NOTION_DATABASE_ID.")
-        return []
+NOTION_API = "https://api.notion.com/v1"
+NOTION_PAGE_SIZE = 100
+# Notion làm tròn last_edited_time theo phút: sửa thêm trong cùng phút không đổi version,
+# nên chỉ tin version khi roster được tải sau khi phút đó kết thúc (cộng biên lệch đồng hồ)
+VERSION_SETTLE_SECONDS = 120
 
-    url = f"https://api.notion.com/v1/databases/{database_id}/query"
-    headers = {
+def _notion_headers(token):
+    return {
         "Authorization": f"Bearer {token}",
         "Notion-Version": "2022-06-28",
         "Content-Type": "application/json"
     }
-    
-    # Filter: Chỉ lấy user có Active = true
-    payload = {
-        "filter": {
-            "property": "Active",
-            "checkbox": {
-                "equals": True
-            }
-        }
+
+def query_pages(database_id, payload=None):
+    """
+    Các bước của `databases/query` có phân trang qua `next_cursor` (Notion trả tối đa 100 dòng/trang),
+    viết dạng generator không gắn với HTTP client: yield (url, body), nhận lại response.
+    Trả về list page, hoặc None nếu API lỗi. Chạy bằng `run_notion_sync` / `run_notion_async`.
+    """
+    url = f"{NOTION_API}/databases/{database_id}/query"
+    body = dict(payload or {}, page_size=NOTION_PAGE_SIZE)
+    results = []
+    while True:
+        response = yield url, dict(body)
+        if response.status_code != 200:
+            print(f"❌ Lỗi API Notion: {response.status_code} - {response.text}")
+            return None
+        data = response.json()
+        results.extend(data.get("results", []))
+        if not data.get("has_more") or not data.get("next_cursor"):
+            return results
+        body["start_cursor"] = data["next_cursor"]
+
+class BlockingCall:
+    """
+    Bước I/O chặn (file local, Redis đồng bộ) trong generator các bước Notion: `result = yield BlockingCall(f, *args)`.
+    Driver sync gọi thẳng, driver async chạy trong thread để không chặn event loop.
+    """
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+def run_notion_sync(steps, token, timeout=10.0):
+    """
+    Chạy generator các bước Notion bằng httpx.Client (đồng bộ, chỉ mở khi có request thật).
+    Lỗi được ném lại vào generator.
+    """
+    headers = _notion_headers(token)
+    with contextlib.ExitStack() as stack:
+        client = None
+        value, error = None, None
+        while True:
+            try:
+                step = steps.throw(error) if error is not None else steps.send(value)
+            except StopIteration as done:
+                return done.value
+            value, error = None, None
+            try:
+                if isinstance(step, BlockingCall):
+                    value = step.func(*step.args)
+                else:
+                    if client is None:
+                        client = stack.enter_context(httpx.Client(timeout=timeout))
+                    value = client.post(step[0], headers=headers, json=step[1])
+            except Exception as e:
+                error = e
+
+async def run_notion_async(steps, token, client, timeout=10.0):
+    """
+    Như `run_notion_sync` nhưng dùng httpx.AsyncClient dùng chung; BlockingCall chạy qua
+    asyncio.to_thread (không chặn event loop).
+    """
+    headers = _notion_headers(token)
+    value, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error is not None else steps.send(value)
+        except StopIteration as done:
+            return done.value
+        value, error = None, None
+        try:
+            if isinstance(step, BlockingCall):
+                value = await asyncio.to_thread(step.func, *step.args)
+            else:
+                value = await client.post(step[0], headers=headers, json=step[1], timeout=timeout)
+        except Exception as e:
+            error = e
+
+def parse_user(page):
+    """
+    Chuyển 1 page Notion thành dict user (None nếu thiếu email/password).
+    """
+    props = page.get("properties", {})
+
+    # Hàm helper lấy text an toàn
+    def get_text(key, type_key="rich_text"):
+        if key not in props: return ""
+        try:
+            obj = props[key]
+            if type_key == "title":
+                return obj["title"][0]["plain_text"] if obj.get("title") else ""
+            elif type_key == "rich_text":
+                return obj["rich_text"][0]["plain_text"] if obj.get("rich_text") else ""
+            elif type_key == "email":
+                return obj.get("email", "")
+            elif type_key == "number": # Phòng hờ Chat ID để dạng số
+                return str(obj.get("number", ""))
+        except:
+            return ""
+
+    # Mapping dữ liệu từ các cột Notion của bạn
+    user = {
+        "name": get_text("Name", "title"),
+        "email": get_text("Email", "email"),
+        "password": get_text("Password", "rich_text"), # Cột Password của bạn là Text
+        "telegram_chat_id": get_text("Telegram Chat ID", "rich_text"), # Cột Chat ID là Text
+
+        # Các trường bổ sung cho AI
+        "goal": get_text("Training Goal", "rich_text"),
+        "note": get_text("Ghi chú", "rich_text"),
+
+        # Xử lý cột chấn thương (Ưu tiên tên chính xác, fallback tên ngắn)
+        "injury": get_text("Chấn thương & Bệnh tật", "rich_text") or get_text("Chấn thương", "rich_text") or "Không có"
     }
 
-    print("Loading users from Notion...")
-    
+    # Chỉ thêm user nếu có đủ email/pass
+    if user["email"] and user["password"]:
+        return user
+    return None
+
+def _edited_at(version):
+    """
+    Epoch (giây) của `last_edited_time` trong version; không đọc được thì coi như chưa ổn định.
+    """
     try:
-        with httpx.Client(timeout=10.0) as client:
-            response = client.post(url, headers=headers, json=payload)
-            
-            if response.status_code != 200:
-                print(f"❌ Lỗi API Notion: {response.status_code} - {response.text}")
-                return []
-
-            data = response.json()
-            results = data.get("results", [])
-            users = []
-
-            for page in results:
-                props = page.get("properties", {})
-                
-                # Hàm helper lấy text an toàn
-                def get_text(key, type_key="rich_text"):
-                    if key not in props: return ""
-                    try:
-                        obj = props[key]
-                        if type_key == "title":
-                            return obj["title"][0]["plain_text"] if obj.get("title") else ""
-                        elif type_key == "rich_text":
-                            return obj["rich_text"][0]["plain_text"] if obj.get("rich_text") else ""
-                        elif type_key == "email":
-                            return obj.get("email", "")
-                        elif type_key == "number": # Phòng hờ Chat ID để dạng số
-                            return str(obj.get("number", ""))
-                    except:
-                        return ""
-
-                # Mapping dữ liệu từ các cột Notion của bạn
-                user = {
-                    "name": get_text("Name", "title"),
-                    "email": get_text("Email", "email"),
-                    "password": get_text("Password", "rich_text"), # Cột Password của bạn là Text
-                    "telegram_chat_id": get_text("Telegram Chat ID", "rich_text"), # Cột Chat ID là Text
-                    
-                    # Các trường bổ sung cho AI
-                    "goal": get_text("Training Goal", "rich_text"),
-                    "note": get_text("Ghi chú", "rich_text"),
-                    
-                    # Xử lý cột chấn thương (Ưu tiên tên chính xác, fallback tên ngắn)
-                    "injury": get_text("Chấn thương & Bệnh tật", "rich_text") or get_text("Chấn thương", "rich_text") or "Không có"
+        return datetime.fromisoformat(version.split("|")[0].replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        return float("inf")
+
+class UserDirectory:
+    """
+    Danh bạ user từ Notion: tải đủ mọi trang, cache roster đã parse trong bộ nhớ (file local 0600
+    chỉ khi đặt NOTION_USERS_CACHE_PATH) kèm version = `last_edited_time` + id của dòng sửa gần nhất,
+    và index theo Telegram Chat ID / email.
+
+    - Snapshot mới hơn NOTION_USERS_TRUST_TTL giây: dùng luôn, không gọi Notion.
+    - Cũ hơn: gửi 1 query nhỏ (page_size=1, sort theo last_edited_time) để lấy version;
+      version không đổi và roster được tải sau phút của version (VERSION_SETTLE_SECONDS) thì giữ roster,
+      ngược lại tải lại toàn bộ. Xóa dòng sửa gần nhất làm đổi id nên cũng được phát hiện.
+    - Snapshot cũ hơn NOTION_USERS_MAX_AGE giây luôn được tải lại (bắt cả trường hợp xóa dòng cũ hơn).
+    - Notion lỗi: dùng snapshot cũ nếu có.
+    - Roster chứa mật khẩu Garmin nên không đẩy lên Redis (có thể là Redis dùng chung / hosted).
+    """
+    def __init__(self, cache_path=None, trust_ttl=None, max_age=None):
+        self.cache_path = cache_path if cache_path is not None else Config.NOTION_USERS_CACHE_PATH
+        self.trust_ttl = trust_ttl if trust_ttl is not None else Config.NOTION_USERS_TRUST_TTL
+        self.max_age = max_age if max_age is not None else Config.NOTION_USERS_MAX_AGE
+        self._snapshot = None
+        self._by_chat_id = {}
+        self._by_email = {}
+        self.stats = {"memory": 0, "probe_hits": 0, "full_loads": 0, "stale": 0}
+
+    def _use(self, snapshot):
+        self._snapshot = snapshot
+        users = snapshot["users"]
+        self._by_chat_id = {str(u["telegram_chat_id"]): u for u in users if u.get("telegram_chat_id")}
+        self._by_email = {u["email"].strip().lower(): u for u in users if u.get("email")}
+        return users
+
+    def _load_cached(self):
+        """
+        Snapshot mới nhất trong bộ nhớ / file local.
+        """
+        candidates = [self._snapshot]
+        if self.cache_path:
+            try:
+                with open(self.cache_path, "r", encoding="utf-8") as f:
+                    candidates.append(json.load(f))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"⚠️ UserDirectory: Lỗi đọc cache local: {e}")
+
+        valid = [c for c in candidates if isinstance(c, dict) and isinstance(c.get("users"), list) and "fetched_at" in c]
+        return max(valid, key=lambda c: c["fetched_at"]) if valid else None
+
+    def _save(self, snapshot):
+        if self.cache_path:
+            try:
+                os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+                tmp_path = f"{self.cache_path}.tmp"
+                # Roster có mật khẩu Garmin: chỉ chủ sở hữu được đọc
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(snapshot, f, ensure_ascii=False)
+                os.replace(tmp_path, self.cache_path)
+            except Exception as e:
+                print(f"⚠️ UserDirectory: Lỗi ghi cache local: {e}")
+
+    def _probe_version(self):
+        """
+        Version của database: `last_edited_time|id` của dòng sửa gần nhất (kể cả dòng không Active)
+        bằng 1 request page_size=1.
+        """
+        url = f"{NOTION_API}/databases/{Config.NOTION_DATABASE_ID}/query"
+        payload = {"page_size": 1, "sorts": [{"timestamp": "last_edited_time", "direction": "descending"}]}
+        response = yield url, payload
+        if response.status_code != 200:
+            print(f"❌ Lỗi API Notion: {response.status_code} - {response.text}")
+            return None
+        results = response.json().get("results", [])
+        if not results:
+            return ""
+        return f"{results[0].get('last_edited_time', '')}|{results[0].get('id', '')}"
+
+    def _fetch_users(self):
+        # Filter: Chỉ lấy user có Active = true
+        payload = {
+            "filter": {
+                "property": "Active",
+                "checkbox": {
+                    "equals": True
                 }
+            }
+        }
+        pages = yield from query_pages(Config.NOTION_DATABASE_ID, payload)
+        if pages is None:
+            return None
+        return [user for user in map(parse_user, pages) if user]
+
+    def _load_steps(self, force_refresh, trust_cache):
+        """
+        Toàn bộ logic tải danh bạ (cache → probe version → tải lại) dạng generator các request Notion.
+        """
+        now = time.time()
+        cached = None
+        if not force_refresh:
+            if trust_cache and self._snapshot and now - self._snapshot["fetched_at"] < self.trust_ttl:
+                self.stats["memory"] += 1
+                return self._snapshot["users"]
+            cached = yield BlockingCall(self._load_cached)
+            if trust_cache and cached and now - cached["fetched_at"] < self.trust_ttl:
+                self.stats["memory"] += 1
+                print(f"📇 Dùng danh sách user đã cache ({len(cached['users'])} user).")
+                return self._use(cached)
+
+        print("Loading users from Notion...")
+        try:
+            version = yield from self._probe_version()
+            if version is None:
+                raise RuntimeError("không lấy được version của database")
 
-                # Chỉ thêm user nếu có đủ email/pass
-                if user["email"] and user["password"]:
-                    users.append(user)
-            
-            print(f"Found {len(users)} active users.")
-            return users
+            loaded_at = cached.get("loaded_at", cached["fetched_at"]) if cached else 0
+            if (cached and cached.get("version") == version and now - loaded_at < self.max_age
+                    and loaded_at >= _edited_at(version) + VERSION_SETTLE_SECONDS):
+                self.stats["probe_hits"] += 1
+                snapshot = dict(cached, fetched_at=now)
+                yield BlockingCall(self._save, snapshot)
+                print(f"📇 Notion không thay đổi, dùng lại {len(snapshot['users'])} user đã cache.")
+                return self._use(snapshot)
 
-    except Exception as e:
-        print(f"Exception calling Notion: {e}")
-        return []
+            users = yield from self._fetch_users()
+            if users is None:
+                raise RuntimeError("query database thất bại")
+        except Exception as e:
+            print(f"Exception calling Notion: {e}")
+            cached = cached or (yield BlockingCall(self._load_cached))
+            if cached:
+                self.stats["stale"] += 1
+                print(f"⚠️ Dùng danh sách user cũ trong cache ({len(cached['users'])} user).")
+                return self._use(cached)
+            return []
+
+        self.stats["full_loads"] += 1
+        snapshot = {"version": version, "fetched_at": now, "loaded_at": now, "users": users}
+        yield BlockingCall(self._save, snapshot)
+        print(f"Found {len(users)} active users.")
+        return self._use(snapshot)
+
+    @staticmethod
+    def _configured():
+        if not Config.NOTION_TOKEN or not Config.NOTION_DATABASE_ID:
+            print("❌ Lỗi: Thiếu cấu hình NOTION_TOKEN hoặc NOTION_DATABASE_ID.")
+            return False
+        return True
+
+    def get_users(self, force_refresh=False, trust_cache=True):
+        """
+        Danh sách user Active (list dict như trước đây).
+        `trust_cache=False` bỏ qua TTL tin tưởng (vẫn chỉ tải lại toàn bộ khi version đổi).
+        """
+        if not self._configured():
+            return []
+        return run_notion_sync(self._load_steps(force_refresh, trust_cache), Config.NOTION_TOKEN)
+
+    async def aget_users(self, client, force_refresh=False, trust_cache=True):
+        """
+        Phiên bản async của `get_users`, chạy trên httpx.AsyncClient dùng chung.
+        """
+        if not self._configured():
+            return []
+        return await run_notion_async(self._load_steps(force_refresh, trust_cache), Config.NOTION_TOKEN, client)
+
+    def get_user_by_chat_id(self, chat_id):
+        if chat_id is None:
+            return None
+        self.get_users()
+        user = self._by_chat_id.get(str(chat_id))
+        if user is None and self._snapshot is not None:
+            # User mới thêm có thể chưa có trong cache: hỏi lại version Notion 1 lần
+            self.get_users(trust_cache=False)
+            user = self._by_chat_id.get(str(chat_id))
+        return user
+
+    async def aget_user_by_chat_id(self, client, chat_id):
+        if chat_id is None:
+            return None
+        await self.aget_users(client)
+        user = self._by_chat_id.get(str(chat_id))
+        if user is None and self._snapshot is not None:
+            await self.aget_users(client, trust_cache=False)
+            user = self._by_chat_id.get(str(chat_id))
+        return user
+
+    def get_user_by_email(self, email):
+        if not email:
+            return None
+        self.get_users()
+        user = self._by_email.get(email.strip().lower())
+        if user is None and self._snapshot is not None:
+            self.get_users(trust_cache=False)
+            user = self._by_email.get(email.strip().lower())
+        return user
+
+# Khởi tạo Global Instance
+user_directory = UserDirectory()
+
+def get_users_from_notion():
+    """
+    Kết nối Notion, lấy danh sách user có trạng thái Active = True.
+    Trả về list các dict user.
+    """
+    return user_directory.get_users()
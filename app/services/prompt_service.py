@@ -1,106 +1,275 @@
 import os
-import httpx
+import re
+import json
+import time
+import string
+import asyncio
+import functools
 from dotenv import load_dotenv
 
 from app.config import Config
+from app.services.redis_service import redis_service
+from app.services.notion_service import BlockingCall, query_pages, run_notion_sync, run_notion_async
 
-def get_prompts_from_notion():
+_FIELD_ROOT = re.compile(r"[^.\[]*")
+
+class PromptTemplate:
     """
-    Fetches prompts from the Notion Prompt Database.
-    Returns a dictionary where keys are the 'Name' (title) of the prompt 
-    and values are the 'Content' (rich_text) of the prompt.
+    Template prompt đã phân tích sẵn một lần: tập placeholder ({name}) và lỗi cú pháp (nếu có).
+    Template lỗi (ngoặc lệch, placeholder vị trí {} / {0}) bị đánh dấu ngay khi tải,
+    `render()` báo lỗi ngay thay vì để str.format hỏng giữa chừng mỗi lần gọi.
+    """
+    def __init__(self, text):
+        self.text = text or ""
+        self.fields = frozenset()
+        self.error = None
+        fields = set()
+        try:
+            for _, field_name, _, _ in string.Formatter().parse(self.text):
+                if field_name is None:
+                    continue
+                root = _FIELD_ROOT.match(field_name).group()
+                if not root or root.isdigit():
+                    raise ValueError(f"placeholder vị trí không được hỗ trợ: {{{field_name}}}")
+                fields.add(root)
+            self.fields = frozenset(fields)
+        except ValueError as e:
+            self.error = str(e)
+
+    def uses(self, *names):
+        return any(name in self.fields for name in names)
+
+    def missing(self, values):
+        return sorted(self.fields.difference(values))
+
+    def render(self, **values):
+        if self.error:
+            raise ValueError(f"Template lỗi: {self.error}")
+        missing = self.missing(values)
+        if missing:
+            raise KeyError(f"Thiếu giá trị cho placeholder: {', '.join(missing)}")
+        return self.text.format_map(values)
+
+@functools.lru_cache(maxsize=256)
+def compile_template(text):
+    """
+    PromptTemplate cho `text` (cache theo nội dung, mỗi template chỉ phân tích 1 lần).
     """
-    token = Config.NOTION_TOKEN
-    database_id = Config.NOTION_PROMPT_DATABASE_ID
-
-    if not token or not database_id:
-        print("⚠️ Warning: Missing NOTION_TOKEN or NOTION_PROMPT_DATABASE_ID. Using default prompts may fail if not handled.")
-        return {}
-
-    url = f"https://api.notion.com/v1/databases/{database_id}/query"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Notion-Version": "2022-06-28",
-        "Content-Type": "application/json"
+    return PromptTemplate(text)
+
+def _plain_text(parts):
+    return "".join(t.get("plain_text", "") for t in parts or [])
+
+def parse_prompt_page(page, default_model):
+    """
+    Chuyển 1 page Notion thành (key, prompt) — prompt là None nếu page không dùng được
+    (Name trống hoặc Active=False).
+    """
+    props = page.get("properties", {})
+
+    # Join ALL text parts, not just [0]; normalize to lowercase
+    prompt_key = _plain_text(props.get("Name", {}).get("title", [])).strip().lower()
+    if not prompt_key:
+        return "", None
+
+    # Client-side Active check
+    if "Active" in props and not props.get("Active", {}).get("checkbox", False):
+        return prompt_key, None
+
+    system_text = _plain_text(props.get("System Prompt", {}).get("rich_text", []))
+    user_text = _plain_text(props.get("User Template", {}).get("rich_text", []))
+
+    # Model: Rich Text, Select hoặc Multi-select; fallback về model mặc định
+    model_text = default_model
+    model_prop = props.get("Model", {})
+    if model_prop.get("type") == "rich_text":
+        m_text = _plain_text(model_prop.get("rich_text", []))
+        if m_text: model_text = m_text
+    elif model_prop.get("type") == "select":
+        m_opt = model_prop.get("select")
+        if m_opt: model_text = m_opt.get("name")
+    elif model_prop.get("type") == "multi_select":
+        m_opts = model_prop.get("multi_select", [])
+        if m_opts: model_text = m_opts[0].get("name")
+
+    return prompt_key, {
+        "system_prompt": system_text,
+        "user_template": user_text,
+        "model": model_text
     }
 
-    # Remove filter to avoid 400 if "Active" column is missing or named differently
-    # We will filter in Python instead.
-    payload = {}
-
-    print("🔄 Loading prompts from Notion...")
-
-    try:
-        with httpx.Client(timeout=10.0) as client:
-            response = client.post(url, headers=headers, json=payload)
-
-            if response.status_code != 200:
-                print(f"❌ Notion API Error: {response.status_code} - {response.text}")
-                return {}
-
-            data = response.json()
-            results = data.get("results", [])
-            print(f"DEBUG: Notion API returned {len(results)} raw results.")
-            
-            prompts = {}
-
-            for page in results:
-                props = page.get("properties", {})
-                
-                # Get Name (Title) - Key
-                name_prop = props.get("Name", {}).get("title", [])
-                
-                # FIX: Join ALL text parts, not just [0]
-                full_raw_name = "".join([t.get("plain_text", "") for t in name_prop])
-                prompt_key = full_raw_name.strip().lower() # Normalize to lowercase
-                
-                # Debug: Print Name to see what we got
-                print(f"   -> Processing row: '{prompt_key}' (Raw: {repr(full_raw_name)})")
-
-                if not prompt_key:
-                    print(f"   -> Skipping row with empty Name.")
-                    continue
+class PromptRegistry:
+    """
+    Registry prompt từ Notion Prompt Database, cache theo từng page kèm `last_edited_time`.
+
+    - Lần đầu (hoặc snapshot cũ hơn NOTION_PROMPTS_MAX_AGE): tải toàn bộ database.
+    - Các lần sau: chỉ query các page có last_edited_time >= version (mốc sửa mới nhất đã biết)
+      và cập nhật đúng các page đó.
+    - Snapshot lưu ở bộ nhớ, file local và Redis; Notion chậm/lỗi (quá NOTION_PROMPTS_TIMEOUT giây)
+      thì dùng snapshot tốt gần nhất.
+    - Template được phân tích (compile_template) ngay khi tải; template lỗi được báo 1 lần.
+    """
+    def __init__(self, cache_path=None, timeout=None, max_age=None, use_redis=True):
+        self.cache_path = cache_path if cache_path is not None else Config.NOTION_PROMPTS_CACHE_PATH
+        self.timeout = timeout if timeout is not None else Config.NOTION_PROMPTS_TIMEOUT
+        self.max_age = max_age if max_age is not None else Config.NOTION_PROMPTS_MAX_AGE
+        self.use_redis = use_redis
+        self._snapshot = None
+        self.stats = {"full_loads": 0, "delta_loads": 0, "changed_pages": 0, "stale": 0}
+
+    def _redis_key(self, database_id):
+        return f"notion_prompts:{database_id}"
+
+    def _load_cached(self, database_id):
+        candidates = [self._snapshot]
+        if self.cache_path:
+            try:
+                with open(self.cache_path, "r", encoding="utf-8") as f:
+                    candidates.append(json.load(f))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"⚠️ PromptRegistry: Lỗi đọc cache local: {e}")
+        if self.use_redis:
+            candidates.append(redis_service.get_cache(self._redis_key(database_id)))
+
+        valid = [
+            c for c in candidates
+            if isinstance(c, dict) and c.get("database_id") == database_id and isinstance(c.get("pages"), dict)
+        ]
+        return max(valid, key=lambda c: c.get("fetched_at", 0)) if valid else None
+
+    def _save(self, snapshot):
+        self._snapshot = snapshot
+        if self.cache_path:
+            try:
+                os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+                tmp_path = f"{self.cache_path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(snapshot, f, ensure_ascii=False)
+                os.replace(tmp_path, self.cache_path)
+            except Exception as e:
+                print(f"⚠️ PromptRegistry: Lỗi ghi cache local: {e}")
+        if self.use_redis:
+            redis_service.set_cache(self._redis_key(snapshot["database_id"]), snapshot, max(int(self.max_age), 1))
+
+    @staticmethod
+    def _build(snapshot):
+        """
+        Dict prompt_key -> prompt từ snapshot. Template được compile ngay (nạp sẵn cache của
+        compile_template mà render_prompt_template dùng) để báo template lỗi 1 lần khi tải.
+        """
+        prompts = {}
+        for entry in snapshot["pages"].values():
+            prompt = entry.get("prompt")
+            if not prompt:
+                continue
+            template = compile_template(prompt["user_template"])
+            if template.error:
+                print(f"⚠️ Prompt '{entry['key']}': User Template lỗi ({template.error}), sẽ dùng fallback.")
+            prompts[entry["key"]] = dict(prompt)
+        return prompts
+
+    @staticmethod
+    def _configured():
+        if not Config.NOTION_TOKEN or not Config.NOTION_PROMPT_DATABASE_ID:
+            print("⚠️ Warning: Missing NOTION_TOKEN or NOTION_PROMPT_DATABASE_ID. Using default prompts may fail if not handled.")
+            return False
+        return True
+
+    def _plan(self, force_full):
+        """
+        Snapshot hiện có, có cần tải toàn bộ không, và timeout cho Notion (ngắn khi đã có snapshot dự phòng).
+        """
+        cached = self._load_cached(Config.NOTION_PROMPT_DATABASE_ID)
+        full = force_full or cached is None or time.time() - cached.get("loaded_at", 0) >= self.max_age
+        return cached, full, (self.timeout if cached else 10.0)
+
+    def get_prompts(self, force_full=False):
+        if not self._configured():
+            return {}
+        cached, full, timeout = self._plan(force_full)
+        return run_notion_sync(self._load_steps(cached, full), Config.NOTION_TOKEN, timeout=timeout)
+
+    async def aget_prompts(self, client, force_full=False):
+        """
+        Phiên bản async của `get_prompts`, chạy trên httpx.AsyncClient dùng chung.
+        """
+        if not self._configured():
+            return {}
+        # Đọc snapshot (file local, Redis đồng bộ) trong thread để không chặn event loop
+        cached, full, timeout = await asyncio.to_thread(self._plan, force_full)
+        return await run_notion_async(self._load_steps(cached, full), Config.NOTION_TOKEN, client, timeout=timeout)
+
+    def _load_steps(self, cached, full):
+        database_id = Config.NOTION_PROMPT_DATABASE_ID
+        default_model = Config.ROUTER9_COMBOS_MODEL or "gemini-3.1-pro"
+        now = time.time()
+
+        if full:
+            # Không lọc Active trên server (tránh 400 nếu thiếu cột), lọc trong Python
+            payload = {}
+            print("🔄 Loading prompts from Notion...")
+        else:
+            # Notion làm tròn last_edited_time theo phút nên dùng on_or_after (áp dụng lại là vô hại)
+            payload = {"filter": {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": cached["version"]}}} if cached.get("version") else {}
+            print(f"🔄 Checking prompt changes on Notion (since {cached.get('version') or 'start'})...")
 
-                # Client-side Active check
-                if "Active" in props:
-                    is_active = props.get("Active", {}).get("checkbox", False)
-                    if not is_active:
-                         print(f"   -> Skipping '{prompt_key}' because Active=False")
-                         continue
-
-                # Get System Prompt (Rich Text)
-                system_prop = props.get("System Prompt", {}).get("rich_text", [])
-                system_text = "".join([t.get("plain_text", "") for t in system_prop]) or ""
-
-                # Get User Template (Rich Text)
-                user_prop = props.get("User Template", {}).get("rich_text", [])
-                user_text = "".join([t.get("plain_text", "") for t in user_prop]) or ""
-                
-                # Get Model (Rich Text or Select) - Fallback to Config.ROUTER9_COMBOS_MODEL or "gemini-3.1-pro"
-                # Assuming Model is a Rich Text or Select property. Based on image it looks like Multi-select or Select or Text.
-                # Let's try to get it as rich_text first, if empty then check select.
-                model_text = Config.ROUTER9_COMBOS_MODEL or "gemini-3.1-pro"
-                model_prop = props.get("Model", {})
-                if model_prop.get("type") == "rich_text":
-                     m_text = "".join([t.get("plain_text", "") for t in model_prop.get("rich_text", [])])
-                     if m_text: model_text = m_text
-                elif model_prop.get("type") == "select":
-                    m_opt = model_prop.get("select")
-                    if m_opt: model_text = m_opt.get("name")
-                elif model_prop.get("type") == "multi_select":
-                    m_opts = model_prop.get("multi_select", [])
-                    if m_opts: model_text = m_opts[0].get("name")
-
-                if prompt_key:
-                    prompts[prompt_key] = {
-                        "system_prompt": system_text,
-                        "user_template": user_text,
-                        "model": model_text
-                    }
-
-            print(f"✅ Loaded {len(prompts)} prompts from Notion: {', '.join(prompts.keys())}")
-            return prompts
-
-    except Exception as e:
-        print(f"❌ Exception fetching prompts: {e}")
-        return {}
+        try:
+            pages = yield from query_pages(database_id, payload)
+        except Exception as e:
+            print(f"❌ Exception fetching prompts: {e}")
+            pages = None
+
+        if pages is None:
+            if cached:
+                self.stats["stale"] += 1
+                self._snapshot = cached
+                prompts = self._build(cached)
+                print(f"⚠️ Dùng {len(prompts)} prompts từ snapshot gần nhất.")
+                return prompts
+            return {}
+
+        snapshot = {
+            "database_id": database_id,
+            "version": "" if full else cached.get("version", ""),
+            "fetched_at": now,
+            "loaded_at": now if full else cached.get("loaded_at", now),
+            "pages": {} if full else dict(cached["pages"])
+        }
+        changed = 0
+        for page in pages:
+            page_id = page.get("id") or str(len(snapshot["pages"]))
+            edited = page.get("last_edited_time", "")
+            previous = snapshot["pages"].get(page_id)
+            if previous and previous.get("last_edited_time") == edited and edited:
+                continue
+            key, prompt = parse_prompt_page(page, default_model)
+            # Page sửa sau cùng được đưa xuống cuối để ghi đè key trùng như trước đây
+            snapshot["pages"].pop(page_id, None)
+            snapshot["pages"][page_id] = {"key": key, "last_edited_time": edited, "prompt": prompt}
+            if edited > snapshot["version"]:
+                snapshot["version"] = edited
+            changed += 1
+
+        if full:
+            self.stats["full_loads"] += 1
+        else:
+            self.stats["delta_loads"] += 1
+        self.stats["changed_pages"] += changed
+        yield BlockingCall(self._save, snapshot)
+
+        prompts = self._build(snapshot)
+        print(f"✅ Loaded {len(prompts)} prompts from Notion ({changed} page thay đổi): {', '.join(prompts.keys())}")
+        return prompts
+
+# Khởi tạo Global Instance
+prompt_registry = PromptRegistry()
+
+def get_prompts_from_notion():
+    """
+    Fetches prompts from the Notion Prompt Database.
+    Returns a dictionary where keys are the 'Name' (title) of the prompt
+    and values are the 'Content' (rich_text) of the prompt.
+    """
+    return prompt_registry.get_prompts()
@@ -191,5 +191,45 @@ class RedisService:
 
         return self._execute(_op, default_return=False)
 
+    def get_cache(self, key: str):
+        """
+        Get a cached JSON value. Returns None on miss or if Redis fails.
+        """
+        if not key:
+            return None
+
+        def _op():
+            raw = self._client.get(key)
+            if raw is None:
+                return None
+            import json
+            return json.loads(raw)
+
+        return self._execute(_op, default_return=None)
+
+    def set_cache(self, key: str, value, ttl_seconds: int) -> bool:
+        """
+        Store a JSON-serializable value with a TTL.
+        """
+        if not key or ttl_seconds <= 0:
+            return False
+
+        import json
+        value_str = json.dumps(value, ensure_ascii=False)
+
+        def _op():
+            return bool(self._client.set(key, value_str, ex=int(ttl_seconds)))
+
+        return self._execute(_op, default_return=False)
+
+    def incr_counter(self, key: str, amount: int = 1) -> int:
+        """
+        Increment a metrics counter. Returns the new value, or 0 if Redis fails.
+        """
+        def _op():
+            return int(self._client.incrby(key, amount))
+
+        return self._execute(_op, default_return=0)
+
 # Initialize a global Redis service instance
 redis_service = RedisService()
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+from app.config import Config
+from app.services.garmin_service import fetch_garmin_concurrently, get_device_watermark
+from app.services.timeseries_store import timeseries_store, client_user_key, STORE_METRICS, VN_TZ
+
+# Các endpoint theo ngày được materialise trong mỗi lần sync
+SYNC_DAY_METHODS = list(STORE_METRICS.keys())
+
+def sync_user(client, user_label="User", days_back=None):
+    """
+    Đồng bộ tăng dần dữ liệu Garmin của một user vào TimeSeriesStore.
+    Dựa vào watermark thiết bị: nếu không có upload mới kể từ lần sync trước thì bỏ qua;
+    nếu có, chỉ kéo lại các ngày chưa đóng theo watermark cũ (từ ngày của watermark cũ - settle_hours) đến hôm nay.
+    Trả về số bản ghi đã ghi (0 nếu đã up-to-date), hoặc None nếu lỗi.
+    """
+    days_back = days_back or Config.SYNC_DAYS_BACK
+    user_key = client_user_key(client)
+    if not user_key:
+        print(f"[{user_label}] ⚠️ Không xác định được tài khoản Garmin, bỏ qua sync.")
+        return None
+
+    watermark_ms, device_name, _ = get_device_watermark(client, user_label)
+    if not watermark_ms:
+        print(f"[{user_label}] ⚠️ Không tìm thấy dữ liệu đồng bộ nào, bỏ qua sync.")
+        return None
+
+    previous_ms = timeseries_store.get_sync_state(user_key)
+    if previous_ms and previous_ms >= watermark_ms:
+        print(f"[{user_label}] ✅ Store đã up-to-date (không có upload mới từ {device_name}).")
+        return 0
+
+    today = datetime.now(VN_TZ).date()
+    earliest = today - timedelta(days=days_back - 1)
+    if previous_ms:
+        # Ngày chưa đóng với watermark cũ có thể vừa nhận thêm dữ liệu (đồng hồ đồng bộ muộn)
+        start = datetime.fromtimestamp(previous_ms / 1000 - timeseries_store.settle_hours * 3600, VN_TZ).date()
+        start = min(max(start, earliest), today)
+    else:
+        start = earliest
+
+    days = [(start + timedelta(days=i)).isoformat() for i in range((today - start).days + 1)]
+    print(f"[{user_label}] 🔄 Sync {len(days)} ngày ({days[0]} → {days[-1]}), watermark {watermark_ms}...")
+
+    calls = {}
+    for day in days:
+        for method_name in SYNC_DAY_METHODS:
+            calls[f"{method_name}|{day}"] = (getattr(client, method_name), day)
+    calls["activities"] = (client.get_activities_by_date, days[0], days[-1], "")
+
+    fetched = fetch_garmin_concurrently(calls, user_label)
+
+    written = 0
+    for key, data in fetched.items():
+        if key == "activities":
+            timeseries_store.put_activities(user_key, data, days[0], days[-1], watermark=watermark_ms)
+            written += len(days)
+            continue
+        method_name, day = key.split("|", 1)
+        if data and timeseries_store.put(user_key, STORE_METRICS[method_name], day, data, watermark=watermark_ms):
+            written += 1
+
+    # Chỉ tiến watermark khi không có endpoint nào lỗi, để lần sau kéo lại phần thiếu
+    if len(fetched) == len(calls):
+        timeseries_store.set_sync_state(user_key, watermark_ms)
+    else:
+        print(f"[{user_label}] ⚠️ {len(calls) - len(fetched)} endpoint lỗi, giữ nguyên watermark cũ.")
+
+    print(f"[{user_label}] ✅ Sync xong: {written} bản ghi.")
+    return written
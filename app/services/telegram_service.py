@@ -1,83 +1,512 @@
-import os
+import time
+import asyncio
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.request import HTTPXRequest
+from app.config import Config
+from app.utils.audio import as_upload
+from app.utils.telegram_html import TELEGRAM_MESSAGE_LIMIT, markdown_to_telegram_html, render_telegram_chunks, html_to_plain
 
-def clean_and_convert_markdown_to_html(text: str) -> str:
+class CountingRequest(HTTPXRequest):
     """
-    Chuyển đổi Markdown cơ bản sang HTML tương thích với Telegram.
-    Tự động escape các ký tự đặc biệt của HTML để tránh lỗi phân tích cú pháp.
+    HTTPXRequest (connection pool keep-alive) có đếm số request API đã gửi qua pool này.
     """
-    import html
-    import re
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.request_count = 0
 
-    if not text:
-        return ""
+    async def do_request(self, *args, **kwargs):
+        self.request_count += 1
+        return await super().do_request(*args, **kwargs)
 
-    # 1. Escape các ký tự HTML đặc biệt để bảo vệ
-    escaped_text = html.escape(text)
+class TelegramClient:
+    """
+    Giữ một Bot dùng chung cho mỗi token (và event loop) với HTTP transport có connection pool,
+    thay vì tạo Bot mới cho từng tin nhắn. Gọi `shutdown()` khi kết thúc chương trình.
+    """
+    def __init__(self):
+        # (token, loop) -> (Bot, CountingRequest)
+        self._bots = {}
+        self.stats = {"pools": 0, "requests": 0}
 
-    # 2. Convert Headers (#, ##, ###) sang dạng chữ đậm
-    lines = escaped_text.split("\n")
-    for i, line in enumerate(lines):
-        striped_line = line.strip()
-        if striped_line.startswith("#"):
-            indent = line[:len(line) - len(line.lstrip())]
-            cleaned = striped_line.lstrip("#").strip()
-            lines[i] = f"{indent}<b>{cleaned}</b>"
-    escaped_text = "\n".join(lines)
+    def get_bot(self, bot_token):
+        loop = asyncio.get_running_loop()
+        # Bỏ các Bot gắn với event loop đã đóng
+        for key in [k for k in self._bots if k[1].is_closed()]:
+            self.stats["requests"] += self._bots.pop(key)[1].request_count
 
-    # 3. Convert **bold** sang <b>bold</b>
-    escaped_text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', escaped_text)
+        key = (bot_token, loop)
+        if key not in self._bots:
+            request = CountingRequest(
+                connection_pool_size=Config.TELEGRAM_POOL_SIZE,
+                connect_timeout=Config.TELEGRAM_CONNECT_TIMEOUT,
+                read_timeout=Config.TELEGRAM_READ_TIMEOUT,
+                write_timeout=Config.TELEGRAM_READ_TIMEOUT,
+                media_write_timeout=Config.TELEGRAM_MEDIA_TIMEOUT
+            )
+            self._bots[key] = (Bot(token=bot_token, request=request), request)
+            self.stats["pools"] += 1
+        return self._bots[key][0]
 
-    # 4. Convert *bold* sang <b>bold</b> (tránh bullet points)
-    escaped_text = re.sub(r'(?<!\w)\*(?!\s)(.*?)(?<!\s)\*(?!\w)', r'<b>\1</b>', escaped_text)
+    def request_count(self):
+        return self.stats["requests"] + sum(request.request_count for _, request in self._bots.values())
 
-    # 5. Convert _italic_ sang <i>italic</i>
-    escaped_text = re.sub(r'(?<!\w)_(?!\s)(.*?)(?<!\s)_(?!\w)', r'<i>\1</i>', escaped_text)
+    async def shutdown(self):
+        """
+        Đóng toàn bộ connection pool và in thống kê số request trên mỗi pool.
+        """
+        loop = asyncio.get_running_loop()
+        total = self.request_count()
+        for key in [k for k in self._bots if k[1] is loop]:
+            bot, request = self._bots.pop(key)
+            self.stats["requests"] += request.request_count
+            try:
+                # Bot chưa initialize() nên bot.shutdown() bỏ qua request; đóng pool httpx trực tiếp
+                await request.shutdown()
+            except Exception as e:
+                print(f"⚠️ Telegram: Lỗi đóng kết nối: {e}")
+        if self.stats["pools"]:
+            print(f"📨 Telegram: {total} request qua {self.stats['pools']} connection pool "
+                  f"(~{total / self.stats['pools']:.1f} request/pool).")
 
-    # 6. Convert `code` sang <code>code</code>
-    escaped_text = re.sub(r'`(.*?)`', r'<code>\1</code>', escaped_text)
+# Khởi tạo Global Instance
+telegram_client = TelegramClient()
 
-    return escaped_text
+# Độ ưu tiên trong hàng đợi gửi (số nhỏ gửi trước)
+PRIORITY_REPORT = 0
+PRIORITY_VOICE = 1
+PRIORITY_PROGRESS = 2
 
-async def send_telegram_report(bot_token, message, chat_id, user_label="User", audio_path=None):
-    print(f"[{user_label}] 📲 Đang gửi Telegram...")
-    if not bot_token or not chat_id:
-        print(f"[{user_label}] ⚠️ Không có Chat ID hoặc Token.")
-        return
+class TokenBucket:
+    """
+    Token bucket kiểu "đặt chỗ": reserve() trừ 1 token (có thể âm) và trả về số giây phải chờ.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, now=None):
+        now = now if now is not None else time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def delay(self, now=None):
+        """
+        Số giây phải chờ tới khi có 1 token, không trừ token.
+        """
+        now = now if now is not None else time.monotonic()
+        tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def pause(self, seconds):
+        """
+        Chặn bucket thêm `seconds` giây (dùng khi Telegram trả về retry_after).
+        """
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+class _OutboxJob:
+    def __init__(self, bot_token, chat_id, action, priority, supersede_key, retries):
+        self.bot_token = bot_token
+        self.chat_id = chat_id
+        self.action = action
+        self.priority = priority
+        self.supersede_key = supersede_key
+        self.retries_left = retries
+        self.seq = None
+        self.future = asyncio.get_running_loop().create_future()
+        self.dropped = False
+
+    def drop(self):
+        self.dropped = True
+        if not self.future.done():
+            self.future.set_result(None)
+
+class TelegramOutbox:
+    """
+    Hàng đợi gửi Telegram dùng chung: ưu tiên báo cáo > voice > progress, giới hạn tốc độ
+    toàn cục (~30 msg/s) và theo từng chat (~1 msg/s) bằng token bucket, tôn trọng retry_after,
+    bỏ các progress/edit đã bị bản mới thay thế và retry có giới hạn cho báo cáo.
+    """
+    def __init__(self):
+        self._loop = None
+        self.stats = {"sent": 0, "superseded": 0, "retried": 0, "failed": 0}
 
-    bot = Bot(token=bot_token)
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        # Event loop mới (mỗi asyncio.run): khởi tạo lại toàn bộ trạng thái
+        self._loop = loop
+        self._queue = asyncio.PriorityQueue()
+        self._seq = 0
+        self._global_bucket = TokenBucket(Config.TELEGRAM_GLOBAL_RATE)
+        self._chat_buckets = {}
+        self._chat_locks = {}
+        self._pending = {}
+        # Job của chat đang hết token: chờ timer xếp lại (theo thứ tự), không giữ worker
+        self._deferred = {}
+        self._timers = set()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(max(1, Config.TELEGRAM_OUTBOX_WORKERS))]
 
-    # Tạo menu nút bấm
+    async def send(self, bot_token, chat_id, action, priority=PRIORITY_REPORT, supersede_key=None, retries=None):
+        """
+        Xếp `action(bot)` (coroutine gửi tin) vào hàng đợi và chờ kết quả.
+        Trả về None nếu bị thay thế bởi job mới hơn cùng `supersede_key`. Lỗi không retry được sẽ được raise.
+        """
+        self._ensure_started()
+        if retries is None:
+            retries = Config.TELEGRAM_SEND_RETRIES if priority < PRIORITY_PROGRESS else 0
+        job = _OutboxJob(bot_token, chat_id, action, priority, supersede_key, retries)
+
+        if supersede_key is not None:
+            previous = self._pending.get(supersede_key)
+            if previous is not None:
+                previous.drop()
+                self.stats["superseded"] += 1
+            self._pending[supersede_key] = job
+        if priority == PRIORITY_REPORT:
+            # Báo cáo đã tới thì các progress đang chờ của chat đó không còn ý nghĩa
+            previous = self._pending.pop(("progress", chat_id), None)
+            if previous is not None:
+                previous.drop()
+                self.stats["superseded"] += 1
+
+        self._enqueue(job)
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            job.drop()
+            raise
+
+    def _enqueue(self, job):
+        # Job xếp lại (retry / hết hạn chờ) giữ số thứ tự cũ để không bị tin sau vượt lên
+        if job.seq is None:
+            self._seq += 1
+            job.seq = self._seq
+        self._queue.put_nowait((job.priority, job.seq, job))
+
+    def _defer(self, job, wait):
+        """
+        Hoãn job của chat đang bị giới hạn tốc độ: 1 timer cho mỗi chat xếp lại cả nhóm sau `wait` giây.
+        """
+        jobs = self._deferred.get(job.chat_id)
+        if jobs is None:
+            jobs = self._deferred[job.chat_id] = []
+            timer = asyncio.create_task(self._release_deferred(job.chat_id, wait))
+            self._timers.add(timer)
+            timer.add_done_callback(self._timers.discard)
+        jobs.append(job)
+
+    async def _release_deferred(self, chat_id, wait):
+        await asyncio.sleep(wait)
+        for job in self._deferred.pop(chat_id, []):
+            self._enqueue(job)
+
+    def _chat_bucket(self, chat_id):
+        if chat_id not in self._chat_buckets:
+            self._chat_buckets[chat_id] = TokenBucket(Config.TELEGRAM_CHAT_RATE, Config.TELEGRAM_CHAT_BURST)
+            self._chat_locks[chat_id] = asyncio.Lock()
+        return self._chat_buckets[chat_id]
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                if not job.dropped:
+                    await self._dispatch(job)
+            except Exception as e:
+                print(f"⚠️ Telegram outbox: Lỗi không mong đợi: {e}")
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    async def _dispatch(self, job):
+        from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest, Forbidden
+
+        bucket = self._chat_bucket(job.chat_id)
+        # Hết token (hoặc đang retry_after): hoãn job thay vì ngủ trong worker giữ lock chat
+        if job.chat_id in self._deferred:
+            self._defer(job, 0)
+            return
+        wait = max(bucket.delay(), self._global_bucket.delay())
+        if wait > 0:
+            self._defer(job, wait)
+            return
+        bucket.reserve()
+        self._global_bucket.reserve()
+
+        async with self._chat_locks[job.chat_id]:
+            if job.dropped:
+                return
+            if job.supersede_key is not None and self._pending.get(job.supersede_key) is job:
+                del self._pending[job.supersede_key]
+
+            try:
+                result = await job.action(telegram_client.get_bot(job.bot_token))
+                self.stats["sent"] += 1
+                if not job.future.done():
+                    job.future.set_result(result)
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+                print(f"⏳ Telegram flood limit chat {job.chat_id}: chờ {retry_after:.0f}s")
+                bucket.pause(retry_after)
+                error = e
+            except (BadRequest, Forbidden) as e:
+                # Lỗi nội dung / bị chặn: không retry
+                job.retries_left = 0
+                error = e
+            except (TimedOut, NetworkError) as e:
+                error = e
+            except Exception as e:
+                # InvalidToken, ChatMigrated, lỗi trong action...: không retry, báo lỗi cho người gọi
+                job.retries_left = 0
+                error = e
+
+        if job.retries_left > 0 and not job.dropped:
+            job.retries_left -= 1
+            self.stats["retried"] += 1
+            self._enqueue(job)
+        else:
+            self.stats["failed"] += 1
+            if not job.future.done():
+                job.future.set_exception(error)
+
+    async def drain(self):
+        """
+        Chờ gửi hết hàng đợi rồi dừng các worker (gọi trước khi đóng kết nối).
+        """
+        if self._loop is not asyncio.get_running_loop():
+            return
+        while True:
+            await self._queue.join()
+            if not self._timers:
+                break
+            await asyncio.gather(*list(self._timers), return_exceptions=True)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._loop = None
+
+# Khởi tạo Global Instance
+telegram_outbox = TelegramOutbox()
+
+async def shutdown_telegram():
+    await telegram_outbox.drain()
+    if telegram_outbox.stats["sent"]:
+        print(f"📬 Telegram outbox: {telegram_outbox.stats}")
+    await telegram_client.shutdown()
+
+def clean_and_convert_markdown_to_html(text: str) -> str:
+    """
+    Chuyển đổi Markdown cơ bản sang HTML tương thích với Telegram (1 lượt duyệt, thẻ luôn cân bằng).
+    Tự động escape các ký tự đặc biệt của HTML để tránh lỗi phân tích cú pháp.
+    """
+    return markdown_to_telegram_html(text)
+
+def report_keyboard():
+    """
+    Menu nút bấm gắn dưới mỗi báo cáo.
+    """
     keyboard = [
         [InlineKeyboardButton("📊 Sức khỏe & Đề xuất Tập", callback_data="daily")],
         [InlineKeyboardButton("💤 Phân tích Ngủ", callback_data="sleep_analysis"),
          InlineKeyboardButton("🏃 Phân tích Buổi tập", callback_data="workout")],
         [InlineKeyboardButton("🔋 Bắt mạch Năng lượng", callback_data="battery")]
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return InlineKeyboardMarkup(keyboard)
+
+class TelegramStreamingMessage:
+    """
+    Hiển thị báo cáo AI đang được stream: gửi 1 tin nhắn khi có đoạn text đầu tiên, sau đó
+    sửa (edit_message_text) tin nhắn đó theo nhịp tối thiểu `min_interval` giây.
+    `push()` an toàn khi gọi từ thread khác (AI chạy trong asyncio.to_thread).
+    Khi xong, `finish()` chuyển nội dung cuối sang HTML và gắn menu nút bấm.
+    """
+    CURSOR = " ▌"
+
+    def __init__(self, bot_token, chat_id, user_label="User", min_interval=None):
+        self.bot_token = bot_token
+        self.chat_id = chat_id
+        self.user_label = user_label
+        self.min_interval = min_interval if min_interval is not None else Config.TELEGRAM_STREAM_EDIT_INTERVAL
+        self.message_id = None
+        self.delivered = False
+        self.edits = 0
+        self._latest = ""
+        self._shown = ""
+        self._loop = None
+        self._changed = None
+        self._pump_task = None
+        self._first_text_at = None
+        self._started_at = None
+
+    def start(self):
+        """
+        Gắn vào event loop hiện tại và chạy vòng cập nhật tin nhắn ở background.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        self._started_at = time.monotonic()
+        self._pump_task = asyncio.create_task(self._pump())
+        return self
+
+    def push(self, text):
+        self._latest = text
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._changed.set)
+
+    @staticmethod
+    def _preview(text):
+        limit = TELEGRAM_MESSAGE_LIMIT - len(TelegramStreamingMessage.CURSOR)
+        if len(text) > limit:
+            text = text[:limit - 1] + "…"
+        return text + TelegramStreamingMessage.CURSOR
+
+    async def _render(self, text):
+        try:
+            if self.message_id is None:
+                preview = self._preview(text)
+                msg = await telegram_outbox.send(
+                    self.bot_token, self.chat_id,
+                    lambda bot: bot.send_message(chat_id=self.chat_id, text=preview, disable_notification=True)
+                )
+                self.message_id = msg.message_id
+                self._first_text_at = time.monotonic()
+                print(f"[{self.user_label}] ⚡ Text đầu tiên sau {self._first_text_at - self._started_at:.1f}s")
+            else:
+                preview = self._preview(text)
+                result = await telegram_outbox.send(
+                    self.bot_token, self.chat_id,
+                    lambda bot: bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_id, text=preview),
+                    priority=PRIORITY_PROGRESS, supersede_key=self._edit_key()
+                )
+                if result is None:
+                    return
+                self.edits += 1
+            self._shown = text
+        except Exception as e:
+            print(f"[{self.user_label}] ⚠️ Lỗi cập nhật tin nhắn stream: {e}")
+
+    def _edit_key(self):
+        return ("edit", self.chat_id, self.message_id)
+
+    async def _pump(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            text = self._latest
+            if text and text != self._shown:
+                await self._render(text)
+                await asyncio.sleep(self.min_interval)
 
-    # Convert markdown to robust HTML
-    formatted_message = clean_and_convert_markdown_to_html(message)
+    async def _stop(self):
+        if self._pump_task:
+            self._pump_task.cancel()
+            try:
+                await self._pump_task
+            except asyncio.CancelledError:
+                pass
+            self._pump_task = None
 
+    async def finish(self, final_text, reply_markup=None):
+        """
+        Dừng stream và thay nội dung bằng bản cuối (HTML). Báo cáo dài hơn giới hạn Telegram
+        được chia thành nhiều tin nhắn. Trả về True nếu báo cáo đã được gửi tới người dùng.
+        """
+        await self._stop()
+        if not final_text:
+            if self.message_id is not None:
+                try:
+                    await telegram_outbox.send(
+                        self.bot_token, self.chat_id,
+                        lambda bot: bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_id, text="⚠️ AI Coach đang bận hoặc gặp lỗi. Vui lòng thử lại sau."),
+                        supersede_key=self._edit_key()
+                    )
+                except Exception as e:
+                    print(f"[{self.user_label}] ⚠️ Lỗi cập nhật tin nhắn stream: {e}")
+            return False
+
+        reply_markup = reply_markup or report_keyboard()
+        chunks = render_telegram_chunks(final_text)
+        sent = []
+        for i, html_chunk in enumerate(chunks):
+            markup = reply_markup if i == len(chunks) - 1 else None
+            for text, parse_mode in ((html_chunk, 'HTML'), (html_to_plain(html_chunk), None)):
+                try:
+                    if i == 0 and self.message_id is not None:
+                        await telegram_outbox.send(
+                            self.bot_token, self.chat_id,
+                            lambda bot: bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_id, text=text, parse_mode=parse_mode, reply_markup=markup),
+                            supersede_key=self._edit_key()
+                        )
+                    else:
+                        await telegram_outbox.send(
+                            self.bot_token, self.chat_id,
+                            lambda bot: bot.send_message(chat_id=self.chat_id, text=text, parse_mode=parse_mode, reply_markup=markup)
+                        )
+                    sent.append(i)
+                    break
+                except Exception as e:
+                    print(f"[{self.user_label}] ⚠️ Lỗi gửi bản cuối ({parse_mode or 'Plain Text'}): {e}")
+
+        self.delivered = len(sent) == len(chunks)
+        if self.delivered:
+            print(f"[{self.user_label}] ✅ Stream xong ({self.edits} lần sửa tin nhắn).")
+        return self.delivered
+
+async def send_voice_note(bot_token, chat_id, audio_clip, user_label="User"):
+    """
+    Gửi voice note (dict từ encode_voice_note) trực tiếp từ bộ nhớ. Trả về True nếu gửi thành công.
+    """
+    if not bot_token or not chat_id or not audio_clip:
+        return False
+    print(f"[{user_label}] 🎙️ Đang gửi Voice Note ({audio_clip['filename']}, {len(audio_clip['data']) // 1024}KB)...")
     try:
-        await bot.send_message(chat_id=chat_id, text=formatted_message, parse_mode='HTML', reply_markup=reply_markup)
-        print(f"[{user_label}] ✅ Gửi thành công!")
+        await telegram_outbox.send(
+            bot_token, chat_id,
+            lambda bot: bot.send_voice(chat_id=chat_id, voice=as_upload(audio_clip), caption="🎧 Voice Coach", duration=audio_clip.get("duration")),
+            priority=PRIORITY_VOICE
+        )
+        print(f"[{user_label}] ✅ Gửi Voice thành công!")
+        return True
     except Exception as e:
-        print(f"[{user_label}] ⚠️ Lỗi HTML (Error: {e}), đang gửi Plain Text...")
-        try:
-            await bot.send_message(chat_id=chat_id, text=message, parse_mode=None, reply_markup=reply_markup)
-        except Exception as e2:
-            print(f"❌ Lỗi gửi tin nhắn: {e2}")
+        print(f"[{user_label}] ⚠️ Lỗi gửi Voice: {e}")
+        return False
 
-    # Gửi Voice nếu có
-    if audio_path and os.path.exists(audio_path):
-        print(f"[{user_label}] 🎙️ Đang gửi Voice Note...")
+async def send_telegram_report(bot_token, message, chat_id, user_label="User", audio_clip=None, stream_message=None):
+    print(f"[{user_label}] 📲 Đang gửi Telegram...")
+    if not bot_token or not chat_id:
+        print(f"[{user_label}] ⚠️ Không có Chat ID hoặc Token.")
+        return
+
+    # Báo cáo đã được stream tới người dùng thì chỉ còn gửi Voice
+    if stream_message is not None and stream_message.delivered:
+        await send_voice_note(bot_token, chat_id, audio_clip, user_label)
+        return
+
+    reply_markup = report_keyboard()
+
+    # Convert markdown to robust HTML, chia thành nhiều tin nếu vượt giới hạn 4096 ký tự
+    chunks = render_telegram_chunks(message)
+    for i, formatted_message in enumerate(chunks):
+        markup = reply_markup if i == len(chunks) - 1 else None
         try:
-            with open(audio_path, 'rb') as audio:
-                await bot.send_voice(chat_id=chat_id, voice=audio, caption="🎧 Voice Coach")
-            print(f"[{user_label}] ✅ Gửi Voice thành công!")
+            await telegram_outbox.send(bot_token, chat_id, lambda bot: bot.send_message(chat_id=chat_id, text=formatted_message, parse_mode='HTML', reply_markup=markup))
+            print(f"[{user_label}] ✅ Gửi thành công ({i + 1}/{len(chunks)})!")
         except Exception as e:
-            print(f"[{user_label}] ⚠️ Lỗi gửi Voice: {e}")
+            print(f"[{user_label}] ⚠️ Lỗi HTML (Error: {e}), đang gửi Plain Text...")
+            try:
+                await telegram_outbox.send(bot_token, chat_id, lambda bot: bot.send_message(chat_id=chat_id, text=html_to_plain(formatted_message), parse_mode=None, reply_markup=markup))
+            except Exception as e2:
+                print(f"❌ Lỗi gửi tin nhắn: {e2}")
+
+    # Gửi Voice nếu có
+    await send_voice_note(bot_token, chat_id, audio_clip, user_label)
 
 async def send_error_alert(bot_token, admin_id, error_message):
     """
@@ -87,18 +516,17 @@ async def send_error_alert(bot_token, admin_id, error_message):
         print("⚠️ Không có Token hoặc Admin ID để gửi alert.")
         return
 
-    bot = Bot(token=bot_token)
     alert_text = f"🚨 **CRASH ALERT** 🚨\n\nBot đã gặp lỗi nghiêm trọng:\n\n`{error_message}`"
     formatted_alert = clean_and_convert_markdown_to_html(alert_text)
 
     try:
-        await bot.send_message(chat_id=admin_id, text=formatted_alert, parse_mode='HTML')
+        await telegram_outbox.send(bot_token, admin_id, lambda bot: bot.send_message(chat_id=admin_id, text=formatted_alert, parse_mode='HTML'))
         print("✅ Đã gửi Error Alert cho Admin.")
     except Exception as e:
         print(f"❌ Không thể gửi Error Alert: {e}")
         try:
              # Fallback plain text if HTML fails
-            await bot.send_message(chat_id=admin_id, text=alert_text.replace('`', '').replace('*', ''), parse_mode=None)
+            await telegram_outbox.send(bot_token, admin_id, lambda bot: bot.send_message(chat_id=admin_id, text=alert_text.replace('`', '').replace('*', ''), parse_mode=None))
         except:
             pass
 
@@ -107,7 +535,11 @@ async def send_error_alert(bot_token, admin_id, error_message):
 async def send_progress_update(bot_token, message, chat_id, user_label="User"):
     if not bot_token or not chat_id: return
     try:
-        bot = Bot(token=bot_token)
-        await bot.send_message(chat_id=chat_id, text=message, disable_notification=True)
+        # Progress mới thay thế progress cũ chưa kịp gửi của cùng chat
+        await telegram_outbox.send(
+            bot_token, chat_id,
+            lambda bot: bot.send_message(chat_id=chat_id, text=message, disable_notification=True),
+            priority=PRIORITY_PROGRESS, supersede_key=("progress", chat_id)
+        )
     except Exception as e:
         print(f"[{user_label}] ⚠️ Lỗi progress: {e}")
@@ -0,0 +1,273 @@
+import os
+import json
+import zlib
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+import pytz
+from app.config import Config
+
+VN_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
+
+# Các endpoint Garmin theo ngày -> tên metric trong store
+STORE_METRICS = {
+    "get_all_day_stress": "all_day_stress",
+    "get_heart_rates": "heart_rates",
+    "get_body_battery": "body_battery",
+    "get_steps_data": "steps",
+    "get_user_summary": "user_summary",
+    "get_sleep_data": "sleep",
+    "get_spo2_data": "spo2",
+    "get_respiration_data": "respiration",
+    "get_hrv_data": "hrv",
+    "get_training_status": "training_status",
+}
+
+ACTIVITIES_METRIC = "activities"
+
+def client_user_key(client):
+    """
+    Lấy khóa user (email Garmin) từ client. Trả về None nếu không xác định được,
+    khi đó store sẽ được bỏ qua.
+    """
+    username = getattr(client, "username", None)
+    if isinstance(username, str) and username:
+        return username.strip().lower()
+    return None
+
+class TimeSeriesStore:
+    """
+    Lưu dữ liệu Garmin theo ngày xuống SQLite, khóa (user, metric, date), kèm watermark
+    (thời điểm thiết bị upload gần nhất lúc ghi). Bản ghi có watermark đã qua ngày kết thúc
+    + thời gian chờ đồng bộ là ngày đã "đóng", được đọc lại vô điều kiện. Bản ghi khác chỉ
+    được dùng lại khi watermark không cũ hơn watermark thiết bị hiện tại.
+    """
+    def __init__(self, path=None, settle_hours=None):
+        self.path = path if path is not None else Config.GARMIN_STORE_PATH
+        self.settle_hours = settle_hours if settle_hours is not None else Config.GARMIN_STORE_SETTLE_HOURS
+        self._lock = threading.Lock()
+        self._conn = None
+        self._disabled = not self.path
+        # Watermark thiết bị mới nhất quan sát được trong process này (user_key -> ms)
+        self._device_watermarks = {}
+
+    def _get_conn(self):
+        if self._disabled:
+            return None
+        if self._conn is None:
+            try:
+                folder = os.path.dirname(self.path)
+                if folder:
+                    os.makedirs(folder, exist_ok=True)
+                conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS day_metrics (
+                        user_key TEXT NOT NULL,
+                        metric TEXT NOT NULL,
+                        day TEXT NOT NULL,
+                        payload BLOB NOT NULL,
+                        fetched_at REAL NOT NULL,
+                        watermark INTEGER,
+                        PRIMARY KEY (user_key, metric, day)
+                    )
+                    """
+                )
+                # Migrate store cũ chưa có cột watermark
+                columns = [r[1] for r in conn.execute("PRAGMA table_info(day_metrics)").fetchall()]
+                if "watermark" not in columns:
+                    conn.execute("ALTER TABLE day_metrics ADD COLUMN watermark INTEGER")
+                conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS sync_state (
+                        user_key TEXT PRIMARY KEY,
+                        watermark INTEGER NOT NULL,
+                        synced_at REAL NOT NULL
+                    )
+                    """
+                )
+                conn.commit()
+                self._conn = conn
+            except Exception as e:
+                print(f"⚠️ TimeSeriesStore: Không mở được {self.path}: {e}. Bỏ qua store.")
+                self._disabled = True
+                return None
+        return self._conn
+
+    def is_closed_day(self, date_iso, watermark):
+        """
+        Ngày được coi là đã đóng khi watermark thiết bị (ms) đã qua nửa đêm (giờ VN) + settle_hours,
+        tức thiết bị đã upload cả phần sau ngày đó. Không dựa vào giờ hệ thống: đồng hồ đồng bộ muộn
+        hơn settle_hours thì dữ liệu lấy trước đó vẫn thiếu.
+        """
+        if not watermark:
+            return False
+        try:
+            day = datetime.strptime(date_iso, "%Y-%m-%d")
+        except (TypeError, ValueError):
+            return False
+        day_end = VN_TZ.localize(day + timedelta(days=1))
+        return int(watermark) >= (day_end + timedelta(hours=self.settle_hours)).timestamp() * 1000
+
+    def _get_row(self, user_key, metric, date_iso):
+        with self._lock:
+            conn = self._get_conn()
+            if conn is None:
+                return None
+            try:
+                row = conn.execute(
+                    "SELECT payload, watermark FROM day_metrics WHERE user_key = ? AND metric = ? AND day = ?",
+                    (user_key, metric, date_iso)
+                ).fetchone()
+            except Exception as e:
+                print(f"⚠️ TimeSeriesStore: Lỗi đọc {metric} {date_iso}: {e}")
+                return None
+        if not row:
+            return None
+        return json.loads(zlib.decompress(row[0]).decode("utf-8")), row[1]
+
+    def get(self, user_key, metric, date_iso):
+        row = self._get_row(user_key, metric, date_iso)
+        return row[0] if row else None
+
+    def put(self, user_key, metric, date_iso, payload, watermark=None):
+        blob = zlib.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+        with self._lock:
+            conn = self._get_conn()
+            if conn is None:
+                return False
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO day_metrics (user_key, metric, day, payload, fetched_at, watermark) VALUES (?, ?, ?, ?, ?, ?)",
+                    (user_key, metric, date_iso, blob, time.time(), watermark)
+                )
+                conn.commit()
+                return True
+            except Exception as e:
+                print(f"⚠️ TimeSeriesStore: Lỗi ghi {metric} {date_iso}: {e}")
+                return False
+
+    def note_watermark(self, user_key, watermark):
+        """
+        Ghi nhận watermark thiết bị mới nhất (lastUsedDeviceUploadTime / lastSyncTimestampGMT, ms).
+        """
+        if user_key and watermark:
+            self._device_watermarks[user_key] = int(watermark)
+
+    def get_sync_state(self, user_key):
+        """
+        Trả về watermark của lần sync gần nhất (ms) hoặc None.
+        """
+        with self._lock:
+            conn = self._get_conn()
+            if conn is None:
+                return None
+            try:
+                row = conn.execute("SELECT watermark FROM sync_state WHERE user_key = ?", (user_key,)).fetchone()
+            except Exception as e:
+                print(f"⚠️ TimeSeriesStore: Lỗi đọc sync_state: {e}")
+                return None
+        return row[0] if row else None
+
+    def set_sync_state(self, user_key, watermark):
+        with self._lock:
+            conn = self._get_conn()
+            if conn is None:
+                return False
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO sync_state (user_key, watermark, synced_at) VALUES (?, ?, ?)",
+                    (user_key, int(watermark), time.time())
+                )
+                conn.commit()
+                return True
+            except Exception as e:
+                print(f"⚠️ TimeSeriesStore: Lỗi ghi sync_state: {e}")
+                return False
+
+    def _usable(self, user_key, row, date_iso):
+        if row is None:
+            return False
+        row_watermark = row[1]
+        if self.is_closed_day(date_iso, row_watermark):
+            return True
+        device_watermark = self._device_watermarks.get(user_key)
+        return row_watermark is not None and device_watermark is not None and row_watermark >= device_watermark
+
+    def fetch(self, client, method_name, date_iso, user_label="User"):
+        """
+        Đọc dữ liệu ngày từ store trước; nếu chưa có (hoặc đã cũ so với watermark thiết bị)
+        thì gọi `client.<method_name>(date_iso)` và lưu lại.
+        """
+        user_key = client_user_key(client)
+        metric = STORE_METRICS.get(method_name, method_name)
+        if user_key is None:
+            return getattr(client, method_name)(date_iso)
+
+        row = self._get_row(user_key, metric, date_iso)
+        if self._usable(user_key, row, date_iso):
+            print(f"[{user_label}] 💾 Store hit: {metric} {date_iso}")
+            return row[0]
+
+        data = getattr(client, method_name)(date_iso)
+
+        # Không biết watermark thiết bị thì không biết dữ liệu đã đủ chưa, không lưu
+        if data and user_key in self._device_watermarks:
+            self.put(user_key, metric, date_iso, data, watermark=self._device_watermarks[user_key])
+        return data
+
+    def put_activities(self, user_key, activities, start_iso, end_iso, watermark=None):
+        """
+        Tách danh sách activity theo ngày (startTimeLocal) và ghi từng ngày trong khoảng,
+        kể cả ngày không có activity (list rỗng). Không có watermark thì không ghi.
+        """
+        if watermark is None:
+            return
+        by_day = {day: [] for day in _iter_days(start_iso, end_iso)}
+        for act in activities or []:
+            day = (act.get("startTimeLocal") or "")[:10]
+            if day in by_day:
+                by_day[day].append(act)
+
+        for day, acts in by_day.items():
+            self.put(user_key, ACTIVITIES_METRIC, day, acts, watermark=watermark)
+
+    def fetch_activities(self, client, start_iso, end_iso, user_label="User"):
+        """
+        Tương đương `client.get_activities_by_date(start, end, "")` nhưng chỉ gọi Garmin
+        cho đoạn ngày chưa có trong store.
+        """
+        user_key = client_user_key(client)
+        if user_key is None:
+            return client.get_activities_by_date(start_iso, end_iso, "")
+
+        days = _iter_days(start_iso, end_iso)
+        cached = []
+        first_missing = None
+        for day in days:
+            row = self._get_row(user_key, ACTIVITIES_METRIC, day)
+            if not self._usable(user_key, row, day):
+                first_missing = day
+                break
+            cached.extend(row[0])
+
+        if first_missing is None:
+            print(f"[{user_label}] 💾 Store hit: activities {start_iso} → {end_iso}")
+            fetched = []
+        else:
+            fetched = client.get_activities_by_date(first_missing, end_iso, "") or []
+            self.put_activities(user_key, fetched, first_missing, end_iso, watermark=self._device_watermarks.get(user_key))
+
+        merged = cached + list(fetched)
+        merged.sort(key=lambda a: a.get("startTimeLocal") or "", reverse=True)
+        return merged
+
+def _iter_days(start_iso, end_iso):
+    start = datetime.strptime(start_iso, "%Y-%m-%d").date()
+    end = datetime.strptime(end_iso, "%Y-%m-%d").date()
+    return [(start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+
+# Khởi tạo Global Instance
+timeseries_store = TimeSeriesStore()
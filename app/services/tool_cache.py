@@ -0,0 +1,106 @@
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+import pytz
+from app.config import Config
+from app.services.redis_service import redis_service
+
+VN_TZ = pytz.timezone('Asia/Ho_Chi_Minh')
+
+# Tham số chỉ ảnh hưởng tới bản tóm tắt của MODEL_WORKER; có / không có `task` vẫn đổi độ phân giải
+# dữ liệu thô (có task thì time-series bị giảm mẫu theo SERIES_POINT_BUDGET) nên khóa ghi nhận điều đó
+SUMMARY_ONLY_ARGS = {"task"}
+DATE_ARGS = ("date", "start_date", "end_date")
+
+def _normalize_arg(name, value):
+    if isinstance(value, str):
+        value = value.strip()
+        if name in ("start_time", "end_time") and ":" in value:
+            try:
+                hour, minute = value.split(":")[:2]
+                return f"{int(hour):02d}:{int(minute):02d}"
+            except ValueError:
+                return value
+    return value
+
+class ToolResultCache:
+    """
+    Cache kết quả tool của /ask agent: LRU trong process đứng trước Redis.
+    Khóa gồm (user, tool, args đã chuẩn hóa, watermark đồng bộ thiết bị), nên khi
+    thiết bị upload dữ liệu mới thì cache tự động không còn khớp.
+    Mỗi entry giữ JSON thô từ Garmin và các bản tóm tắt của MODEL_WORKER theo `task`.
+    """
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or Config.TOOL_CACHE_MAX_ENTRIES
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "raw_hits": 0, "misses": 0}
+
+    @staticmethod
+    def make_key(user_key, tool_name, args, watermark):
+        normalized = {
+            k: _normalize_arg(k, v) for k, v in sorted((args or {}).items())
+            if k not in SUMMARY_ONLY_ARGS and v not in (None, "")
+        }
+        normalized["_payload"] = "worker" if (args or {}).get("task") else "full"
+        digest = hashlib.sha1(json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+        return f"tool_cache:{user_key}:{tool_name}:{digest}:{watermark or 0}"
+
+    @staticmethod
+    def ttl_for(args, today_iso=None):
+        """
+        TTL theo ngày của dữ liệu: ngày đã qua giữ lâu, hôm nay (hoặc tương lai) giữ ngắn.
+        """
+        today_iso = today_iso or datetime.now(VN_TZ).strftime("%Y-%m-%d")
+        dates = [str(args.get(k)) for k in DATE_ARGS if args and args.get(k)]
+        if not dates:
+            return Config.TOOL_CACHE_TTL_DEFAULT
+        if all(d < today_iso for d in dates):
+            return Config.TOOL_CACHE_TTL_PAST
+        return Config.TOOL_CACHE_TTL_TODAY
+
+    def get(self, key):
+        with self._lock:
+            item = self._lru.get(key)
+            if item is not None:
+                expires_at, entry = item
+                if expires_at > time.time():
+                    self._lru.move_to_end(key)
+                    return entry
+                del self._lru[key]
+
+        entry = redis_service.get_cache(key)
+        if entry is not None:
+            # Redis không trả TTL còn lại ở đây, giữ tạm trong LRU với TTL ngắn nhất
+            self._remember(key, entry, Config.TOOL_CACHE_TTL_TODAY)
+        return entry
+
+    def set(self, key, entry, ttl_seconds):
+        self._remember(key, entry, ttl_seconds)
+        redis_service.set_cache(key, entry, ttl_seconds)
+
+    def _remember(self, key, entry, ttl_seconds):
+        with self._lock:
+            self._lru[key] = (time.time() + ttl_seconds, entry)
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+
+    def record(self, outcome):
+        """
+        Ghi nhận kết quả tra cache: "hits" (có sẵn tóm tắt), "raw_hits" (chỉ có dữ liệu thô), "misses".
+        """
+        self.stats[outcome] += 1
+        redis_service.incr_counter(f"tool_cache:stats:{outcome}")
+
+    def hit_rate(self):
+        total = sum(self.stats.values())
+        if total == 0:
+            return 0.0
+        return (self.stats["hits"] + self.stats["raw_hits"]) / total
+
+# Khởi tạo Global Instance
+tool_cache = ToolResultCache()
@@ -0,0 +1,137 @@
+import os
+import json
+import base64
+import hashlib
+import threading
+from app.config import Config
+from app.services.redis_service import redis_service
+
+class TTSCache:
+    """
+    Cache audio TTS theo nội dung: khóa = sha256(text, voice, model).
+    Lưu voice note đã encode xuống đĩa (LRU theo mtime, giới hạn tổng dung lượng)
+    và thêm vào Redis (base64) với các clip nhỏ để chia sẻ giữa các lần chạy CI.
+    """
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir if cache_dir is not None else Config.TTS_CACHE_DIR
+        self.max_bytes = max_bytes if max_bytes is not None else Config.TTS_CACHE_MAX_BYTES
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        self.stats = {"hits": 0, "redis_hits": 0, "misses": 0}
+
+    @staticmethod
+    def make_key(text, voice, model):
+        payload = json.dumps([text or "", voice or "", model or ""], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.clip")
+
+    @staticmethod
+    def _serialize(clip):
+        header = {k: v for k, v in clip.items() if k != "data"}
+        return json.dumps(header, ensure_ascii=False).encode("utf-8") + b"\n" + clip["data"]
+
+    @staticmethod
+    def _deserialize(blob):
+        header, data = blob.split(b"\n", 1)
+        clip = json.loads(header.decode("utf-8"))
+        clip["data"] = data
+        return clip
+
+    def _scan_total(self):
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".clip"):
+                total += entry.stat().st_size
+        return total
+
+    def get(self, key):
+        """
+        Trả về clip đã cache (dict như encode_voice_note) hoặc None.
+        """
+        if not self.cache_dir:
+            return None
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                clip = self._deserialize(f.read())
+            # Đánh dấu vừa dùng cho LRU
+            os.utime(path, None)
+            self.stats["hits"] += 1
+            return clip
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ TTSCache: Lỗi đọc {path}: {e}")
+
+        cached = redis_service.get_cache(f"tts_cache:{key}")
+        if cached:
+            try:
+                clip = dict(cached, data=base64.b64decode(cached["data"]))
+                self.stats["redis_hits"] += 1
+                self._write_disk(key, clip)
+                return clip
+            except Exception as e:
+                print(f"⚠️ TTSCache: Dữ liệu Redis hỏng: {e}")
+
+        self.stats["misses"] += 1
+        return None
+
+    def set(self, key, clip):
+        if not clip or not clip.get("data"):
+            return
+        self._write_disk(key, clip)
+        if len(clip["data"]) <= Config.TTS_CACHE_REDIS_MAX_BYTES:
+            redis_value = dict(clip, data=base64.b64encode(clip["data"]).decode("ascii"))
+            redis_service.set_cache(f"tts_cache:{key}", redis_value, Config.TTS_CACHE_REDIS_TTL)
+
+    def _write_disk(self, key, clip):
+        if not self.cache_dir:
+            return
+        blob = self._serialize(clip)
+        if len(blob) > self.max_bytes:
+            return
+
+        with self._lock:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                if self._total_bytes is None:
+                    self._total_bytes = self._scan_total()
+
+                path = self._path(key)
+                previous = os.path.getsize(path) if os.path.exists(path) else 0
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(blob)
+                os.replace(tmp_path, path)
+                self._total_bytes += len(blob) - previous
+
+                if self._total_bytes > self.max_bytes:
+                    self._evict(keep=path)
+            except Exception as e:
+                print(f"⚠️ TTSCache: Lỗi ghi cache: {e}")
+
+    def _evict(self, keep=None):
+        """
+        Xóa các clip ít được dùng gần đây nhất cho tới khi tổng dung lượng dưới giới hạn.
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".clip") and entry.path != keep:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        for _, size, path in entries:
+            if self._total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self._total_bytes -= size
+            except FileNotFoundError:
+                pass
+
+# Khởi tạo Global Instance
+tts_cache = TTSCache()
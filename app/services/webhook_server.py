@@ -0,0 +1,216 @@
+import hmac
+import json
+import ipaddress
+import signal
+import asyncio
+import itertools
+from app.config import Config
+
+# Các mode nhận qua webhook (giống client_payload.mode của repository_dispatch)
+SERVE_MODES = {"daily", "daily_report", "sleep_analysis", "workout", "battery", "ask", "sync"}
+
+HTTP_REASONS = {
+    200: "OK", 202: "Accepted", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 408: "Request Timeout", 413: "Payload Too Large"
+}
+
+def parse_dispatch_payload(payload):
+    """
+    Chuẩn hóa payload webhook: nhận cả dạng phẳng {mode, user_id, question} lẫn dạng
+    repository_dispatch {event_type, client_payload: {...}}. Trả về (mode, user_id, question)
+    hoặc ném ValueError nếu không hợp lệ.
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("payload phải là JSON object")
+    if isinstance(payload.get("client_payload"), dict):
+        payload = payload["client_payload"]
+
+    mode = str(payload.get("mode") or "").strip()
+    if mode not in SERVE_MODES:
+        raise ValueError(f"mode không hợp lệ: {mode or '(trống)'}")
+
+    user_id = payload.get("user_id")
+    user_id = str(user_id).strip() if user_id not in (None, "") else None
+    question = payload.get("question")
+    question = str(question) if question not in (None, "") else None
+    return mode, user_id, question
+
+def is_loopback(host):
+    """
+    True nếu `host` chỉ nhận kết nối từ chính máy này ("" / 0.0.0.0 là mọi interface).
+    """
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+class WebhookServer:
+    """
+    HTTP server tối giản (asyncio.start_server) chạy thường trực thay cho GitHub Actions:
+    nhận cùng payload với repository_dispatch tại POST /dispatch, trả 202 ngay và chạy
+    `dispatch(mode, user_id, question)` trong process (session Garmin, prompts, client đã "ấm").
+    GET /health trả trạng thái. Nếu có `secret`, request phải gửi `Authorization: Bearer <secret>`.
+    Không có secret thì chỉ được nghe trên địa chỉ loopback và không nhận lệnh chạy cho mọi user (thiếu user_id).
+    """
+    def __init__(self, dispatch, host=None, port=None, secret=None, max_body=None, read_timeout=10.0):
+        self.dispatch = dispatch
+        self.host = host if host is not None else Config.SERVE_HOST
+        self.port = port if port is not None else Config.SERVE_PORT
+        self.secret = secret if secret is not None else Config.SERVE_SECRET
+        self.max_body = max_body if max_body is not None else Config.SERVE_MAX_BODY
+        self.read_timeout = read_timeout
+        self._server = None
+        self._jobs = set()
+        self._job_ids = itertools.count(1)
+        self.stats = {"accepted": 0, "completed": 0, "failed": 0, "rejected": 0}
+
+    async def start(self):
+        if not self.secret and not is_loopback(self.host):
+            raise RuntimeError(f"Không chạy webhook server trên {self.host} khi chưa đặt SERVE_SECRET.")
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # port=0 → lấy cổng thật hệ điều hành cấp
+        self.port = self._server.sockets[0].getsockname()[1]
+        print(f"🌐 Webhook server đang nghe tại http://{self.host}:{self.port} (POST /dispatch, GET /health)")
+        return self
+
+    async def close(self, drain_timeout=None):
+        """
+        Ngừng nhận request mới và chờ các job đang chạy (tối đa `drain_timeout` giây).
+        """
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._jobs:
+            print(f"⏳ Chờ {len(self._jobs)} job đang chạy...")
+            await asyncio.wait(list(self._jobs), timeout=drain_timeout)
+
+    async def serve_forever(self):
+        """
+        Chạy tới khi nhận SIGINT/SIGTERM rồi đóng server một cách êm.
+        """
+        await self.start()
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        await stop.wait()
+        print("🛑 Đang tắt webhook server...")
+        await self.close(drain_timeout=Config.SERVE_DRAIN_TIMEOUT)
+
+    def _authorized(self, headers):
+        if not self.secret:
+            return True
+        supplied = headers.get("authorization", "")
+        if supplied.lower().startswith("bearer "):
+            supplied = supplied[7:].strip()
+        return hmac.compare_digest(supplied.encode(), self.secret.encode())
+
+    async def _run_job(self, job_id, mode, user_id, question):
+        label = f"job #{job_id} {mode}" + (f" user={user_id}" if user_id else "")
+        print(f"▶️ Bắt đầu {label}")
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            await self.dispatch(mode, user_id, question)
+            self.stats["completed"] += 1
+            print(f"✅ Xong {label} sau {loop.time() - started:.1f}s")
+        except Exception as e:
+            self.stats["failed"] += 1
+            print(f"❌ Lỗi {label}: {e}")
+
+    def submit(self, mode, user_id=None, question=None):
+        job_id = next(self._job_ids)
+        task = asyncio.create_task(self._run_job(job_id, mode, user_id, question))
+        self._jobs.add(task)
+        task.add_done_callback(self._jobs.discard)
+        self.stats["accepted"] += 1
+        return job_id
+
+    async def _route(self, method, path, headers, body):
+        path = path.split("?", 1)[0]
+        if path == "/health":
+            if method != "GET":
+                return 405, {"error": "method not allowed"}
+            return 200, {"ok": True, "running": len(self._jobs), **self.stats}
+
+        if path not in ("/dispatch", "/"):
+            return 404, {"error": "not found"}
+        if method != "POST":
+            return 405, {"error": "method not allowed"}
+        if not self._authorized(headers):
+            self.stats["rejected"] += 1
+            return 401, {"error": "unauthorized"}
+        try:
+            mode, user_id, question = parse_dispatch_payload(json.loads(body or b"{}"))
+        except ValueError as e:
+            self.stats["rejected"] += 1
+            return 400, {"error": str(e)}
+        if user_id is None and not self.secret:
+            # Chạy cho mọi user chỉ được phép khi request đã xác thực bằng secret
+            self.stats["rejected"] += 1
+            return 403, {"error": "thiếu user_id (chạy cho mọi user cần SERVE_SECRET)"}
+
+        job_id = self.submit(mode, user_id, question)
+        return 202, {"accepted": True, "job_id": job_id, "mode": mode, "user_id": user_id}
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        parts = request_line.decode("latin-1").split()
+        if len(parts) < 2:
+            raise ValueError("request line không hợp lệ")
+        method, path = parts[0].upper(), parts[1]
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length") or 0)
+        if length > self.max_body:
+            return method, path, headers, None
+        body = await reader.readexactly(length) if length else b""
+        return method, path, headers, body
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                request = await asyncio.wait_for(self._read_request(reader), self.read_timeout)
+                if request is None:
+                    return
+                method, path, headers, body = request
+                if body is None:
+                    status, payload = 413, {"error": "payload too large"}
+                else:
+                    status, payload = await self._route(method, path, headers, body)
+            except asyncio.TimeoutError:
+                status, payload = 408, {"error": "request timeout"}
+            except (ValueError, asyncio.IncompleteReadError) as e:
+                status, payload = 400, {"error": f"bad request: {e}"}
+
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}\r\n"
+                f"Content-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"Connection: close\r\n\r\n".encode("latin-1") + data
+            )
+            await writer.drain()
+        except Exception as e:
+            print(f"⚠️ Webhook server: Lỗi xử lý kết nối: {e}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
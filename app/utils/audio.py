@@ -0,0 +1,102 @@
+import io
+import shutil
+import struct
+import subprocess
+from typing import Optional, Dict
+from app.config import Config
+
+def parse_audio_mime_type(mime_type: str) -> Dict[str, Optional[int]]:
+    """Parses bits per sample and rate from an audio MIME type string."""
+    bits_per_sample = 16
+    rate = 24000
+    parts = mime_type.split(";")
+    for param in parts:
+        param = param.strip()
+        if param.lower().startswith("rate="):
+            try:
+                rate_str = param.split("=", 1)[1]
+                rate = int(rate_str)
+            except (ValueError, IndexError):
+                pass
+        elif param.startswith("audio/L"):
+            try:
+                bits_per_sample = int(param.split("L", 1)[1])
+            except (ValueError, IndexError):
+                pass
+    return {"bits_per_sample": bits_per_sample, "rate": rate}
+
+def convert_to_wav(audio_data: bytes, mime_type: str) -> bytes:
+    """Generates a WAV file header for the given audio data and parameters."""
+    parameters = parse_audio_mime_type(mime_type)
+    bits_per_sample = parameters["bits_per_sample"]
+    sample_rate = parameters["rate"]
+    num_channels = 1
+    data_size = len(audio_data)
+    bytes_per_sample = bits_per_sample // 8
+    block_align = num_channels * bytes_per_sample
+    byte_rate = sample_rate * block_align
+    chunk_size = 36 + data_size
+
+    header = struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", chunk_size, b"WAVE", b"fmt ", 16, 1, num_channels,
+        sample_rate, byte_rate, block_align, bits_per_sample, b"data", data_size
+    )
+    return header + audio_data
+
+def ffmpeg_path():
+    """
+    Đường dẫn ffmpeg (Config.FFMPEG_PATH hoặc tìm trong PATH). None nếu không có.
+    """
+    return Config.FFMPEG_PATH or shutil.which("ffmpeg")
+
+def pcm_to_ogg_opus(audio_data: bytes, mime_type: str) -> Optional[bytes]:
+    """
+    Encode PCM (L16 mono) sang Opus trong container OGG bằng cách pipe qua ffmpeg,
+    hoàn toàn trong bộ nhớ. Trả về None nếu không có ffmpeg hoặc encode lỗi.
+    """
+    binary = ffmpeg_path()
+    if not binary:
+        return None
+
+    parameters = parse_audio_mime_type(mime_type)
+    if parameters["bits_per_sample"] != 16:
+        return None
+
+    command = [
+        binary, "-hide_banner", "-loglevel", "error",
+        "-f", "s16le", "-ar", str(parameters["rate"]), "-ac", "1", "-i", "pipe:0",
+        "-c:a", "libopus", "-b:a", Config.VOICE_NOTE_BITRATE, "-application", "voip",
+        "-f", "ogg", "pipe:1"
+    ]
+    try:
+        result = subprocess.run(command, input=bytes(audio_data), capture_output=True, timeout=60)
+    except Exception as e:
+        print(f"⚠️ Lỗi chạy ffmpeg: {e}")
+        return None
+    if result.returncode != 0 or not result.stdout:
+        print(f"⚠️ ffmpeg encode Opus lỗi: {result.stderr.decode('utf-8', 'ignore').strip()[:200]}")
+        return None
+    return result.stdout
+
+def encode_voice_note(audio_data: bytes, mime_type: str) -> Dict:
+    """
+    Đóng gói PCM thành voice note trong bộ nhớ: OGG/Opus (định dạng voice của Telegram)
+    nếu có ffmpeg, ngược lại là WAV. Trả về dict {data, filename, mime_type, duration}.
+    """
+    parameters = parse_audio_mime_type(mime_type)
+    bytes_per_second = parameters["rate"] * (parameters["bits_per_sample"] // 8)
+    duration = int(round(len(audio_data) / bytes_per_second)) if bytes_per_second else None
+
+    ogg_data = pcm_to_ogg_opus(audio_data, mime_type)
+    if ogg_data:
+        return {"data": ogg_data, "filename": "voice.ogg", "mime_type": "audio/ogg", "duration": duration}
+    return {"data": convert_to_wav(audio_data, mime_type), "filename": "voice.wav", "mime_type": "audio/wav", "duration": duration}
+
+def as_upload(clip: Dict) -> io.BytesIO:
+    """
+    Bọc voice note thành file-like object có tên để upload lên Telegram.
+    """
+    buffer = io.BytesIO(clip["data"])
+    buffer.name = clip["filename"]
+    return buffer
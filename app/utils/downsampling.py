@@ -0,0 +1,114 @@
+import numpy as np
+
+def _all_indices(n):
+    return np.arange(n, dtype=np.int64)
+
+def lttb(x, y, budget):
+    """
+    Largest-Triangle-Three-Buckets: giữ `budget` điểm sao cho hình dạng đồ thị
+    (đỉnh, đáy, điểm gãy) được bảo toàn tốt nhất. Trả về mảng index đã sắp xếp.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if budget >= n or n <= 2:
+        return _all_indices(n)
+    if budget < 3:
+        return np.array([0, n - 1][:max(budget, 1)], dtype=np.int64)
+
+    # Điểm đầu/cuối luôn giữ, phần giữa chia đều thành budget - 2 bucket
+    edges = np.linspace(1, n - 1, budget - 1).astype(np.int64)
+    selected = np.empty(budget, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    prev = 0
+    for b in range(budget - 2):
+        start, end = edges[b], max(edges[b + 1], edges[b] + 1)
+        # Trung bình của bucket kế tiếp làm đỉnh thứ 3 của tam giác
+        if b + 2 < len(edges):
+            nxt_start, nxt_end = edges[b + 1], max(edges[b + 2], edges[b + 1] + 1)
+        else:
+            nxt_start, nxt_end = n - 1, n
+        avg_x = x[nxt_start:nxt_end].mean()
+        avg_y = y[nxt_start:nxt_end].mean()
+
+        area = np.abs(
+            (x[prev] - avg_x) * (y[start:end] - y[prev])
+            - (x[prev] - x[start:end]) * (avg_y - y[prev])
+        )
+        prev = start + int(np.argmax(area))
+        selected[b + 1] = prev
+    return selected
+
+def minmax_buckets(x, y, budget):
+    """
+    Chia chuỗi thành budget/2 bucket, mỗi bucket giữ điểm thấp nhất và cao nhất
+    (theo đúng thứ tự thời gian). Không bao giờ làm mất đỉnh/đáy.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if budget >= n or n <= 2:
+        return _all_indices(n)
+    if budget < 4:
+        return lttb(x, y, budget)
+
+    # Trừ 2 chỗ cho điểm đầu/cuối để tổng số điểm không vượt budget
+    buckets = max((budget - 2) // 2, 1)
+    edges = np.linspace(0, n, buckets + 1).astype(np.int64)
+    picked = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end <= start:
+            continue
+        chunk = y[start:end]
+        picked.append(start + int(np.argmin(chunk)))
+        picked.append(start + int(np.argmax(chunk)))
+    picked.extend([0, n - 1])
+    return np.unique(np.asarray(picked, dtype=np.int64))
+
+def change_only(y, tolerance=0):
+    """
+    Chỉ giữ các điểm mà giá trị thay đổi nhiều hơn `tolerance` so với điểm được giữ
+    gần nhất (run-length), luôn giữ điểm đầu và cuối. Phù hợp cho chuỗi có nhiều đoạn phẳng.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if n <= 2:
+        return _all_indices(n)
+    if tolerance <= 0:
+        keep = np.flatnonzero(np.diff(y) != 0) + 1
+        return np.unique(np.concatenate(([0], keep, [n - 1])))
+
+    keep = [0]
+    last = y[0]
+    for i in range(1, n - 1):
+        if abs(y[i] - last) > tolerance:
+            keep.append(i)
+            last = y[i]
+    keep.append(n - 1)
+    return np.asarray(keep, dtype=np.int64)
+
+def _change_then_lttb(x, y, budget):
+    idx = change_only(y)
+    if len(idx) > budget:
+        idx = idx[lttb(np.asarray(x)[idx], np.asarray(y)[idx], budget)]
+    return idx
+
+DOWNSAMPLERS = {
+    "lttb": lttb,
+    "minmax": minmax_buckets,
+    "change": _change_then_lttb,
+}
+
+def downsample(x, y, budget, method="lttb"):
+    """
+    Giảm chuỗi (x, y) về tối đa `budget` điểm bằng thuật toán `method`
+    ("lttb", "minmax", "change"). Trả về mảng index (tăng dần) của các điểm được giữ.
+    budget <= 0 nghĩa là không giảm.
+    """
+    n = len(y)
+    if not budget or budget <= 0 or n <= budget:
+        return _all_indices(n)
+    func = DOWNSAMPLERS.get(method)
+    if func is None:
+        raise ValueError(f"Unknown downsampler: {method}")
+    return np.asarray(func(x, y, budget), dtype=np.int64)
@@ -0,0 +1,241 @@
+import numpy as np
+
+# Ngưỡng Stress theo thang Garmin
+STRESS_ZONES = [
+    ("Nghỉ ngơi (0-25)", 0, 26),
+    ("Thấp (26-50)", 26, 51),
+    ("Trung bình (51-75)", 51, 76),
+    ("Cao (76-100)", 76, 101),
+]
+
+# Dải nhịp tim thô (bpm) khi không có thông tin Max HR cá nhân
+HEART_RATE_ZONES = [
+    ("Dưới 70 bpm", 0, 70),
+    ("70-109 bpm", 70, 110),
+    ("110-139 bpm", 110, 140),
+    ("Từ 140 bpm", 140, 1000),
+]
+
+BODY_BATTERY_ZONES = [
+    ("Thấp (0-25)", 0, 26),
+    ("Trung bình (26-50)", 26, 51),
+    ("Khá (51-75)", 51, 76),
+    ("Cao (76-100)", 76, 101),
+]
+
+def _fmt(value):
+    value = float(value)
+    return str(int(round(value))) if abs(value - round(value)) < 0.05 else f"{value:.1f}"
+
+def _hhmm(minute):
+    minute = int(minute) % 1440
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+def _duration(minutes):
+    minutes = int(round(minutes))
+    return f"{minutes // 60}h{minutes % 60:02d}p" if minutes >= 60 else f"{minutes}p"
+
+def to_arrays(points, value_key="value"):
+    """
+    Chuyển output của filter_time_series ([{"time": "HH:MM", "value": v}, ...]) thành
+    (minutes, values) dạng NumPy, đã sắp xếp theo thời gian.
+    """
+    minutes = []
+    values = []
+    for p in points or []:
+        t = p.get("time")
+        v = p.get(value_key)
+        if not t or v is None:
+            continue
+        try:
+            h, m = t.split(":")[:2]
+            minutes.append(int(h) * 60 + int(m))
+            values.append(float(v))
+        except (ValueError, AttributeError):
+            continue
+    minutes = np.asarray(minutes, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    order = np.argsort(minutes, kind="stable")
+    return minutes[order], values[order]
+
+def sample_durations(minutes):
+    """
+    Thời lượng (phút) đại diện cho mỗi mẫu: khoảng cách tới mẫu kế tiếp,
+    giới hạn 3x chu kỳ lấy mẫu để không tính các khoảng mất dữ liệu.
+    """
+    if len(minutes) == 0:
+        return np.zeros(0)
+    if len(minutes) == 1:
+        return np.ones(1)
+    gaps = np.diff(minutes).astype(np.float64)
+    step = float(np.median(gaps[gaps > 0])) if np.any(gaps > 0) else 1.0
+    durations = np.append(gaps, step)
+    return np.clip(durations, 0, 3 * step)
+
+def rolling_window_means(minutes, values, window_minutes):
+    """
+    Trung bình theo cửa sổ thời gian bắt đầu tại mỗi mẫu. Trả về (means, end_idx).
+    """
+    csum = np.concatenate(([0.0], np.cumsum(values)))
+    end_idx = np.searchsorted(minutes, minutes + window_minutes, side="left")
+    counts = end_idx - np.arange(len(values))
+    means = (csum[end_idx] - csum[np.arange(len(values))]) / np.maximum(counts, 1)
+    return means, end_idx
+
+def window_deltas(minutes, values, window_minutes):
+    """
+    Thay đổi giá trị trong vòng `window_minutes` kể từ mỗi mẫu. Trả về (deltas, end_idx).
+    """
+    end_idx = np.searchsorted(minutes, minutes + window_minutes, side="right") - 1
+    return values[end_idx] - values, end_idx
+
+def mean_shift_change_point(values):
+    """
+    Điểm chia tốt nhất thành 2 đoạn có trung bình khác nhau nhiều nhất (tối thiểu SSE).
+    Trả về (index, mean_before, mean_after) hoặc None.
+    """
+    n = len(values)
+    if n < 6:
+        return None
+    csum = np.cumsum(values)
+    total = csum[-1]
+    k = np.arange(2, n - 1)
+    left = csum[k - 1]
+    score = left ** 2 / k + (total - left) ** 2 / (n - k)
+    best = int(k[np.argmax(score)])
+    return best, float(values[:best].mean()), float(values[best:].mean())
+
+def time_in_zones(minutes, values, zones):
+    durations = sample_durations(minutes)
+    result = []
+    for name, low, high in zones:
+        mask = (values >= low) & (values < high)
+        result.append((name, float(durations[mask].sum())))
+    return result
+
+def describe_series(points, label, unit="", zones=None, window_minutes=30, value_key="value"):
+    """
+    Tóm tắt một chuỗi time-series thành khối text ngắn gọn cho MODEL_BRAIN:
+    min/max/trung bình, khung giờ cao/thấp nhất, biến động lớn nhất, điểm đổi xu hướng, thời gian theo vùng.
+    """
+    minutes, values = to_arrays(points, value_key)
+    if len(values) == 0:
+        return f"{label}: không có dữ liệu."
+
+    suffix = f" {unit}" if unit else ""
+    i_min = int(np.argmin(values))
+    i_max = int(np.argmax(values))
+    lines = [
+        f"{label}: {len(values)} mẫu ({_hhmm(minutes[0])}–{_hhmm(minutes[-1])})",
+        f"- Trung bình {_fmt(values.mean())}{suffix}, độ lệch chuẩn {_fmt(values.std())}",
+        f"- Thấp nhất {_fmt(values[i_min])}{suffix} lúc {_hhmm(minutes[i_min])}; cao nhất {_fmt(values[i_max])}{suffix} lúc {_hhmm(minutes[i_max])}",
+        f"- Đầu kỳ {_fmt(values[0])}{suffix} → cuối kỳ {_fmt(values[-1])}{suffix}",
+    ]
+
+    if len(values) >= 3 and minutes[-1] - minutes[0] > window_minutes:
+        means, end_idx = rolling_window_means(minutes, values, window_minutes)
+        valid = end_idx - np.arange(len(values)) >= 2
+        if np.any(valid):
+            masked_hi = np.where(valid, means, -np.inf)
+            masked_lo = np.where(valid, means, np.inf)
+            hi = int(np.argmax(masked_hi))
+            lo = int(np.argmin(masked_lo))
+            lines.append(
+                f"- Khung {window_minutes} phút cao nhất: {_hhmm(minutes[hi])}–{_hhmm(minutes[hi] + window_minutes)} (TB {_fmt(means[hi])}{suffix}); "
+                f"thấp nhất: {_hhmm(minutes[lo])}–{_hhmm(minutes[lo] + window_minutes)} (TB {_fmt(means[lo])}{suffix})"
+            )
+
+    if len(values) >= 2:
+        jumps = np.diff(values)
+        top = np.argsort(np.abs(jumps))[::-1][:3]
+        top = [int(i) for i in top if jumps[i] != 0]
+        if top:
+            parts = [f"{_hhmm(minutes[i])}→{_hhmm(minutes[i + 1])} ({'+' if jumps[i] > 0 else ''}{_fmt(jumps[i])})" for i in sorted(top)]
+            lines.append(f"- Biến động mạnh nhất giữa 2 mẫu: {', '.join(parts)}")
+
+    cp = mean_shift_change_point(values)
+    if cp and abs(cp[2] - cp[1]) >= max(values.std() * 0.5, 1e-9):
+        idx, before, after = cp
+        trend = "tăng" if after > before else "giảm"
+        lines.append(f"- Đổi xu hướng quanh {_hhmm(minutes[idx])}: TB {_fmt(before)} → {_fmt(after)}{suffix} ({trend})")
+
+    if zones:
+        zone_parts = [f"{name} {_duration(dur)}" for name, dur in time_in_zones(minutes, values, zones) if dur > 0]
+        if zone_parts:
+            lines.append(f"- Thời gian theo vùng: {', '.join(zone_parts)}")
+
+    return "\n".join(lines)
+
+def describe_body_battery(points, window_minutes=60):
+    """
+    Tóm tắt Body Battery, kèm khung sạc nhanh nhất / tụt nhanh nhất.
+    """
+    text = describe_series(points, "Body Battery", zones=BODY_BATTERY_ZONES, window_minutes=window_minutes)
+    minutes, values = to_arrays(points)
+    if len(values) < 2:
+        return text
+
+    deltas, end_idx = window_deltas(minutes, values, window_minutes)
+    extra = []
+    up = int(np.argmax(deltas))
+    if deltas[up] > 0:
+        extra.append(f"- Sạc nhanh nhất ({window_minutes} phút): {_hhmm(minutes[up])}–{_hhmm(minutes[end_idx[up]])} (+{_fmt(deltas[up])})")
+    down = int(np.argmin(deltas))
+    if deltas[down] < 0:
+        extra.append(f"- Tụt nhanh nhất ({window_minutes} phút): {_hhmm(minutes[down])}–{_hhmm(minutes[end_idx[down]])} ({_fmt(deltas[down])})")
+    return "\n".join([text] + extra)
+
+def describe_steps(entries):
+    """
+    Tóm tắt danh sách bước chân [{"time": "HH:MM", "steps": n, "activity_level": ...}].
+    """
+    minutes, steps = to_arrays(entries, value_key="steps")
+    if len(steps) == 0:
+        return "Bước chân: không có dữ liệu."
+
+    lines = [f"Bước chân: tổng {int(steps.sum())} bước trong {len(steps)} khoảng ghi nhận ({_hhmm(minutes[0])}–{_hhmm(minutes[-1])})"]
+
+    hours = minutes // 60
+    per_hour = np.bincount(hours, weights=steps, minlength=24)
+    top_hours = [int(h) for h in np.argsort(per_hour)[::-1][:3] if per_hour[h] > 0]
+    if top_hours:
+        lines.append("- Giờ đi nhiều nhất: " + ", ".join(f"{h:02d}:00 ({int(per_hour[h])} bước)" for h in top_hours))
+
+    i_max = int(np.argmax(steps))
+    lines.append(f"- Khoảng cao nhất: {_hhmm(minutes[i_max])} ({int(steps[i_max])} bước)")
+
+    levels = {}
+    for e in entries or []:
+        level = e.get("activity_level")
+        if level:
+            levels[level] = levels.get(level, 0) + 1
+    if levels:
+        lines.append("- Mức vận động: " + ", ".join(f"{k} {v} khoảng" for k, v in sorted(levels.items(), key=lambda kv: -kv[1])))
+    return "\n".join(lines)
+
+def summarize_tool_payload(tool_name, data):
+    """
+    Tóm tắt cục bộ cho các tool time-series lớn. Trả về None nếu tool không được hỗ trợ.
+    """
+    if tool_name == "get_heart_rates" and isinstance(data, dict):
+        header = (
+            f"Nhịp tim nghỉ {data.get('restingHeartRate')} | cao nhất ngày {data.get('maxHeartRate')} | "
+            f"thấp nhất ngày {data.get('minHeartRate')} (bpm)"
+        )
+        return header + "\n" + describe_series(data.get("heart_rate_readings"), "Nhịp tim", "bpm", zones=HEART_RATE_ZONES)
+
+    if tool_name == "get_stress_trend" and isinstance(data, dict):
+        header = f"Stress trung bình ngày: {data.get('average_stress')}"
+        return header + "\n" + describe_series(data.get("stress_readings"), "Stress", zones=STRESS_ZONES)
+
+    if tool_name == "get_body_battery_trend" and isinstance(data, dict):
+        header = f"Pin sạc vào +{data.get('charged')} | tiêu hao -{data.get('drained')}"
+        naps = data.get("naps") or []
+        if naps:
+            header += " | Ngủ trưa: " + ", ".join(f"{n.get('start_time')} ({n.get('duration_minutes')}p)" for n in naps)
+        return header + "\n" + describe_body_battery(data.get("body_battery_readings"))
+
+    if tool_name == "get_steps_trend" and isinstance(data, list):
+        return describe_steps(data)
+
+    return None
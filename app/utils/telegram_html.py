@@ -0,0 +1,255 @@
+import re
+import html
+
+# Giới hạn độ dài 1 tin nhắn Telegram (đơn vị UTF-16 như Telegram đếm)
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Các token inline: `code`, **, * và _ (mọi thứ còn lại là text thường)
+_INLINE_TOKEN = re.compile(r"`[^`\n]*`|\*\*|[*_]")
+_HAS_MARKER = re.compile(r"[*_`]")
+_HTML_TAG = re.compile(r"</?(?:b|i|code)>")
+
+def _units(text):
+    """
+    Độ dài theo cách Telegram đếm (UTF-16 code units: emoji tính 2).
+    """
+    return len(text.encode("utf-16-le")) // 2
+
+def _escape(text):
+    # Telegram chỉ yêu cầu escape &, <, >
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def _is_word(ch):
+    return ch.isalnum() or ch == "_"
+
+def _line_events(line):
+    """
+    Tách 1 dòng Markdown (đã escape) thành chuỗi sự kiện ("text", html) / ("open", tag) /
+    ("close", tag) trong một lượt quét. Cặp ký hiệu được ghép bằng stack nên thẻ luôn cân bằng và lồng đúng;
+    ký hiệu không có cặp giữ nguyên là text.
+    """
+    stripped = line.strip()
+    header = stripped.startswith("#")
+    if not header and not _HAS_MARKER.search(line):
+        return [("text", line)]
+    if header:
+        indent = line[:len(line) - len(line.lstrip())]
+        line = stripped.lstrip("#").strip()
+
+    tokens = []  # [kind, value]: kind là "text", "code" hoặc ký hiệu ("**", "*", "_")
+    pos = 0
+    for match in _INLINE_TOKEN.finditer(line):
+        if match.start() > pos:
+            tokens.append(["text", line[pos:match.start()]])
+        value = match.group()
+        if value[0] == "`":
+            tokens.append(["code", value[1:-1]] if len(value) > 2 else ["text", value])
+        else:
+            prev_ch = line[match.start() - 1] if match.start() > 0 else " "
+            next_ch = line[match.end()] if match.end() < len(line) else " "
+            tokens.append([value, (prev_ch, next_ch)])
+        pos = match.end()
+    if pos < len(line):
+        tokens.append(["text", line[pos:]])
+
+    # Ghép cặp: closer khớp opener cùng loại gần nhất, các opener nằm giữa thành text
+    pairs = {}
+    stack = []
+    for i, (kind, value) in enumerate(tokens):
+        if kind in ("text", "code"):
+            continue
+        prev_ch, next_ch = value
+        if kind == "**":
+            can_open = can_close = True
+        else:
+            can_open = not _is_word(prev_ch) and not next_ch.isspace()
+            can_close = not prev_ch.isspace() and not _is_word(next_ch)
+        opener = next((j for j in range(len(stack) - 1, -1, -1) if tokens[stack[j]][0] == kind), None) if can_close else None
+        if opener is not None and stack[opener] == i - 1:
+            # Cặp rỗng (****) giữ nguyên là text, Telegram không nhận thẻ rỗng
+            del stack[opener:]
+        elif opener is not None:
+            pairs[stack[opener]] = i
+            pairs[i] = None
+            del stack[opener:]
+        elif can_open:
+            stack.append(i)
+
+    events = []
+    bold_depth = 1 if header else 0
+    if header:
+        events.append(("text", indent))
+        events.append(("open", "b"))
+    for i, (kind, value) in enumerate(tokens):
+        if kind == "text":
+            events.append(("text", value))
+        elif kind == "code":
+            events.extend((("open", "code"), ("text", value), ("close", "code")))
+        elif i not in pairs:
+            events.append(("text", kind))
+        else:
+            tag = "i" if kind == "_" else "b"
+            closing = pairs[i] is None
+            if tag == "b":
+                # Không lồng <b> trong <b> (header, **a *b* c**)
+                if closing:
+                    bold_depth -= 1
+                    if bold_depth:
+                        continue
+                else:
+                    bold_depth += 1
+                    if bold_depth > 1:
+                        continue
+            events.append(("close" if closing else "open", tag))
+    if header:
+        events.append(("close", "b"))
+    return events
+
+def _render(events):
+    parts = []
+    for kind, value in events:
+        if kind == "text":
+            parts.append(value)
+        elif kind == "open":
+            parts.append(f"<{value}>")
+        else:
+            parts.append(f"</{value}>")
+    return "".join(parts)
+
+def markdown_to_telegram_html(text):
+    """
+    Chuyển Markdown cơ bản (header #, **bold**, *bold*, _italic_, `code`) sang HTML của Telegram
+    trong một lượt duyệt, escape &, <, > và luôn sinh thẻ cân bằng.
+    """
+    if not text:
+        return ""
+    # Escape cả văn bản 1 lần: &, <, > không trùng với ký hiệu Markdown nên không ảnh hưởng việc tách token
+    return "\n".join(_render(_line_events(line)) for line in _escape(text).split("\n"))
+
+def _split_long_line(events, limit):
+    """
+    Cắt 1 dòng quá dài thành nhiều đoạn HTML <= limit: đóng các thẻ đang mở ở cuối đoạn
+    và mở lại ở đầu đoạn sau, ưu tiên cắt ở khoảng trắng.
+    """
+    pieces = []
+    stack = []
+    current = []
+    size = 0
+
+    def closing():
+        return "".join(f"</{tag}>" for tag in reversed(stack))
+
+    def flush():
+        nonlocal current, size
+        pieces.append("".join(current) + closing())
+        current = [f"<{tag}>" for tag in stack]
+        size = _units("".join(current))
+
+    for kind, value in events:
+        if kind == "open":
+            tag = f"<{value}>"
+            if size + _units(tag) + _units(closing()) + len(value) + 3 > limit and size:
+                flush()
+            stack.append(value)
+            current.append(tag)
+            size += _units(tag)
+        elif kind == "close":
+            stack.pop()
+            current.append(f"</{value}>")
+            size += len(value) + 3
+        else:
+            rest = value
+            while rest:
+                remaining = limit - size - _units(closing())
+                if _units(rest) <= remaining:
+                    current.append(rest)
+                    size += _units(rest)
+                    break
+                cut = max(min(len(rest), remaining), 0)
+                while cut > 0 and _units(rest[:cut]) > remaining:
+                    cut -= 1
+                # Không cắt giữa entity (&amp; &lt; &gt;)
+                amp = rest.rfind("&", max(cut - 4, 0), cut)
+                if amp != -1 and ";" not in rest[amp:cut]:
+                    cut = amp
+                space = rest.rfind(" ", 0, cut)
+                if space > cut // 2:
+                    cut = space + 1
+                if cut == 0:
+                    if any(not part.startswith("<") for part in current):
+                        flush()
+                        continue
+                    cut = rest.find(";") + 1 if rest.startswith("&") else 1
+                piece = rest[:cut]
+                current.append(piece)
+                size += _units(piece)
+                rest = rest[cut:]
+                flush()
+    if current:
+        pieces.append("".join(current) + closing())
+    return [piece for piece in pieces if _HTML_TAG.sub("", piece).strip()]
+
+def _join_lines(lines):
+    start, end = 0, len(lines)
+    while start < end and not lines[start].strip():
+        start += 1
+    while end > start and not lines[end - 1].strip():
+        end -= 1
+    return "\n".join(lines[start:end])
+
+def render_telegram_chunks(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Chuyển Markdown sang HTML Telegram và chia thành các tin nhắn <= `limit`.
+    Ưu tiên cắt ở ranh giới đoạn (dòng trống), rồi tới ranh giới dòng; dòng quá dài mới
+    bị cắt giữa chừng (thẻ được đóng/mở lại). Mỗi đoạn trả về là HTML hợp lệ độc lập.
+    """
+    if not text:
+        return []
+
+    chunks = []
+    current = []
+    size = 0
+    paragraph_cut = None  # số dòng đầu của `current` kết thúc bằng dòng trống
+
+    def emit(lines):
+        chunk = _join_lines(lines)
+        if chunk:
+            chunks.append(chunk)
+
+    for line in _escape(text).split("\n"):
+        rendered = _render(events := _line_events(line))
+        length = _units(rendered)
+
+        if length > limit:
+            emit(current)
+            pieces = _split_long_line(events, limit)
+            chunks.extend(pieces[:-1])
+            current = pieces[-1:]
+            size = _units(current[0]) if current else 0
+            paragraph_cut = None
+            continue
+
+        if current and size + 1 + length > limit:
+            if paragraph_cut:
+                emit(current[:paragraph_cut])
+                current = current[paragraph_cut:]
+                size = _units("\n".join(current))
+                paragraph_cut = None
+            if current and size + 1 + length > limit:
+                emit(current)
+                current = []
+                size = 0
+
+        size += length + (1 if current else 0)
+        current.append(rendered)
+        if not line.strip():
+            paragraph_cut = len(current)
+
+    emit(current)
+    return chunks
+
+def html_to_plain(html_text):
+    """
+    Bỏ thẻ và giải mã entity để gửi lại dạng Plain Text khi Telegram từ chối HTML.
+    """
+    return html.unescape(_HTML_TAG.sub("", html_text))
@@ -0,0 +1,58 @@
+"""
+So sánh converter Markdown → HTML Telegram cũ (nhiều lượt regex) với bản 1 lượt
+trên báo cáo lớn. Chạy: python -m benchmarks.bench_telegram_html
+"""
+import re
+import html
+import time
+
+from app.utils.telegram_html import markdown_to_telegram_html, render_telegram_chunks
+
+def legacy_convert(text):
+    # Bản cũ của clean_and_convert_markdown_to_html (giữ nguyên để so sánh)
+    if not text:
+        return ""
+    escaped_text = html.escape(text)
+    lines = escaped_text.split("\n")
+    for i, line in enumerate(lines):
+        striped_line = line.strip()
+        if striped_line.startswith("#"):
+            indent = line[:len(line) - len(line.lstrip())]
+            cleaned = striped_line.lstrip("#").strip()
+            lines[i] = f"{indent}<b>{cleaned}</b>"
+    escaped_text = "\n".join(lines)
+    escaped_text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', escaped_text)
+    escaped_text = re.sub(r'(?<!\w)\*(?!\s)(.*?)(?<!\s)\*(?!\w)', r'<b>\1</b>', escaped_text)
+    escaped_text = re.sub(r'(?<!\w)_(?!\s)(.*?)(?<!\s)_(?!\w)', r'<i>\1</i>', escaped_text)
+    escaped_text = re.sub(r'`(.*?)`', r'<code>\1</code>', escaped_text)
+    return escaped_text
+
+SECTION = """## 🏃 Phân tích Buổi tập
+**Tổng quan:** Chạy 10.2 km, pace TB `5:12/km`, nhịp tim TB **152 bpm** (Zone 3).
+* Khởi động _ổn định_ trong 2 km đầu, HR < 140 & cadence 172 spm.
+* Km 6-8: pace nhanh dần, *HR drift* 6% → dấu hiệu mệt tích lũy.
+* Gợi ý: giữ **Zone 2** cho buổi sau, ngủ đủ 8h, bổ sung điện giải.
+
+"""
+
+def bench(func, text, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func(text)
+    return (time.perf_counter() - started) / repeat * 1000
+
+def main():
+    for sections in (10, 100, 1000):
+        report = SECTION * sections
+        repeat = max(3, 2000 // sections)
+        old_ms = bench(legacy_convert, report, repeat)
+        new_ms = bench(markdown_to_telegram_html, report, repeat)
+        chunk_ms = bench(render_telegram_chunks, report, repeat)
+        chunks = render_telegram_chunks(report)
+        print(
+            f"{len(report):>8} ký tự | cũ {old_ms:8.2f} ms | 1 lượt {new_ms:8.2f} ms | "
+            f"1 lượt + chia tin {chunk_ms:8.2f} ms ({len(chunks)} tin, dài nhất {max(len(c) for c in chunks)})"
+        )
+
+if __name__ == "__main__":
+    main()
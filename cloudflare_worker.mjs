@@ -258,7 +258,37 @@ async function sendMessage(env, chatId, text, replyMarkup = null, disableNotific
     }
 }
 
+async function triggerServer(env, mode, chatId, question = "") {
+    // Server Python thường trực (python main.py --mode serve): chạy ngay, không chờ runner GitHub Actions
+    const resp = await fetch(env.BOT_SERVER_URL, {
+        method: "POST",
+        headers: {
+            "Content-Type": "application/json",
+            ...(env.BOT_SERVER_SECRET ? { "Authorization": `Bearer ${env.BOT_SERVER_SECRET}` } : {})
+        },
+        body: JSON.stringify({ mode: mode, user_id: chatId, question: question })
+    });
+
+    if (resp.status !== 202) {
+        console.error("Bot Server Error Status:", resp.status);
+        console.error("Bot Server Error Body:", await resp.text());
+        return false;
+    }
+    return true;
+}
+
 async function triggerGitHub(env, mode, chatId, targetRepo, question = "") {
+    // Ưu tiên server thường trực nếu được cấu hình, lỗi thì quay về repository_dispatch
+    if (env.BOT_SERVER_URL && targetRepo !== "ueh") {
+        try {
+            if (await triggerServer(env, mode, chatId, question)) {
+                return true;
+            }
+        } catch (e) {
+            console.error("Bot Server unreachable:", e.message);
+        }
+    }
+
     // Route to correct repo
     let owner, repo;
     if (targetRepo === "ueh") {
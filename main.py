@@ -1,23 +1,28 @@
-import os
 import asyncio
 import argparse
-from datetime import date
+import contextvars
 import time
+import httpx
+from datetime import date
 import logging
 from dotenv import load_dotenv
-from garminconnect import Garmin
 
 # Tắt cảnh báo 429 từ garminconnect
 logging.getLogger("garminconnect").setLevel(logging.CRITICAL)
 
 # Import Services
-from app.services.notion_service import get_users_from_notion
+from app.services.notion_service import user_directory
 from app.services.garmin_service import get_processed_data, fetch_daily_activities_detailed, check_garmin_sync_status
 from app.services.ai_service import get_ai_advice, get_workout_analysis_advice, get_battery_analysis_advice, get_speech_script, generate_audio_from_text, get_customer_service_advice
-from app.services.prompt_service import get_prompts_from_notion
-from app.services.telegram_service import send_telegram_report, send_error_alert, send_progress_update
+from app.services.prompt_service import prompt_registry
+from app.services.telegram_service import send_telegram_report, send_error_alert, send_progress_update, send_voice_note, TelegramStreamingMessage, shutdown_telegram
 from app.services.weather_service import WeatherService
 from app.services.redis_service import redis_service
+from app.services.sync_service import sync_user
+from app.services.garmin_session import garmin_session_pool
+from app.services.llm_client import llm_clients
+from app.services.webhook_server import WebhookServer
+from app.services.job_queue import JobWorker, job_queue
 
 # --- CẤU HÌNH CHUNG ---
 from app.config import Config
@@ -27,58 +32,91 @@ TELE_ADMIN = Config.TELEGRAM_ADMIN_ID
 
 def login_garmin(email, password, name):
     """
-    Đăng nhập Garmin có check token cache để tránh 429 (Too Many Requests).
+    Lấy Garmin client đã đăng nhập từ session pool (tái sử dụng session/token, tránh 429).
     """
-    # Hỗ trợ lấy Token từ GitHub Secrets (môi trường CI/CD không lưu được file)
-    env_token_key = f"GARMINTOKENS_{email.replace('@', '_').replace('.', '_').upper()}"
-    token_string = os.getenv(env_token_key) or os.getenv("GARMINTOKENS")
-    
-    token_dir = os.path.join(os.getcwd(), "tokens", email)
-    os.makedirs(token_dir, exist_ok=True)
-    client = Garmin(email, password)
+    return garmin_session_pool.get_client(email, password, name)
+
+# Các task nền (Voice Note) đang chạy; main() chờ hết trước khi kết thúc
+background_tasks = set()
+# Task nền do lượt run_mode hiện tại tạo ra, để mỗi lượt chỉ chờ Voice Note của chính nó
+# (serve / worker chạy nhiều lượt song song trên cùng tập background_tasks)
+_run_background = contextvars.ContextVar("run_background", default=None)
+
+def spawn_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    scoped = _run_background.get()
+    if scoped is not None:
+        scoped.add(task)
+    return task
+
+async def drain_background_tasks(tasks=None):
+    """
+    Chờ các task nền: chỉ `tasks` nếu truyền vào (của 1 lượt run_mode), ngược lại toàn bộ process.
+    """
+    if tasks is not None:
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return
+    while background_tasks:
+        await asyncio.gather(*list(background_tasks), return_exceptions=True)
+
+# Semaphore dùng chung cả process theo tên (giới hạn MAX_CONCURRENT_USERS), tạo lại khi đổi event loop
+_limiters = {}
+
+def get_limiter(name):
+    loop = asyncio.get_running_loop()
+    entry = _limiters.get(name)
+    if entry is None or entry[0] is not loop:
+        entry = (loop, asyncio.Semaphore(max(1, Config.MAX_CONCURRENT_USERS)))
+        _limiters[name] = entry
+    return entry[1]
 
+async def produce_voice_note(ai_report, user_config, prompts, voice_mode, delay=0):
+    """
+    Viết Voice Script, tạo Audio rồi gửi Voice Note (chạy nền, không chặn báo cáo text).
+    """
+    name = user_config.get('name', 'Unknown')
+    tele_id = user_config.get('telegram_chat_id')
     try:
-        if token_string:
-            # Ghi token từ GitHub Secret ra file để garminconnect đọc
-            import base64
-            try:
-                # Ghi tạm chuỗi base64 gốc vào env để thư viện garminconnect tự xử lý (cách mới)
-                os.environ["GARMINTOKENS"] = token_string
-                client.login(tokenstore=token_string)
-                print(f"[{name}] ✅ Đăng nhập Garmin bằng Token từ GitHub Secrets thành công.")
-            except Exception as e1:
-                print(f"[{name}] ⚠️ Lỗi đọc trực tiếp token_string, thử decode ra file... {e1}")
-                # Cách cũ: decode và lưu thành file oauth1 và oauth2
-                import json
-                try:
-                    tokens = json.loads(base64.b64decode(token_string).decode('utf-8'))
-                    with open(os.path.join(token_dir, "oauth1_token.json"), "w") as f1:
-                        json.dump(tokens[0], f1)
-                    with open(os.path.join(token_dir, "oauth2_token.json"), "w") as f2:
-                        json.dump(tokens[1], f2)
-                    client.login(tokenstore=token_dir)
-                    print(f"[{name}] ✅ Đăng nhập Garmin bằng Token decode từ Secrets thành công.")
-                except Exception as e2:
-                    print(f"[{name}] ⚠️ Lỗi decode token: {e2}. Chuyển sang password.")
-                    raise e2
-        else:
-            client.login(tokenstore=token_dir)
-            print(f"[{name}] ✅ Đăng nhập Garmin bằng Token bảo lưu thành công.")
+        if delay:
+            await asyncio.sleep(delay)
+        # Voice Note chạy nền nhưng vẫn chung giới hạn MAX_CONCURRENT_USERS (Gemini TTS có rate limit)
+        async with get_limiter("voice"):
+            voice_template = prompts.get("voice_script")
+            speech_script = await asyncio.to_thread(get_speech_script, ai_report, user_config, prompt_template=voice_template, mode=voice_mode)
+            audio_clip = await generate_audio_from_text(speech_script)
+            if audio_clip:
+                await send_voice_note(TELE_TOKEN, tele_id, audio_clip, name)
     except Exception as e:
-        print(f"[{name}] ℹ️ Không dùng được Token. Chuyển sang đăng nhập Password...")
-        client.login()
-        try:
-            os.makedirs(token_dir, exist_ok=True)
-            client.garth.dump(token_dir)
-            print(f"[{name}] ✅ Đăng nhập Garmin thành công & đã lưu Token mới.")
-        except Exception as save_err:
-            print(f"[{name}] ⚠️ Lỗi lưu Token: {save_err}")
-    return client
+        print(f"[{name}] ⚠️ Lỗi tạo Voice Note: {e}")
 
+async def deliver_report(user_config, ai_report, prompts, voice_mode, stream_msg=None, voice_delay=0):
+    """
+    Gửi báo cáo text ngay khi có, sau đó tạo Voice Note ở nền.
+    """
+    name = user_config.get('name', 'Unknown')
+    tele_id = user_config.get('telegram_chat_id')
+    if not tele_id:
+        print(f"[{name}] ⚠️ Không có Chat ID, không gửi tin.")
+        return None
+
+    await send_telegram_report(TELE_TOKEN, ai_report, tele_id, name, None, stream_message=stream_msg)
+    return spawn_background(produce_voice_note(ai_report, user_config, prompts, voice_mode, delay=voice_delay))
+
+def start_report_stream(tele_id, name):
+    """
+    Tạo tin nhắn Telegram hiển thị báo cáo AI theo thời gian thực (nếu bật REPORT_STREAMING).
+    """
+    if tele_id and TELE_TOKEN and Config.REPORT_STREAMING:
+        return TelegramStreamingMessage(TELE_TOKEN, tele_id, name).start()
+    return None
 
-async def handle_daily_or_sleep(user_config, mode, prompts, user_note=None):
+
+async def handle_daily_or_sleep(user_config, mode, prompts, user_note=None, aqi_data=None, raise_errors=False):
     """
     Xử lý báo cáo hàng ngày (Daily) hoặc phân tích giấc ngủ (Sleep Analysis).
+    `raise_errors=True` (mode worker): lỗi được ném lại sau khi dọn dẹp để hàng đợi retry / dead-letter.
     """
     name = user_config.get('name', 'Unknown')
     email = user_config.get('email')
@@ -94,13 +132,13 @@ async def handle_daily_or_sleep(user_config, mode, prompts, user_note=None):
     date_iso = today.isoformat()
 
     if tele_id:
-        if redis_service.is_rate_limited(tele_id, mode):
+        if await asyncio.to_thread(redis_service.is_rate_limited, tele_id, mode):
             msg = "⚠️ Bạn đã yêu cầu quá nhanh. Vui lòng thử lại sau 10 phút."
             print(f"[{name}] {msg}")
             await send_telegram_report(TELE_TOKEN, msg, tele_id, name, None)
             return
 
-        if not redis_service.check_and_set_dedup(tele_id, date_iso, mode):
+        if not await asyncio.to_thread(redis_service.check_and_set_dedup, tele_id, date_iso, mode):
             msg = f"⛔ Báo cáo {mode} của bạn đã được gửi trong 1 giờ qua. Vui lòng đợi 1 tiếng giữa các yêu cầu."
             print(f"[{name}] {msg}")
             await send_telegram_report(TELE_TOKEN, msg, tele_id, name, None)
@@ -108,16 +146,16 @@ async def handle_daily_or_sleep(user_config, mode, prompts, user_note=None):
     # ------------------------------------
 
     try:
-        client = login_garmin(email, password, name)
+        client = await asyncio.to_thread(login_garmin, email, password, name)
 
         # --- FRESHNESS CHECK ---
-        is_fresh, fresh_msg = check_garmin_sync_status(client, max_age_hours=1.0, user_label=name)
+        is_fresh, fresh_msg = await asyncio.to_thread(check_garmin_sync_status, client, max_age_hours=1.0, user_label=name)
         if not is_fresh:
             print(f"[{name}] ⛔ {fresh_msg}")
             if tele_id:
                 # Gửi cảnh báo Telegram
                 await send_telegram_report(TELE_TOKEN, f"⛔ {fresh_msg}", tele_id, name, None)
-                redis_service.delete_dedup(tele_id, date_iso, mode)
+                await asyncio.to_thread(redis_service.delete_dedup, tele_id, date_iso, mode)
             return
         # -----------------------
 
@@ -125,14 +163,15 @@ async def handle_daily_or_sleep(user_config, mode, prompts, user_note=None):
         # today = date(2025, 12, 30) # Dùng khi test ngày cũ
 
         # 1. Lấy dữ liệu Garmin (Sleep + Stats)
-        r_data, r_score, l_data = get_processed_data(client, today, name)
+        r_data, r_score, l_data = await asyncio.to_thread(get_processed_data, client, today, name)
 
         if tele_id:
             await send_progress_update(TELE_TOKEN, "✅ Đã đồng bộ. 🧠 Đang phân tích dữ liệu bằng AI...", tele_id, name)
 
         # 2. Gọi AI
-        # Lấy thông tin thời tiết (AQI)
-        aqi_data = WeatherService.get_aqi_data()
+        # Lấy thông tin thời tiết (AQI): dùng kết quả chung của lần chạy nếu đã có
+        if aqi_data is None:
+            aqi_data = await asyncio.to_thread(WeatherService.get_aqi_data)
         
         prompt_key = "sleep_analysis" if mode == "sleep_analysis" else "daily_report"
         advice_template = prompts.get(prompt_key)
@@ -142,36 +181,22 @@ async def handle_daily_or_sleep(user_config, mode, prompts, user_note=None):
         else:
             print(f"[{name}] ⚠️ Prompt '{prompt_key}' not found in Notion. Using Hardcoded Fallback.")
 
-        ai_report = get_ai_advice(today, r_data, r_score, l_data, user_config, prompt_template=advice_template, mode=mode, aqi_data=aqi_data, user_note=user_note)
+        stream_msg = start_report_stream(tele_id, name)
+        ai_report = await asyncio.to_thread(get_ai_advice, today, r_data, r_score, l_data, user_config, prompt_template=advice_template, mode=mode, aqi_data=aqi_data, user_note=user_note, on_text=stream_msg.push if stream_msg else None)
+        if stream_msg:
+            await stream_msg.finish(ai_report)
 
-        # 3. Tạo Voice Script & Audio
-        if tele_id:
-            await send_progress_update(TELE_TOKEN, "✅ Phân tích xong. 🎙️ Đang tạo bản thu âm...", tele_id, name)
+        # 3. Gửi báo cáo ngay, Voice Script & Audio tạo ở nền rồi gửi sau
+        await deliver_report(user_config, ai_report, prompts, mode, stream_msg=stream_msg)
 
-        voice_template = prompts.get("voice_script")
-        speech_script = get_speech_script(ai_report, user_config, prompt_template=voice_template, mode=mode)
-        
-        audio_file = f"voice_{name}_{today}_morning.wav" if mode == "sleep_analysis" else f"voice_{name}_{today}.wav"
-        has_audio = await generate_audio_from_text(speech_script, audio_file)
-        
-        # 4. Gửi Telegram (Kèm Audio)
-        if tele_id:
-            await send_telegram_report(TELE_TOKEN, ai_report, tele_id, name, audio_file if has_audio else None)
-        else:
-            print(f"[{name}] ⚠️ Không có Chat ID, không gửi tin.")
-        
-        # Xóa file audio tạm
-        if has_audio and os.path.exists(audio_file):
-            try:
-                os.remove(audio_file)
-            except: pass
-            
     except Exception as e:
         print(f"[{name}] ❌ Lỗi xử lý ({mode}): {e}")
         if tele_id:
-            redis_service.delete_dedup(tele_id, date_iso, mode)
+            await asyncio.to_thread(redis_service.delete_dedup, tele_id, date_iso, mode)
+        if raise_errors:
+            raise
 
-async def handle_workout_analysis(user_config, prompts, user_note=None):
+async def handle_workout_analysis(user_config, prompts, user_note=None, aqi_data=None, raise_errors=False):
     """
     Xử lý phân tích bài tập chuyên sâu (Workout Analysis).
     """
@@ -190,13 +215,13 @@ async def handle_workout_analysis(user_config, prompts, user_note=None):
     mode = "workout"
 
     if tele_id:
-        if redis_service.is_rate_limited(tele_id, mode):
+        if await asyncio.to_thread(redis_service.is_rate_limited, tele_id, mode):
             msg = "⚠️ Bạn đã yêu cầu quá nhanh. Vui lòng thử lại sau 10 phút."
             print(f"[{name}] {msg}")
             await send_telegram_report(TELE_TOKEN, msg, tele_id, name, None)
             return
 
-        if not redis_service.check_and_set_dedup(tele_id, date_iso, mode):
+        if not await asyncio.to_thread(redis_service.check_and_set_dedup, tele_id, date_iso, mode):
             msg = f"⛔ Báo cáo {mode} của bạn đã được gửi trong 1 giờ qua. Vui lòng đợi 1 tiếng giữa các yêu cầu."
             print(f"[{name}] {msg}")
             await send_telegram_report(TELE_TOKEN, msg, tele_id, name, None)
@@ -205,38 +230,39 @@ async def handle_workout_analysis(user_config, prompts, user_note=None):
 
     try:
         # 1. Login Garmin
-        client = login_garmin(email, password, name)
+        client = await asyncio.to_thread(login_garmin, email, password, name)
 
         # --- FRESHNESS CHECK ---
-        is_fresh, fresh_msg = check_garmin_sync_status(client, max_age_hours=1.0, user_label=name)
+        is_fresh, fresh_msg = await asyncio.to_thread(check_garmin_sync_status, client, max_age_hours=1.0, user_label=name)
         if not is_fresh:
             print(f"[{name}] ⛔ {fresh_msg}")
             if tele_id:
                 # Gửi cảnh báo Telegram
                 await send_telegram_report(TELE_TOKEN, f"⛔ {fresh_msg}", tele_id, name, None)
-                redis_service.delete_dedup(tele_id, date_iso, mode)
+                await asyncio.to_thread(redis_service.delete_dedup, tele_id, date_iso, mode)
             return
         # -----------------------
 
         today = date.today()
 
         # 2. Lấy dữ liệu bài tập 24h qua
-        activities = fetch_daily_activities_detailed(client, today, name)
+        activities = await asyncio.to_thread(fetch_daily_activities_detailed, client, today, name)
 
         if not activities:
             msg = "Hôm nay bạn không có hoạt động nào để phân tích."
             print(f"[{name}] ⚠️ {msg}")
             if tele_id:
                 await send_telegram_report(TELE_TOKEN, f"⚠️ {msg}", tele_id, name, None)
-                redis_service.delete_dedup(tele_id, date_iso, mode)
+                await asyncio.to_thread(redis_service.delete_dedup, tele_id, date_iso, mode)
             return
 
         if tele_id:
             await send_progress_update(TELE_TOKEN, "✅ Đã đồng bộ. 🧠 Đang phân tích dữ liệu bằng AI...", tele_id, name)
 
         # 3. AI Phân tích chuyên sâu
-        # Lấy thông tin thời tiết (AQI)
-        aqi_data = WeatherService.get_aqi_data()
+        # Lấy thông tin thời tiết (AQI): dùng kết quả chung của lần chạy nếu đã có
+        if aqi_data is None:
+            aqi_data = await asyncio.to_thread(WeatherService.get_aqi_data)
         
         workout_template = prompts.get("workout_analysis")
         if workout_template:
@@ -244,44 +270,27 @@ async def handle_workout_analysis(user_config, prompts, user_note=None):
         else:
              print(f"[{name}] ⚠️ Prompt 'workout_analysis' not found in Notion. Using Fallback.")
 
-        ai_report = get_workout_analysis_advice(activities, user_config, prompt_template=workout_template, aqi_data=aqi_data, user_note=user_note)
+        stream_msg = start_report_stream(tele_id, name)
+        ai_report = await asyncio.to_thread(get_workout_analysis_advice, activities, user_config, prompt_template=workout_template, aqi_data=aqi_data, user_note=user_note, on_text=stream_msg.push if stream_msg else None)
+        if stream_msg:
+            await stream_msg.finish(ai_report)
         
         if not ai_report:
             print(f"[{name}] ⚠️ Không tạo được báo cáo AI.")
             return
 
-        # 4. Tạo Voice Script & Audio
-        # Để tránh Rate Limit khi gọi liên tiếp
-        time.sleep(5) 
-        
-        if tele_id:
-            await send_progress_update(TELE_TOKEN, "✅ Phân tích xong. 🎙️ Đang tạo bản thu âm...", tele_id, name)
-
-        voice_template = prompts.get("voice_script")
-        # Dùng mode="daily" tạm cho context thể thao
-        voice_script = get_speech_script(ai_report, user_config, prompt_template=voice_template, mode="daily")
-        
-        audio_file = f"voice_workout_{name}_{today}.wav"
-        has_audio = await generate_audio_from_text(voice_script, audio_file)
-
-        # 5. Gửi Telegram
-        if tele_id:
-            await send_telegram_report(TELE_TOKEN, ai_report, tele_id, name, audio_file if has_audio else None)
-        else:
-            print(f"[{name}] ⚠️ Không có Chat ID.")
-
-        # Cleanup
-        if has_audio and os.path.exists(audio_file):
-            try:
-                os.remove(audio_file)
-            except: pass
+        # 4. Gửi báo cáo ngay, Voice Script & Audio tạo ở nền rồi gửi sau
+        # (Dùng mode="daily" tạm cho context thể thao; chờ 5s để tránh Rate Limit khi gọi liên tiếp)
+        await deliver_report(user_config, ai_report, prompts, "daily", stream_msg=stream_msg, voice_delay=5)
 
     except Exception as e:
         print(f"[{name}] ❌ Lỗi xử lý Workout: {e}")
         if tele_id:
-            redis_service.delete_dedup(tele_id, date_iso, mode)
+            await asyncio.to_thread(redis_service.delete_dedup, tele_id, date_iso, mode)
+        if raise_errors:
+            raise
 
-async def handle_battery_analysis(user_config, prompts, user_note=None):
+async def handle_battery_analysis(user_config, prompts, user_note=None, aqi_data=None, raise_errors=False):
     """
     Xử lý phân tích năng lượng chuyên biệt (Body Battery & Stress).
     """
@@ -300,13 +309,13 @@ async def handle_battery_analysis(user_config, prompts, user_note=None):
     mode = "battery"
 
     if tele_id:
-        if redis_service.is_rate_limited(tele_id, mode):
+        if await asyncio.to_thread(redis_service.is_rate_limited, tele_id, mode):
             msg = "⚠️ Bạn đã yêu cầu quá nhanh. Vui lòng thử lại sau 10 phút."
             print(f"[{name}] {msg}")
             await send_telegram_report(TELE_TOKEN, msg, tele_id, name, None)
             return
 
-        if not redis_service.check_and_set_dedup(tele_id, date_iso, mode):
+        if not await asyncio.to_thread(redis_service.check_and_set_dedup, tele_id, date_iso, mode):
             msg = f"⛔ Báo cáo {mode} của bạn đã được gửi trong 1 giờ qua. Vui lòng đợi 1 tiếng giữa các yêu cầu."
             print(f"[{name}] {msg}")
             await send_telegram_report(TELE_TOKEN, msg, tele_id, name, None)
@@ -314,28 +323,29 @@ async def handle_battery_analysis(user_config, prompts, user_note=None):
     # ------------------------------------
 
     try:
-        client = login_garmin(email, password, name)
+        client = await asyncio.to_thread(login_garmin, email, password, name)
 
         # --- FRESHNESS CHECK ---
-        is_fresh, fresh_msg = check_garmin_sync_status(client, max_age_hours=1.0, user_label=name)
+        is_fresh, fresh_msg = await asyncio.to_thread(check_garmin_sync_status, client, max_age_hours=1.0, user_label=name)
         if not is_fresh:
             print(f"[{name}] ⛔ {fresh_msg}")
             if tele_id:
                 await send_telegram_report(TELE_TOKEN, f"⛔ {fresh_msg}", tele_id, name, None)
-                redis_service.delete_dedup(tele_id, date_iso, mode)
+                await asyncio.to_thread(redis_service.delete_dedup, tele_id, date_iso, mode)
             return
         # -----------------------
 
         today = date.today()
 
         # 1. Kéo data đã tổng hợp (gồm Timeseries)
-        r_data, r_score, l_data = get_processed_data(client, today, name)
+        r_data, r_score, l_data = await asyncio.to_thread(get_processed_data, client, today, name)
 
         if tele_id:
             await send_progress_update(TELE_TOKEN, "✅ Đã đồng bộ. 🧠 Đang phân tích dữ liệu bằng AI...", tele_id, name)
 
         # 2. Gọi AI
-        aqi_data = WeatherService.get_aqi_data()
+        if aqi_data is None:
+            aqi_data = await asyncio.to_thread(WeatherService.get_aqi_data)
 
         battery_template = prompts.get("battery_analysis")
         if battery_template:
@@ -344,41 +354,26 @@ async def handle_battery_analysis(user_config, prompts, user_note=None):
              print(f"[{name}] ⚠️ Prompt 'battery_analysis' not found in Notion. Using Fallback.")
 
         # Gọi hàm chuyên biệt phân tích Pin
-        ai_report = get_battery_analysis_advice(today, r_data, user_config, prompt_template=battery_template, aqi_data=aqi_data, user_note=user_note)
+        stream_msg = start_report_stream(tele_id, name)
+        ai_report = await asyncio.to_thread(get_battery_analysis_advice, today, r_data, user_config, prompt_template=battery_template, aqi_data=aqi_data, user_note=user_note, on_text=stream_msg.push if stream_msg else None)
+        if stream_msg:
+            await stream_msg.finish(ai_report)
 
         if not ai_report:
             print(f"[{name}] ⚠️ Không tạo được báo cáo AI.")
             return
 
-        # 3. Tạo Voice Script & Audio
-        time.sleep(5)
-
-        if tele_id:
-            await send_progress_update(TELE_TOKEN, "✅ Phân tích xong. 🎙️ Đang tạo bản thu âm...", tele_id, name)
-
-        voice_template = prompts.get("voice_script")
-        voice_script = get_speech_script(ai_report, user_config, prompt_template=voice_template, mode="battery")
-
-        audio_file = f"voice_battery_{name}_{today}.wav"
-        has_audio = await generate_audio_from_text(voice_script, audio_file)
-
-        # 4. Gửi Telegram
-        if tele_id:
-            await send_telegram_report(TELE_TOKEN, ai_report, tele_id, name, audio_file if has_audio else None)
-        else:
-            print(f"[{name}] ⚠️ Không có Chat ID.")
-
-        if has_audio and os.path.exists(audio_file):
-            try:
-                os.remove(audio_file)
-            except: pass
+        # 3. Gửi báo cáo ngay, Voice Script & Audio tạo ở nền rồi gửi sau
+        await deliver_report(user_config, ai_report, prompts, "battery", stream_msg=stream_msg, voice_delay=5)
 
     except Exception as e:
         print(f"[{name}] ❌ Lỗi xử lý Battery Analysis: {e}")
         if tele_id:
-            redis_service.delete_dedup(tele_id, date_iso, mode)
+            await asyncio.to_thread(redis_service.delete_dedup, tele_id, date_iso, mode)
+        if raise_errors:
+            raise
 
-async def handle_ask(user_config, question, prompts):
+async def handle_ask(user_config, question, prompts, raise_errors=False):
     """
     Xử lý câu hỏi của người dùng (Customer Service Q&A & Garmin Data Retrieval).
     """
@@ -409,7 +404,7 @@ async def handle_ask(user_config, question, prompts):
         client = None
         if email and password:
             try:
-                client = login_garmin(email, password, name)
+                client = await asyncio.to_thread(login_garmin, email, password, name)
                 print(f"[{name}] 🧠 Garmin client loaded for Agent.")
             except Exception as ge:
                 print(f"[{name}] ⚠️ Lỗi đăng nhập Garmin Connect: {ge}")
@@ -428,14 +423,244 @@ async def handle_ask(user_config, question, prompts):
 
     except Exception as e:
         print(f"[{name}] ❌ Lỗi xử lý hỏi đáp: {e}")
+        if raise_errors:
+            raise
+
+async def handle_sync(user_config, raise_errors=False):
+    """
+    Đồng bộ tăng dần dữ liệu Garmin của user vào store local (không gửi Telegram).
+    """
+    name = user_config.get('name', 'Unknown')
+    email = user_config.get('email')
+    password = user_config.get('password')
+
+    if not email or not password:
+        print(f"[{name}] ❌ Thiếu Email/Pass, bỏ qua.")
+        return
+
+    try:
+        client = await asyncio.to_thread(login_garmin, email, password, name)
+        await asyncio.to_thread(sync_user, client, name)
+    except Exception as e:
+        print(f"[{name}] ❌ Lỗi sync: {e}")
+        if raise_errors:
+            raise
+
+# Các mode có dùng AQI trong prompt
+AQI_MODES = {"daily", "daily_report", "sleep_analysis", "workout", "battery"}
+
+async def _resolved(value):
+    return value
+
+class SharedResources:
+    """
+    Cache ngắn hạn (TTL) cho dữ liệu dùng chung giữa các job trong 1 process worker (AQI, prompts),
+    tránh mỗi job lại gọi API AQI và query delta Notion. Mỗi tên có lock riêng nên các job
+    chạy song song chỉ tải 1 lần; kết quả rỗng / None không được cache để lần sau thử lại.
+    """
+    def __init__(self, ttl=None):
+        self.ttl = Config.JOB_SHARED_TTL if ttl is None else ttl
+        self._entries = {}
+        self._locks = {}
+
+    async def get(self, name, loader):
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            entry = self._entries.get(name)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+            value = await loader()
+            if value:
+                self._entries[name] = (time.monotonic() + self.ttl, value)
+            return value
+
+async def bootstrap(mode, filter_tele_id=None, http_client=None, shared=None):
+    """
+    Tải danh sách user, prompts và AQI song song trên 1 httpx.AsyncClient dùng chung
+    trước khi chia việc cho từng user. AQI chỉ lấy 1 lần và dùng chung cho mọi user.
+    `http_client` cho phép dùng lại client sống lâu (mode serve); `shared` (SharedResources, mode worker)
+    cho phép dùng lại AQI / prompts giữa các job. Trả về (users, prompts, aqi_data).
+    """
+    if http_client is None:
+        async with httpx.AsyncClient(timeout=10.0) as client:
+            return await bootstrap(mode, filter_tele_id, client, shared)
+
+    def load_prompts():
+        return prompt_registry.aget_prompts(http_client)
+
+    def load_aqi():
+        return WeatherService.aget_aqi_data(http_client)
+
+    if filter_tele_id:
+        users_job = user_directory.aget_user_by_chat_id(http_client, filter_tele_id)
+    else:
+        users_job = user_directory.aget_users(http_client)
+    if mode == "sync":
+        prompts_job = _resolved({})
+    else:
+        prompts_job = shared.get("prompts", load_prompts) if shared else load_prompts()
+    if mode in AQI_MODES:
+        aqi_job = shared.get("aqi", load_aqi) if shared else load_aqi()
+    else:
+        aqi_job = _resolved(None)
+    users, prompts, aqi_data = await asyncio.gather(users_job, prompts_job, aqi_job)
+
+    if filter_tele_id:
+        users = [users] if users else []
+    return users, prompts, aqi_data
+
+def build_user_task(mode, user, prompts, question=None, aqi_data=None, raise_errors=False):
+    """
+    Coroutine xử lý 1 user theo mode, hoặc None nếu mode không hỗ trợ.
+    """
+    if mode == "workout":
+        return handle_workout_analysis(user, prompts, user_note=question, aqi_data=aqi_data, raise_errors=raise_errors)
+    elif mode == "battery":
+        return handle_battery_analysis(user, prompts, user_note=question, aqi_data=aqi_data, raise_errors=raise_errors)
+    elif mode == "ask":
+        return handle_ask(user, question, prompts, raise_errors=raise_errors)
+    elif mode == "sync":
+        return handle_sync(user, raise_errors=raise_errors)
+    elif mode in ["daily", "daily_report", "sleep_analysis"]:
+        # Clean up mode string explicitly if needed
+        run_mode = "sleep_analysis" if mode == "sleep_analysis" else "daily"
+        return handle_daily_or_sleep(user, run_mode, prompts, user_note=question, aqi_data=aqi_data, raise_errors=raise_errors)
+    return None
+
+async def run_mode(mode, filter_tele_id=None, question=None, http_client=None, raise_errors=False, shared=None, wait_background=True):
+    """
+    Chạy 1 lượt xử lý (dùng chung cho CLI và webhook server): bootstrap rồi chạy handler cho từng user.
+    `raise_errors=True` (mode worker): chạy hết các user rồi ném lại lỗi đầu tiên để job được retry.
+    `wait_background=False` (mode worker): không chờ Voice Note của lượt này, job được ack ngay sau báo cáo text.
+    """
+    # 1. Lấy user, Prompts và AQI song song (danh bạ có cache, tra theo Chat ID không cần duyệt cả danh sách)
+    users, prompts, aqi_data = await bootstrap(mode, filter_tele_id, http_client, shared)
+    if not users:
+        if filter_tele_id:
+            print(f"User with Chat ID {filter_tele_id} not found or inactive on Notion.")
+        else:
+            print("⚠️ Không tìm thấy user nào Active trên Notion.")
+        return
+
+    print(f"🚀 Kích hoạt quy trình cho {len(users)} người dùng...")
+
+    # Giới hạn số user chạy đồng thời cho cả process (Garmin/AI/TTS đều có rate limit),
+    # dùng chung giữa các lần run_mode song song trong mode serve / worker
+    user_semaphore = get_limiter("users")
+
+    async def run_limited(coro):
+        async with user_semaphore:
+            return await coro
+
+    tasks = []
+    for user in users:
+        task = build_user_task(mode, user, prompts, question, aqi_data, raise_errors=raise_errors)
+        if task is None:
+            print(f"Unknown mode: {mode}")
+            for pending in tasks:
+                pending.close()
+            return
+        tasks.append(task)
+
+    own_background = set()
+    token = _run_background.set(own_background)
+    try:
+        results = await asyncio.gather(*(run_limited(t) for t in tasks), return_exceptions=True)
+    finally:
+        _run_background.reset(token)
+    # Chờ các Voice Note của lượt này còn đang tạo ở nền (không chờ của các lượt khác)
+    if wait_background:
+        await drain_background_tasks(own_background)
+
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        raise errors[0]
+
+async def enqueue_jobs(mode, filter_tele_id=None, question=None, http_client=None):
+    """
+    Producer của hàng đợi job: không có tele_id thì tách thành 1 job mỗi user (có Chat ID)
+    để các worker chia nhau xử lý. Trả về số job mới (job trùng đang chờ được gộp).
+    """
+    if filter_tele_id:
+        tele_ids = [filter_tele_id]
+    else:
+        if http_client is None:
+            async with httpx.AsyncClient(timeout=10.0) as client:
+                return await enqueue_jobs(mode, filter_tele_id, question, client)
+        users = await user_directory.aget_users(http_client)
+        tele_ids = [u.get("telegram_chat_id") for u in users if u.get("telegram_chat_id")]
+        if len(tele_ids) < len(users):
+            print(f"⚠️ Bỏ qua {len(users) - len(tele_ids)} user không có Chat ID.")
+
+    created = 0
+    for tele_id in tele_ids:
+        message_id, is_new = await job_queue.enqueue(mode, tele_id, question)
+        created += is_new
+        print(f"📥 {'Đã xếp' if is_new else 'Gộp vào'} job {message_id} ({mode}, user={tele_id})")
+    return created
+
+async def serve(host=None, port=None):
+    """
+    Mode serve: HTTP server thường trực nhận webhook (cùng payload với repository_dispatch)
+    và chạy handler ngay trong process, không mất thời gian khởi động runner GitHub Actions.
+    Với JOB_QUEUE_ENABLED, server chỉ đưa job vào hàng đợi Redis cho các process `--mode worker`.
+    """
+    async with httpx.AsyncClient(timeout=10.0) as http_client:
+        async def dispatch(mode, tele_id, question):
+            try:
+                if Config.JOB_QUEUE_ENABLED:
+                    await enqueue_jobs(mode, tele_id, question, http_client)
+                else:
+                    await run_mode(mode, tele_id, question, http_client)
+            except Exception as e:
+                error_msg = f"CRITICAL ERROR in serve (Mode: {mode}, User: {tele_id}):\n{str(e)}"
+                if TELE_ADMIN:
+                    await send_error_alert(TELE_TOKEN, TELE_ADMIN, error_msg)
+                raise
+
+        server = WebhookServer(dispatch, host=host, port=port)
+        try:
+            await server.serve_forever()
+        finally:
+            await job_queue.close()
+
+async def work(concurrency=None):
+    """
+    Mode worker: consumer của hàng đợi job Redis Streams. Chạy nhiều process (nhiều core / nhiều máy)
+    để xử lý song song; job lỗi được retry, quá JOB_MAX_DELIVERIES lần thì vào dead-letter.
+    """
+    # AQI và prompts dùng chung giữa các job trong JOB_SHARED_TTL giây
+    shared = SharedResources()
+    async with httpx.AsyncClient(timeout=10.0) as http_client:
+        async def dispatch(mode, tele_id, question):
+            try:
+                # Voice Note chạy nền sau khi job được ack (không giữ lock user / heartbeat)
+                await run_mode(mode, tele_id, question, http_client, raise_errors=True, shared=shared, wait_background=False)
+            except Exception as e:
+                error_msg = f"CRITICAL ERROR in worker (Mode: {mode}, User: {tele_id}):\n{str(e)}"
+                if TELE_ADMIN:
+                    await send_error_alert(TELE_TOKEN, TELE_ADMIN, error_msg)
+                raise
+
+        worker = JobWorker(job_queue, dispatch, concurrency=concurrency)
+        try:
+            await worker.serve_forever()
+        finally:
+            # Job đã ack hết; chờ các Voice Note còn chạy nền trước khi thoát
+            await drain_background_tasks()
+            await job_queue.close()
 
 async def main():
     parser = argparse.ArgumentParser(description="Garmin AI Coach Pro")
-    parser.add_argument("--mode", default="daily", help="Mode: daily | sleep_analysis | workout | battery | ask")
+    parser.add_argument("--mode", default="daily", help="Mode: daily | sleep_analysis | workout | battery | ask | sync | serve | worker")
 
     # 1. THÊM DÒNG NÀY: Nhận tham số tele_id từ GitHub Action
     parser.add_argument("--tele_id", default=None, help="Filter specific user by Telegram ID")
     parser.add_argument("--question", default=None, help="The question text for Q&A mode")
+    parser.add_argument("--host", default=None, help="Serve mode: địa chỉ lắng nghe (mặc định SERVE_HOST)")
+    parser.add_argument("--port", type=int, default=None, help="Serve mode: cổng lắng nghe (mặc định SERVE_PORT)")
+    parser.add_argument("--enqueue", action="store_true", help="Đưa job vào hàng đợi Redis cho các worker thay vì chạy ngay")
+    parser.add_argument("--concurrency", type=int, default=None, help="Worker mode: số job chạy đồng thời (mặc định JOB_WORKER_CONCURRENCY)")
 
     args = parser.parse_args()
     mode = args.mode
@@ -447,45 +672,18 @@ async def main():
         print(f"Filter User ID: {filter_tele_id}")
     
     try:
-        # 1. Lấy user từ Notion
-        all_users = get_users_from_notion()
-        if not all_users:
-            print("⚠️ Không tìm thấy user nào Active trên Notion.")
-            return
-
-        # 2. LỌC USER: Nếu có filter_tele_id thì chỉ giữ lại user đó
-        if filter_tele_id:
-            # Lưu ý: telegram_chat_id trong notion_service.py đang lấy về dạng string (get_text)
-            users = [u for u in all_users if str(u.get('telegram_chat_id')) == str(filter_tele_id)]
-
-            if not users:
-                print(f"User with Chat ID {filter_tele_id} not found or inactive on Notion.")
-                return
+        if mode == "serve":
+            await serve(args.host, args.port)
+        elif mode == "worker":
+            await work(args.concurrency)
+        elif args.enqueue:
+            try:
+                created = await enqueue_jobs(mode, filter_tele_id, question)
+                print(f"📥 Đã thêm {created} job vào hàng đợi.")
+            finally:
+                await job_queue.close()
         else:
-            users = all_users
-
-        print(f"🚀 Kích hoạt quy trình cho {len(users)} người dùng...")
-        
-        # 2. Lấy Prompts
-        prompts = get_prompts_from_notion()
-        
-        tasks = []
-        for user in users:
-            if mode == "workout":
-                tasks.append(handle_workout_analysis(user, prompts, user_note=question))
-            elif mode == "battery":
-                tasks.append(handle_battery_analysis(user, prompts, user_note=question))
-            elif mode == "ask":
-                tasks.append(handle_ask(user, question, prompts))
-            elif mode in ["daily", "daily_report", "sleep_analysis"]:
-                # Clean up mode string explicitly if needed
-                run_mode = "sleep_analysis" if mode == "sleep_analysis" else "daily"
-                tasks.append(handle_daily_or_sleep(user, run_mode, prompts, user_note=question))
-            else:
-                print(f"Unknown mode: {mode}")
-                return
-
-        await asyncio.gather(*tasks)
+            await run_mode(mode, filter_tele_id, question)
         print("\n=== COMPLETE ===")
 
     except Exception as e:
@@ -497,6 +695,12 @@ async def main():
         else:
              print("Config TELEGRAM_ADMIN_ID not set, alert not sent.")
         raise e # Re-raise để GitHub Actions vẫn báo fail
+    finally:
+        latency_report = llm_clients.latency.report()
+        if latency_report:
+            print(f"📊 Latency LLM theo model:\n{latency_report}")
+        await llm_clients.aclose()
+        await shutdown_telegram()
 
 if __name__ == "__main__":
     asyncio.run(main())
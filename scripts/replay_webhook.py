@@ -0,0 +1,68 @@
+"""
+Client giả lập Cloudflare Worker: gửi lại các webhook (cùng payload với repository_dispatch)
+tới server `python main.py --mode serve` để thử nghiệm cục bộ.
+
+Ví dụ:
+    python scripts/replay_webhook.py --mode ask --user_id 123456 --question "HRV hôm nay?"
+    python scripts/replay_webhook.py --file payloads.jsonl --concurrency 4
+(mỗi dòng của payloads.jsonl: {"mode": ..., "user_id": ..., "question": ...}
+ hoặc {"event_type": "telegram_command", "client_payload": {...}})
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import httpx
+
+def load_payloads(args):
+    if args.file:
+        with open(args.file, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    payload = {"mode": args.mode, "user_id": args.user_id}
+    if args.question:
+        payload["question"] = args.question
+    return [payload] * args.repeat
+
+async def replay(url, payloads, secret=None, concurrency=1):
+    headers = {"Authorization": f"Bearer {secret}"} if secret else {}
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    results = []
+
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        async def send(i, payload):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(url, json=payload, headers=headers)
+                    body = response.text
+                    status = response.status_code
+                except Exception as e:
+                    status, body = None, str(e)
+                elapsed = (time.perf_counter() - started) * 1000
+                print(f"#{i} {payload.get('mode') or payload.get('client_payload', {}).get('mode')} → {status} ({elapsed:.0f} ms) {body}")
+                results.append((status, elapsed))
+
+        await asyncio.gather(*(send(i, p) for i, p in enumerate(payloads, 1)))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay webhook tới server mode serve")
+    parser.add_argument("--url", default=os.getenv("BOT_SERVER_URL", "http://127.0.0.1:8080/dispatch"))
+    parser.add_argument("--secret", default=os.getenv("SERVE_SECRET"))
+    parser.add_argument("--file", default=None, help="File JSONL chứa các payload")
+    parser.add_argument("--mode", default="daily")
+    parser.add_argument("--user_id", default=None)
+    parser.add_argument("--question", default=None)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=1)
+    args = parser.parse_args()
+
+    results = asyncio.run(replay(args.url, load_payloads(args), args.secret, args.concurrency))
+    accepted = sum(1 for status, _ in results if status == 202)
+    print(f"Đã gửi {len(results)} webhook, {accepted} được nhận (202).")
+    sys.exit(0 if accepted == len(results) else 1)
+
+if __name__ == "__main__":
+    main()
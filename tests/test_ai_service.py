@@ -37,13 +37,17 @@ async def test_process_data_with_worker_without_task():
         mock_response.content = "processed result by AI"
         mock_call.return_value = mock_response
 
-        tool_args = {"date": "2026-07-07"}
+        tool_args = {"activity_id": 123}
+        splits = [{"lapIndex": i, "distance": 1000, "duration": 300 + i, "averageHR": 150} for i in range(60)]
+        raw_data = json.dumps({"activityId": 123, "splits": {"lapDTOs": splits}})
 
         with patch("app.services.ai_service.Config") as mock_cfg:
             mock_cfg.ROUTER9_API_KEY = "fake-key"
             mock_cfg.MODEL_WORKER = "gemini-worker"
+            mock_cfg.WORKER_MIN_PAYLOAD_CHARS = 2000
+            mock_cfg.WORKER_MIN_SERIES_POINTS = 30
 
-            res = await process_data_with_worker("get_body_battery_trend", tool_args, '{"charged": 10}')
+            res = await process_data_with_worker("get_activity_details", tool_args, raw_data)
 
             assert res == "processed result by AI"
 
@@ -54,6 +58,27 @@ async def test_process_data_with_worker_without_task():
             assert "Trích xuất tất cả các số liệu quan trọng nhất" in user_prompt
             assert "Nhiệm vụ cụ thể của bạn được yêu cầu từ MODEL_BRAIN" not in user_prompt
 
+@pytest.mark.asyncio
+async def test_process_data_with_worker_skips_small_payload():
+    from app.services.ai_service import worker_stats
+
+    with patch("app.services.ai_service.call_ai_api_raw_async", new_callable=AsyncMock) as mock_call:
+        with patch("app.services.ai_service.Config") as mock_cfg:
+            mock_cfg.ROUTER9_API_KEY = "fake-key"
+            mock_cfg.MODEL_WORKER = "gemini-worker"
+            mock_cfg.WORKER_MIN_PAYLOAD_CHARS = 2000
+            mock_cfg.WORKER_MIN_SERIES_POINTS = 30
+
+            avoided_before = worker_stats["avoided"]
+            raw = json.dumps({"averageSpO2": 96, "lowestSpO2": 90, "latestSpO2": None})
+            res = await process_data_with_worker("get_spo2_data", {"date": "2026-07-07"}, raw)
+
+            mock_call.assert_not_called()
+            assert worker_stats["avoided"] == avoided_before + 1
+            assert "- averageSpO2: 96" in res
+            assert "- lowestSpO2: 90" in res
+            assert "latestSpO2" not in res
+
 def test_execute_garmin_tool_get_body_battery_trend():
     client = MagicMock()
 
@@ -265,3 +290,159 @@ def test_execute_garmin_tool_get_training_readiness_fallback():
 
         mock_gpd.assert_called_once()
 
+
+
+def _reference_filter_time_series(values_list, start_time=None, end_time=None):
+    """Bản cài đặt gốc (từng phần tử với datetime) để đối chiếu kết quả."""
+    import pytz
+    from datetime import datetime
+    vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
+    start_min = int(start_time.split(":")[0]) * 60 + int(start_time.split(":")[1]) if start_time else None
+    end_min = int(end_time.split(":")[0]) * 60 + int(end_time.split(":")[1]) if end_time else None
+    filtered = []
+    for item in values_list:
+        if not isinstance(item, (list, tuple)) or len(item) < 2:
+            continue
+        val = item[2] if len(item) >= 3 and isinstance(item[1], str) else item[1]
+        if val is None or not isinstance(val, (int, float)) or val < 0:
+            continue
+        dt = datetime.fromtimestamp(item[0] / 1000, vn_tz)
+        item_min = dt.hour * 60 + dt.minute
+        if start_min is not None and item_min < start_min:
+            continue
+        if end_min is not None and item_min > end_min:
+            continue
+        filtered.append({"time": dt.strftime("%H:%M"), "value": val})
+    return filtered
+
+
+def test_filter_time_series_matches_reference_implementation():
+    from app.services.ai_service import filter_time_series
+    import random
+
+    rng = random.Random(42)
+    base = 1783357200000  # 2026-07-07 00:00 giờ VN
+    values = []
+    for i in range(720):
+        ts = base + i * 120000 + rng.randint(0, 999)
+        roll = rng.random()
+        if roll < 0.05:
+            values.append([ts, -1])
+        elif roll < 0.08:
+            values.append([ts, None])
+        elif roll < 0.2:
+            values.append([ts, "MEASURED", rng.randint(5, 100), 2.0])
+        else:
+            values.append([ts, rng.randint(40, 180)])
+    values.append("garbage")
+    values.append([base])
+
+    for window in [(None, None), ("06:30", "09:15"), ("22:00", None), (None, "01:00")]:
+        assert filter_time_series(values, *window, point_budget=0) == _reference_filter_time_series(values, *window)
+
+
+def test_filter_time_series_respects_point_budget_and_keeps_peak():
+    from app.services.ai_service import filter_time_series
+
+    base = 1783357200000
+    values = [[base + i * 60000, 50] for i in range(600)]
+    values[333][1] = 180  # đỉnh ngắn mà bước nhảy cố định dễ bỏ sót
+
+    for method in ("lttb", "minmax", "change"):
+        result = filter_time_series(values, point_budget=40, method=method)
+        assert len(result) <= 40
+        assert max(p["value"] for p in result) == 180
+        assert result[0]["time"] == "00:00"
+        assert result[-1]["time"] == "09:59"
+
+
+def test_heart_rate_tool_keeps_full_resolution_for_local_analytics():
+    from app.config import Config
+
+    base = 1783357200000
+    client = MagicMock()
+    client.get_heart_rates.return_value = {
+        "restingHeartRate": 55,
+        "heartRateValues": [[base + i * 60000, 150 if i % 3 else 120] for i in range(600)],
+    }
+
+    # Không có task: phân tích cục bộ trên chuỗi đầy đủ (downsample làm lệch thời gian theo vùng)
+    local = json.loads(execute_garmin_tool(client, "get_heart_rates", {"date": "2026-07-07"}))
+    assert local["heart_rate_readings_count"] == 600
+
+    # Có task: payload gửi MODEL_WORKER nên được giảm theo SERIES_POINT_BUDGET
+    worker = json.loads(execute_garmin_tool(client, "get_heart_rates", {"date": "2026-07-07", "task": "Tìm đỉnh"}))
+    assert worker["heart_rate_readings_count"] <= Config.SERIES_POINT_BUDGET
+
+def test_thinking_stream_filter_hides_blocks_until_closed():
+    from app.services.ai_service import ThinkingStreamFilter
+
+    f = ThinkingStreamFilter()
+    assert f.feed("<thi") == ""
+    assert f.feed("nking>đang nghĩ") == ""
+    assert f.feed("...</thinking>**Tổng") == "**Tổng"
+    assert f.feed(" quan** ổn <th") == "**Tổng quan** ổn "
+    assert f.feed("ought>ẩn</thought> tiếp") == "**Tổng quan** ổn  tiếp"
+
+
+def test_call_ai_api_streams_visible_text():
+    from app.services import ai_service
+
+    chunks = ["<think>", "suy nghĩ", "</think>", "**Đánh giá**", " tốt"]
+    seen = []
+    with patch.object(ai_service.llm_clients, "stream_chat_completion", return_value=iter(chunks)) as mock_stream:
+        result = ai_service.call_ai_api("key", "model", "prompt", on_text=seen.append)
+
+    mock_stream.assert_called_once()
+    assert result == "**Đánh giá** tốt"
+    assert seen == ["**Đánh giá**", "**Đánh giá** tốt"]
+
+
+def test_split_script_into_chunks_respects_sentence_boundaries():
+    from app.services.ai_service import split_script_into_chunks
+
+    text = "Chào bạn. Hôm nay pin cơ thể đạt 80! Giấc ngủ sâu khá tốt?\nHãy chạy nhẹ 30 phút."
+    chunks = split_script_into_chunks(text, max_chars=40)
+    assert chunks == ["Chào bạn. Hôm nay pin cơ thể đạt 80!", "Giấc ngủ sâu khá tốt?", "Hãy chạy nhẹ 30 phút."]
+    assert split_script_into_chunks(text, max_chars=1000) == [" ".join(chunks)]
+
+
+def test_generate_audio_from_text_synthesises_chunks_in_parallel_and_in_order():
+    import asyncio
+    import threading
+    import time as time_mod
+    from app.services import ai_service
+    from app.config import Config
+
+    used_keys = []
+    lock = threading.Lock()
+
+    def fake_synth(api_key, text, voice, model_name):
+        with lock:
+            used_keys.append(api_key)
+        # Đoạn đầu chậm nhất để kiểm tra thứ tự ghép
+        time_mod.sleep(0.3 if text.startswith("Một") else 0.1)
+        return text[:3].encode("utf-8"), "audio/L16;rate=24000"
+
+    captured = {}
+
+    def fake_encode(pcm, mime_type):
+        captured["pcm"] = pcm
+        return {"data": b"OggS", "filename": "voice.ogg", "mime_type": "audio/ogg", "duration": 1}
+
+    script = "Một câu khá dài. Hai câu nữa. Ba câu cuối."
+    with patch.object(ai_service, "synthesize_pcm", side_effect=fake_synth), \
+         patch.object(ai_service, "encode_voice_note", side_effect=fake_encode), \
+         patch.object(ai_service.tts_cache, "get", return_value=None), \
+         patch.object(ai_service.tts_cache, "set"), \
+         patch.object(ai_service, "gemini_key_manager", ai_service.GeminiKeyManager(keys=["key-a", "key-b", "key-c"])), \
+         patch.object(Config, "TTS_CHUNK_CHARS", 15), \
+         patch.object(Config, "TTS_CHUNK_GAP_SECONDS", 0):
+        started = time_mod.monotonic()
+        clip = asyncio.run(ai_service.generate_audio_from_text(script))
+        elapsed = time_mod.monotonic() - started
+
+    assert clip["filename"] == "voice.ogg"
+    assert captured["pcm"] == "Một".encode() + b"Hai" + b"Ba "
+    assert sorted(used_keys) == ["key-a", "key-b", "key-c"]
+    assert elapsed < 0.5
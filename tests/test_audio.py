@@ -0,0 +1,40 @@
+import struct
+from unittest.mock import patch, MagicMock
+
+from app.utils.audio import convert_to_wav, encode_voice_note, as_upload, pcm_to_ogg_opus
+
+PCM = b"\x00\x01" * 24000  # 1 giây L16 mono 24kHz
+
+
+def test_encode_voice_note_falls_back_to_wav_without_ffmpeg():
+    with patch("app.utils.audio.ffmpeg_path", return_value=None):
+        clip = encode_voice_note(PCM, "audio/L16;rate=24000")
+
+    assert clip["filename"] == "voice.wav"
+    assert clip["duration"] == 1
+    assert clip["data"] == convert_to_wav(PCM, "audio/L16;rate=24000")
+    riff, size, wave = struct.unpack("<4sI4s", clip["data"][:12])
+    assert (riff, wave, size) == (b"RIFF", b"WAVE", 36 + len(PCM))
+
+    upload = as_upload(clip)
+    assert upload.name == "voice.wav" and upload.read() == clip["data"]
+
+
+def test_encode_voice_note_pipes_pcm_through_ffmpeg():
+    fake_result = MagicMock(returncode=0, stdout=b"OggS-opus", stderr=b"")
+    with patch("app.utils.audio.ffmpeg_path", return_value="/usr/bin/ffmpeg"), \
+         patch("app.utils.audio.subprocess.run", return_value=fake_result) as mock_run:
+        clip = encode_voice_note(PCM, "audio/L16;codec=pcm;rate=24000")
+
+    assert clip == {"data": b"OggS-opus", "filename": "voice.ogg", "mime_type": "audio/ogg", "duration": 1}
+    command = mock_run.call_args.args[0]
+    assert command[command.index("-ar") + 1] == "24000"
+    assert "libopus" in command and command[-1] == "pipe:1"
+    assert mock_run.call_args.kwargs["input"] == PCM
+
+
+def test_pcm_to_ogg_opus_returns_none_on_ffmpeg_failure():
+    fake_result = MagicMock(returncode=1, stdout=b"", stderr=b"Unknown encoder 'libopus'")
+    with patch("app.utils.audio.ffmpeg_path", return_value="/usr/bin/ffmpeg"), \
+         patch("app.utils.audio.subprocess.run", return_value=fake_result):
+        assert pcm_to_ogg_opus(PCM, "audio/L16;rate=24000") is None
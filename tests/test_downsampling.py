@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from app.config import Config
+from app.utils.downsampling import DOWNSAMPLERS, downsample, lttb, minmax_buckets, change_only
+
+
+def test_lttb_keeps_endpoints_and_budget():
+    x = np.arange(1000)
+    y = np.sin(x / 50.0)
+    idx = lttb(x, y, 50)
+    assert len(idx) == 50
+    assert idx[0] == 0 and idx[-1] == 999
+    assert np.all(np.diff(idx) > 0)
+
+
+def test_minmax_buckets_never_drops_extremes():
+    rng = np.random.default_rng(0)
+    y = rng.normal(60, 5, 500)
+    y[123] = 150
+    y[400] = 10
+    idx = minmax_buckets(np.arange(500), y, 30)
+    assert len(idx) <= 30
+    assert 123 in idx and 400 in idx
+
+
+def test_change_only_collapses_flat_runs():
+    y = [5, 5, 5, 7, 7, 7, 7, 3, 3, 3]
+    assert change_only(y).tolist() == [0, 3, 7, 9]
+    assert change_only([10, 11, 12, 20, 21], tolerance=2).tolist() == [0, 3, 4]
+
+
+def test_downsample_passthrough_and_unknown_method():
+    assert downsample([1, 2, 3], [4, 5, 6], 10).tolist() == [0, 1, 2]
+    assert downsample([1, 2, 3], [4, 5, 6], 0).tolist() == [0, 1, 2]
+    with pytest.raises(ValueError):
+        downsample(list(range(10)), list(range(10)), 3, "bogus")
+
+
+def test_config_downsampler_choices_match_registry():
+    assert set(Config.SERIES_DOWNSAMPLERS) == set(DOWNSAMPLERS)
+    assert Config.SERIES_DOWNSAMPLER in DOWNSAMPLERS
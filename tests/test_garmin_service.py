@@ -0,0 +1,85 @@
+import time
+from datetime import date
+from unittest.mock import MagicMock
+
+from app.services.garmin_service import get_processed_data, fetch_garmin_concurrently
+
+
+def _make_client():
+    client = MagicMock()
+    client.get_user_summary.return_value = {
+        "restingHeartRate": 52,
+        "averageStressLevel": 30,
+        "bodyBatteryMostRecentValue": 70,
+        "bodyBatteryActivityEventList": [{"eventType": "NAP", "durationInMilliseconds": 1200000}]
+    }
+    client.get_sleep_data.return_value = {
+        "dailySleepDTO": {"deepSleepSeconds": 3600, "lightSleepSeconds": 14400, "remSleepSeconds": 3600, "awakeSleepSeconds": 600}
+    }
+    client.get_spo2_data.return_value = {"averageSpO2": 96, "lowestSpO2": 90, "latestSpO2": 97}
+    client.get_respiration_data.return_value = {"avgSleepRespirationValue": 14}
+    client.get_hrv_data.return_value = {"hrvStatus": "BALANCED", "lastNightAvg": 60}
+    client.get_training_status.return_value = {"trainingStatus": "PRODUCTIVE"}
+    client.get_activities_by_date.return_value = [
+        {"activityName": "Chạy sáng", "duration": 3600, "averageHR": 150, "maxHR": 175, "startTimeLocal": "2026-07-08 06:00:00"}
+    ]
+    client.get_all_day_stress.return_value = {
+        "stressValuesArray": [[1783468800000, 20]],
+        "bodyBatteryValuesArray": []
+    }
+    return client
+
+
+def test_get_processed_data_merges_concurrent_results():
+    client = _make_client()
+
+    r_data, r_score, l_data = get_processed_data(client, date(2026, 7, 8), "Test User")
+
+    assert r_data["rhr"] == 52
+    assert r_data["stress"] == 30
+    assert r_data["body_battery"] == 70
+    assert r_data["nap_seconds"] == 1200
+    assert r_data["sleep_hours"] == 6
+    assert r_data["avg_spo2"] == 96
+    assert r_data["avg_sleep_resp"] == 14
+    assert r_data["hrv_status"] == "BALANCED"
+    assert r_data["training_status"] == "PRODUCTIVE"
+    assert "Tập: Chạy sáng" in r_data["timeseries_text"]
+    assert l_data["final_calc_max_hr"] == 175
+    assert len(l_data["raw_activities_for_ai"]) == 1
+    assert isinstance(r_score, (int, float))
+
+    # Mỗi endpoint chỉ được gọi đúng một lần (không fetch lại all_day_stress)
+    client.get_all_day_stress.assert_called_once_with("2026-07-08")
+    client.get_activities_by_date.assert_called_once_with("2026-07-02", "2026-07-08", "")
+
+
+def test_get_processed_data_survives_failing_endpoints():
+    client = _make_client()
+    client.get_user_summary.side_effect = Exception("429 Too Many Requests")
+    client.get_all_day_stress.side_effect = Exception("boom")
+
+    r_data, _, l_data = get_processed_data(client, date(2026, 7, 8), "Test User")
+
+    assert r_data["rhr"] == 0
+    assert r_data["timeseries_text"] == "Lỗi lấy biểu đồ 24h."
+    assert r_data["hrv_status"] == "BALANCED"
+    assert l_data["final_calc_max_hr"] == 175
+
+
+def test_fetch_garmin_concurrently_runs_in_parallel_and_times_out():
+    def slow(value, delay):
+        time.sleep(delay)
+        return value
+
+    started = time.monotonic()
+    results = fetch_garmin_concurrently({
+        "a": (slow, 1, 0.2),
+        "b": (slow, 2, 0.2),
+        "c": (slow, 3, 0.2),
+        "hang": (slow, 4, 2.0),
+    }, max_workers=4, timeout=0.5)
+    elapsed = time.monotonic() - started
+
+    assert results == {"a": 1, "b": 2, "c": 3}
+    assert elapsed < 1.5
@@ -0,0 +1,90 @@
+import time
+from unittest.mock import MagicMock, patch
+
+from app.services.garmin_session import GarminSessionPool
+
+
+def _fake_garmin(expires_in):
+    client = MagicMock()
+    client.garth.oauth2_token.expires_at = time.time() + expires_in
+    return client
+
+
+def test_pool_reuses_logged_in_client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pool = GarminSessionPool()
+    fake = _fake_garmin(expires_in=3600)
+
+    with patch("app.services.garmin_session.Garmin", return_value=fake) as mock_cls:
+        first = pool.get_client("runner@example.com", "secret", "Runner")
+        second = pool.get_client("runner@example.com", "secret", "Runner")
+
+    assert first is second is fake
+    mock_cls.assert_called_once()
+    fake.login.assert_called_once()
+    fake.garth.refresh_oauth2.assert_not_called()
+    assert pool.stats == {"logins": 1, "reuses": 1, "refreshes": 0}
+
+
+def test_pool_refreshes_expiring_token_and_relogs_on_failure(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pool = GarminSessionPool()
+    expiring = _fake_garmin(expires_in=10)
+    replacement = _fake_garmin(expires_in=3600)
+
+    with patch("app.services.garmin_session.Garmin", side_effect=[expiring, replacement]):
+        pool.get_client("runner@example.com", "secret", "Runner")
+        assert pool.get_client("runner@example.com", "secret", "Runner") is expiring
+        expiring.garth.refresh_oauth2.assert_called_once()
+
+        expiring.garth.refresh_oauth2.side_effect = Exception("refresh rejected")
+        assert pool.get_client("runner@example.com", "secret", "Runner") is replacement
+
+    assert pool.stats["logins"] == 2
+    assert pool.stats["refreshes"] == 1
+
+
+def test_revoked_token_invalidates_session_and_relogs_once(tmp_path, monkeypatch):
+    from garminconnect import GarminConnectAuthenticationError
+    from app.services import garmin_service
+
+    monkeypatch.chdir(tmp_path)
+    pool = GarminSessionPool()
+    fake = _fake_garmin(expires_in=3600)
+    fake.username = "runner@example.com"
+    fake.password = "secret"
+    fake.get_device_last_used.side_effect = [
+        GarminConnectAuthenticationError("401 Unauthorized"),
+        {"lastUsedDeviceUploadTime": "2026-07-07T10:00:00.0", "lastUsedDeviceName": "FR965"},
+    ]
+
+    with patch("app.services.garmin_session.Garmin", return_value=fake), \
+         patch.object(garmin_service, "garmin_session_pool", pool):
+        client = pool.get_client("runner@example.com", "secret", "Runner")
+        watermark, device, _ = garmin_service.get_device_watermark(client, "Runner")
+
+    assert watermark > 0 and device == "FR965"
+    # Lần đầu đăng nhập bằng token, lần sau bằng password ngay trên client đang giữ
+    assert fake.login.call_count == 2 and fake.login.call_args.args == () and fake.login.call_args.kwargs == {}
+    assert pool.stats["logins"] == 2
+    assert pool._sessions["runner@example.com"]["client"] is fake
+
+
+def test_non_auth_errors_do_not_trigger_relogin(tmp_path, monkeypatch):
+    from app.services import garmin_service
+
+    monkeypatch.chdir(tmp_path)
+    pool = GarminSessionPool()
+    fake = _fake_garmin(expires_in=3600)
+    fake.username = "runner@example.com"
+    fake.password = "secret"
+    fake.get_device_last_used.side_effect = ConnectionError("timeout")
+    fake.get_user_summary.return_value = {}
+
+    with patch("app.services.garmin_session.Garmin", return_value=fake), \
+         patch.object(garmin_service, "garmin_session_pool", pool):
+        client = pool.get_client("runner@example.com", "secret", "Runner")
+        assert garmin_service.get_device_watermark(client, "Runner")[0] == 0
+
+    fake.login.assert_called_once()
+    assert pool.stats["logins"] == 1
@@ -0,0 +1,259 @@
+import asyncio
+import os
+import uuid
+from unittest.mock import patch
+
+import pytest
+import redis
+import redis.asyncio as aioredis
+
+from app.services.job_queue import JobQueue, JobWorker, decode_job, encode_job
+
+# Chạy với Redis local: TEST_REDIS_URL=redis://localhost:6379/15 (mặc định), không có Redis thì bỏ qua
+TEST_REDIS_URL = os.getenv("TEST_REDIS_URL", "redis://localhost:6379/15")
+
+
+def _redis_available():
+    try:
+        redis.Redis.from_url(TEST_REDIS_URL, socket_connect_timeout=0.5).ping()
+        return True
+    except Exception:
+        return False
+
+
+requires_redis = pytest.mark.skipif(not _redis_available(), reason=f"Redis không chạy tại {TEST_REDIS_URL}")
+
+
+def _queue(**overrides):
+    options = dict(
+        url=TEST_REDIS_URL, prefix=f"test_jobs:{uuid.uuid4().hex}", group="workers",
+        max_deliveries=3, visibility_timeout=0.3, retry_backoff=0.1, coalesce_ttl=60, maxlen=1000,
+    )
+    options.update(overrides)
+    return JobQueue(**options)
+
+
+async def _cleanup(queue):
+    client = aioredis.Redis.from_url(TEST_REDIS_URL, decode_responses=True)
+    keys = [key async for key in client.scan_iter(f"{queue.prefix}:*")]
+    if keys:
+        await client.delete(*keys)
+    await client.aclose()
+    await queue.close()
+
+
+async def _run_until(worker, condition, timeout=5.0):
+    task = asyncio.create_task(worker.run(drain_timeout=1.0))
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition() and loop.time() < deadline:
+        await asyncio.sleep(0.02)
+    worker.stop()
+    await task
+
+
+def test_encode_decode_round_trip():
+    fields = encode_job("ask", 123, "HRV?", enqueued_at=1.0)
+    assert fields == {"mode": "ask", "tele_id": "123", "question": "HRV?", "enqueued_at": "1.000"}
+    assert decode_job(fields) == ("ask", "123", "HRV?")
+    assert decode_job(encode_job("daily")) == ("daily", None, None)
+
+
+@requires_redis
+def test_enqueue_coalesces_pending_jobs_per_user_and_mode():
+    async def run():
+        queue = _queue()
+        try:
+            first, created = await queue.enqueue("daily", "1")
+            again, created_again = await queue.enqueue("daily", "1")
+            other_mode, _ = await queue.enqueue("battery", "1")
+            ask_1, _ = await queue.enqueue("ask", "1", "Ngủ thế nào?")
+            ask_2, _ = await queue.enqueue("ask", "1", "Ngủ thế nào?")
+            assert created and not created_again and again == first
+            assert len({first, other_mode, ask_1, ask_2}) == 4
+
+            # Job đã bắt đầu chạy: yêu cầu mới được xếp hàng chứ không gộp nữa
+            entries = await queue.read("c1", 10, block_ms=100)
+            message_id, fields = entries[0]
+            await queue.release_pending(fields, message_id)
+            _, created_after_start = await queue.enqueue("daily", "1")
+            assert created_after_start
+        finally:
+            await _cleanup(queue)
+
+    asyncio.run(run())
+
+
+@requires_redis
+def test_workers_share_the_stream_and_ack_every_job():
+    done = []
+
+    async def dispatch(mode, tele_id, question):
+        await asyncio.sleep(0.01)
+        done.append((mode, tele_id))
+
+    async def run():
+        queue = _queue()
+        try:
+            for i in range(6):
+                await queue.enqueue("daily", str(i))
+            workers = [JobWorker(queue, dispatch, consumer=f"w{n}", concurrency=2, block_ms=50) for n in range(2)]
+            await asyncio.gather(*(_run_until(w, lambda: len(done) == 6) for w in workers))
+            assert sorted(done) == [("daily", str(i)) for i in range(6)]
+            assert sum(w.stats["completed"] for w in workers) == 6
+            info = await queue.info()
+            assert info["pending"] == 0 and info["dead"] == 0
+        finally:
+            await _cleanup(queue)
+
+    asyncio.run(run())
+
+
+@requires_redis
+def test_failing_job_is_retried_then_dead_lettered():
+    attempts = []
+
+    async def dispatch(mode, tele_id, question):
+        attempts.append(tele_id)
+        raise RuntimeError("Garmin 500")
+
+    async def run():
+        queue = _queue(max_deliveries=2)
+        worker = JobWorker(queue, dispatch, consumer="w1", concurrency=1, block_ms=50)
+        try:
+            await queue.enqueue("workout", "7")
+            await _run_until(worker, lambda: worker.stats["dead"] == 1)
+            assert attempts == ["7", "7"]
+            assert worker.stats["retried"] == 1
+            dead = await queue.client.xrange(queue.dead_stream)
+            assert len(dead) == 1
+            assert dead[0][1]["tele_id"] == "7" and "Garmin 500" in dead[0][1]["error"]
+            assert (await queue.info())["pending"] == 0
+        finally:
+            await _cleanup(queue)
+
+    asyncio.run(run())
+
+
+@requires_redis
+def test_job_of_a_crashed_consumer_is_reclaimed():
+    done = []
+
+    async def dispatch(mode, tele_id, question):
+        done.append(question)
+
+    async def run():
+        queue = _queue()
+        try:
+            await queue.enqueue("ask", "5", "VO2max?")
+            # Consumer "crashed" nhận job rồi chết, không ack
+            assert len(await queue.read("crashed", 1, block_ms=100)) == 1
+            worker = JobWorker(queue, dispatch, consumer="w1", concurrency=1, block_ms=50)
+            await _run_until(worker, lambda: done)
+            assert done == ["VO2max?"]
+            assert worker.stats["reclaimed"] == 1
+            assert (await queue.info())["pending"] == 0
+        finally:
+            await _cleanup(queue)
+
+    asyncio.run(run())
+
+
+@requires_redis
+def test_jobs_of_one_user_never_overlap_across_workers():
+    running = {}
+    overlaps = []
+    done = []
+
+    async def dispatch(mode, tele_id, question):
+        running[tele_id] = running.get(tele_id, 0) + 1
+        if running[tele_id] > 1:
+            overlaps.append(tele_id)
+        await asyncio.sleep(0.05)
+        running[tele_id] -= 1
+        done.append((tele_id, question))
+
+    async def run():
+        queue = _queue(visibility_timeout=2.0)
+        try:
+            for i in range(3):
+                await queue.enqueue("ask", "9", f"q{i}")
+            await queue.enqueue("ask", "10", "khác")
+            workers = [JobWorker(queue, dispatch, consumer=f"w{n}", concurrency=2, block_ms=50, lock_wait=5.0) for n in range(2)]
+            await asyncio.gather(*(_run_until(w, lambda: len(done) == 4) for w in workers))
+            assert len(done) == 4
+            assert overlaps == []
+        finally:
+            await _cleanup(queue)
+
+    asyncio.run(run())
+
+
+@requires_redis
+def test_handler_failure_in_worker_mode_is_retried_then_dead_lettered():
+    import main
+
+    attempts = []
+
+    async def fake_bootstrap(mode, filter_tele_id=None, http_client=None, shared=None):
+        return [{"name": "U7", "email": "u7@x", "password": "p"}], {}, None
+
+    def fake_login(email, password, name):
+        attempts.append(name)
+        raise RuntimeError("Garmin 500")
+
+    async def dispatch(mode, tele_id, question):
+        await main.run_mode(mode, tele_id, question, raise_errors=True)
+
+    async def run():
+        queue = _queue(max_deliveries=2)
+        worker = JobWorker(queue, dispatch, consumer="w1", concurrency=1, block_ms=50)
+        try:
+            await queue.enqueue("sync", "7")
+            with patch.object(main, "bootstrap", new=fake_bootstrap), \
+                 patch.object(main, "login_garmin", side_effect=fake_login):
+                await _run_until(worker, lambda: worker.stats["dead"] == 1)
+            assert attempts == ["U7", "U7"]
+            assert worker.stats["retried"] == 1
+            dead = await queue.client.xrange(queue.dead_stream)
+            assert len(dead) == 1 and "Garmin 500" in dead[0][1]["error"]
+            assert (await queue.info())["pending"] == 0
+        finally:
+            await _cleanup(queue)
+
+    asyncio.run(run())
+
+
+@requires_redis
+def test_worker_acks_job_before_its_voice_note_finishes():
+    import main
+
+    voice_done = asyncio.Event()
+
+    async def fake_bootstrap(mode, filter_tele_id=None, http_client=None, shared=None):
+        return [{"name": "U8"}], {}, None
+
+    async def fake_handle(user):
+        main.spawn_background(voice_done.wait())
+
+    async def dispatch(mode, tele_id, question):
+        await main.run_mode(mode, tele_id, question, raise_errors=True, wait_background=False)
+
+    async def run():
+        queue = _queue()
+        worker = JobWorker(queue, dispatch, consumer="w1", concurrency=1, block_ms=50)
+        try:
+            await queue.enqueue("daily", "8")
+            with patch.object(main, "bootstrap", new=fake_bootstrap), \
+                 patch.object(main, "build_user_task", new=lambda mode, user, *a, **k: fake_handle(user)):
+                await _run_until(worker, lambda: worker.stats["completed"] == 1, timeout=2.0)
+            # Job đã ack (không còn pending) trong khi Voice Note vẫn chạy nền
+            assert worker.stats["completed"] == 1
+            assert (await queue.info())["pending"] == 0
+            assert not voice_done.is_set()
+            voice_done.set()
+            await main.drain_background_tasks()
+        finally:
+            await _cleanup(queue)
+
+    asyncio.run(run())
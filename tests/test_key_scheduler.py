@@ -0,0 +1,70 @@
+import asyncio
+import time
+from unittest.mock import patch
+
+from app.config import Config
+from app.services.key_scheduler import GeminiKeyManager, parse_retry_delay
+
+
+def test_quota_error_puts_key_on_cooldown_and_next_call_skips_it():
+    manager = GeminiKeyManager(keys=["key-aaaaa", "key-bbbbb"])
+    calls = []
+
+    def worker(key):
+        calls.append(key)
+        if key == "key-aaaaa":
+            raise Exception("429 RESOURCE_EXHAUSTED. Please retry in 42s.")
+        return "ok"
+
+    assert manager.execute_with_retry(worker, verbose_label="Test") == "ok"
+    assert calls == ["key-aaaaa", "key-bbbbb"]
+
+    calls.clear()
+    assert manager.execute_with_retry(worker, verbose_label="Test") == "ok"
+    # Key hết quota không được thử lại ngay
+    assert calls == ["key-bbbbb"]
+
+    snap = {s["key"]: s for s in manager.snapshot()}
+    assert snap["...aaaaa"]["quota"] == 1
+    assert 41 <= snap["...aaaaa"]["cooldown"] <= 60
+
+
+def test_scheduler_prefers_faster_healthier_key():
+    manager = GeminiKeyManager(keys=["slow-key", "fast-key"], rate_per_minute=100)
+    state = {s.key: s for s in manager._states}
+    state["slow-key"].latency_ewma = 8.0
+    state["fast-key"].latency_ewma = 1.0
+
+    picked = [manager.execute_with_retry(lambda key: key) for _ in range(5)]
+    assert picked == ["fast-key"] * 5
+
+
+def test_token_bucket_limits_rate_per_key():
+    manager = GeminiKeyManager(keys=["only-key"], rate_per_minute=2)
+    with patch.object(Config, "GEMINI_KEY_MAX_WAIT", 0.01):
+        assert manager.execute_with_retry(lambda key: 1) == 1
+        assert manager.execute_with_retry(lambda key: 2) == 2
+        # Hết token, phải chờ ~30s nên bỏ qua
+        assert manager.execute_with_retry(lambda key: 3, default_return="skipped") == "skipped"
+
+
+def test_aexecute_runs_keys_concurrently():
+    manager = GeminiKeyManager(keys=["k1", "k2", "k3"], rate_per_minute=60)
+
+    def worker(key):
+        time.sleep(0.2)
+        return key
+
+    async def run():
+        return await asyncio.gather(*(manager.aexecute(worker) for _ in range(3)))
+
+    started = time.monotonic()
+    result = asyncio.run(run())
+    assert sorted(result) == ["k1", "k2", "k3"]
+    assert time.monotonic() - started < 0.5
+
+
+def test_parse_retry_delay():
+    assert parse_retry_delay("Please retry in 23.5s") == 23.5
+    assert parse_retry_delay("{'retryDelay': '17s'}") == 17
+    assert parse_retry_delay("500 Internal") is None
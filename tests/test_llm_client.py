@@ -0,0 +1,77 @@
+import json
+import asyncio
+
+import httpx
+import pytest
+from openai import OpenAI, AsyncOpenAI
+
+from app.services.llm_client import LLMClientRegistry, LatencyHistogram
+
+
+def _completion_handler(request):
+    body = json.loads(request.content)
+    return httpx.Response(200, json={
+        "id": "cmpl-1",
+        "object": "chat.completion",
+        "created": 0,
+        "model": body["model"],
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "xin chào"}}],
+    })
+
+
+def test_sync_client_is_reused_and_latency_recorded():
+    registry = LLMClientRegistry()
+    assert registry.get_sync("key-a") is registry.get_sync("key-a")
+    assert registry.get_sync("key-a") is not registry.get_sync("key-b")
+
+    registry._sync_clients["key-a"] = OpenAI(
+        base_url="http://llm.test/v1", api_key="key-a",
+        http_client=httpx.Client(transport=httpx.MockTransport(_completion_handler))
+    )
+    for _ in range(3):
+        response = registry.chat_completion("key-a", "model-x", [{"role": "user", "content": "hi"}])
+        assert response.choices[0].message.content == "xin chào"
+
+    stats = registry.latency.snapshot()["model-x"]
+    assert stats["count"] == 3 and stats["errors"] == 0
+    assert "model-x: 3 lượt" in registry.latency.report()
+
+
+def test_async_client_is_cached_per_event_loop():
+    registry = LLMClientRegistry()
+
+    async def grab():
+        first = registry.get_async("key-a")
+        assert registry.get_async("key-a") is first
+        return first
+
+    c1 = asyncio.run(grab())
+    c2 = asyncio.run(grab())
+    assert c1 is not c2
+    # Client của loop cũ đã đóng được dọn đi
+    assert len(registry._async_clients) == 1
+
+
+def test_achat_completion_records_errors():
+    registry = LLMClientRegistry()
+
+    async def run():
+        registry._async_clients[("key-a", asyncio.get_running_loop())] = AsyncOpenAI(
+            base_url="http://llm.test/v1", api_key="key-a", max_retries=0,
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(lambda r: httpx.Response(500, json={"error": "boom"})))
+        )
+        with pytest.raises(Exception):
+            await registry.achat_completion("key-a", "model-y", [{"role": "user", "content": "hi"}])
+        await registry.aclose()
+
+    asyncio.run(run())
+    assert registry.latency.snapshot()["model-y"]["errors"] == 1
+
+
+def test_latency_histogram_percentiles():
+    hist = LatencyHistogram()
+    for seconds in [0.2, 0.3, 0.4, 1.5, 12.0]:
+        hist.record("m", seconds)
+    assert hist.percentile("m", 0.5) == 0.5
+    assert hist.percentile("m", 1.0) == 12.0
+    assert hist.percentile("missing", 0.5) is None
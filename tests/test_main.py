@@ -0,0 +1,247 @@
+import asyncio
+from unittest.mock import AsyncMock, patch
+
+import main
+
+
+def test_deliver_report_sends_text_before_voice_pipeline():
+    events = []
+
+    async def fake_report(*args, **kwargs):
+        events.append("text")
+
+    def fake_script(*args, **kwargs):
+        events.append("script")
+        return "kịch bản"
+
+    clip = {"data": b"OggS", "filename": "voice.ogg", "mime_type": "audio/ogg", "duration": 1}
+
+    async def fake_audio(text):
+        events.append("audio")
+        return clip
+
+    async def fake_voice(bot_token, chat_id, audio_clip, user_label):
+        assert audio_clip is clip
+        events.append("voice")
+        return True
+
+    user = {"name": "Test", "telegram_chat_id": "123"}
+
+    async def run():
+        with patch.object(main, "send_telegram_report", side_effect=fake_report), \
+             patch.object(main, "get_speech_script", side_effect=fake_script), \
+             patch.object(main, "generate_audio_from_text", side_effect=fake_audio), \
+             patch.object(main, "send_voice_note", side_effect=fake_voice):
+            task = await main.deliver_report(user, "Báo cáo", {}, "daily")
+            # Text đã gửi xong trước khi pipeline voice chạy
+            assert events == ["text"]
+            await main.drain_background_tasks()
+            return task
+
+    task = asyncio.run(run())
+    assert task.done()
+    assert events == ["text", "script", "audio", "voice"]
+
+
+def test_deliver_report_skips_voice_without_chat_id():
+    with patch.object(main, "send_telegram_report", new_callable=AsyncMock) as mock_send:
+        assert asyncio.run(main.deliver_report({"name": "Test"}, "Báo cáo", {}, "daily")) is None
+    mock_send.assert_not_awaited()
+
+
+def test_bootstrap_loads_users_prompts_and_aqi_concurrently_on_one_client():
+    started = []
+    clients = set()
+
+    async def slow(label, value, client):
+        started.append(label)
+        clients.add(id(client))
+        await asyncio.sleep(0.05)
+        # Cả 3 việc đã bắt đầu trước khi việc nào kết thúc
+        assert len(started) == 3
+        return value
+
+    users = [{"name": "A"}, {"name": "B"}]
+    aqi = {"aqi": 42, "pm25": 10, "city": "HN"}
+
+    with patch.object(main.user_directory, "aget_users", new=lambda client: slow("users", users, client)), \
+         patch.object(main.prompt_registry, "aget_prompts", new=lambda client: slow("prompts", {"daily_report": {}}, client)), \
+         patch.object(main.WeatherService, "aget_aqi_data", new=lambda client: slow("aqi", aqi, client)):
+        result = asyncio.run(main.bootstrap("daily"))
+
+    assert result == (users, {"daily_report": {}}, aqi)
+    assert len(clients) == 1
+
+
+def test_bootstrap_skips_prompts_and_aqi_in_sync_mode_and_filters_by_chat_id():
+    user = {"name": "A", "telegram_chat_id": "123"}
+    with patch.object(main.user_directory, "aget_user_by_chat_id", new_callable=AsyncMock, return_value=user) as by_id, \
+         patch.object(main.prompt_registry, "aget_prompts", new_callable=AsyncMock) as prompts, \
+         patch.object(main.WeatherService, "aget_aqi_data", new_callable=AsyncMock) as aqi:
+        assert asyncio.run(main.bootstrap("sync", "123")) == ([user], {}, None)
+
+    assert by_id.await_args.args[1] == "123"
+    prompts.assert_not_awaited()
+    aqi.assert_not_awaited()
+
+
+def test_shared_resources_reuse_aqi_and_prompts_across_worker_jobs():
+    user = {"name": "A", "telegram_chat_id": "123"}
+    aqi = {"aqi": 42, "pm25": 10, "city": "HN"}
+
+    async def run():
+        shared = main.SharedResources(ttl=60)
+        with patch.object(main.user_directory, "aget_user_by_chat_id", new_callable=AsyncMock, return_value=user) as by_id, \
+             patch.object(main.prompt_registry, "aget_prompts", new_callable=AsyncMock, return_value={"daily_report": {}}) as prompts, \
+             patch.object(main.WeatherService, "aget_aqi_data", new_callable=AsyncMock, return_value=aqi) as aqi_job:
+            # 3 job song song + 1 job sau: AQI và prompts chỉ tải 1 lần, user vẫn tra mỗi job
+            results = await asyncio.gather(*(main.bootstrap("daily", "123", object(), shared) for _ in range(3)))
+            results.append(await main.bootstrap("workout", "123", object(), shared))
+            assert all(r == ([user], {"daily_report": {}}, aqi) for r in results)
+            assert prompts.await_count == 1 and aqi_job.await_count == 1
+            assert by_id.await_count == 4
+
+            # Hết TTL thì tải lại
+            shared.ttl = 0
+            shared._entries.clear()
+            await main.bootstrap("daily", "123", object(), shared)
+            await main.bootstrap("daily", "123", object(), shared)
+            assert aqi_job.await_count == 3
+
+            # AQI lỗi (None) không bị cache
+            aqi_job.return_value = None
+            fresh = main.SharedResources(ttl=60)
+            await main.bootstrap("daily", "123", object(), fresh)
+            await main.bootstrap("daily", "123", object(), fresh)
+            assert aqi_job.await_count == 5
+
+    asyncio.run(run())
+
+
+def test_enqueue_jobs_fans_out_one_job_per_user_with_chat_id():
+    enqueued = []
+
+    class FakeQueue:
+        async def enqueue(self, mode, tele_id=None, question=None):
+            enqueued.append((mode, tele_id, question))
+            return f"{len(enqueued)}-0", tele_id != "2"
+
+    async def fake_users(client):
+        return [{"telegram_chat_id": "1"}, {"telegram_chat_id": "2"}, {"name": "No chat"}]
+
+    async def run():
+        with patch.object(main, "job_queue", FakeQueue()), \
+             patch.object(main.user_directory, "aget_users", new=fake_users):
+            return await main.enqueue_jobs("daily", http_client=object())
+
+    assert asyncio.run(run()) == 1
+    assert enqueued == [("daily", "1", None), ("daily", "2", None)]
+
+
+def test_background_voice_notes_share_the_concurrency_limit():
+    running = []
+    peak = []
+
+    async def fake_audio(text):
+        running.append(text)
+        peak.append(len(running))
+        await asyncio.sleep(0.02)
+        running.remove(text)
+        return None
+
+    async def run():
+        with patch.object(main.Config, "MAX_CONCURRENT_USERS", 2), \
+             patch.object(main, "get_speech_script", side_effect=lambda report, *a, **k: report), \
+             patch.object(main, "generate_audio_from_text", side_effect=fake_audio):
+            for i in range(6):
+                main.spawn_background(main.produce_voice_note(f"r{i}", {"name": f"U{i}"}, {}, "daily"))
+            await main.drain_background_tasks()
+
+    asyncio.run(run())
+    assert len(peak) == 6
+    assert max(peak) == 2
+
+
+def test_concurrent_run_mode_calls_share_one_user_limit():
+    running = []
+    peak = []
+
+    async def fake_bootstrap(mode, filter_tele_id=None, http_client=None, shared=None):
+        return [{"name": f"{filter_tele_id}-{i}"} for i in range(3)], {}, None
+
+    async def fake_handle(user):
+        running.append(user["name"])
+        peak.append(len(running))
+        await asyncio.sleep(0.02)
+        running.remove(user["name"])
+
+    async def run():
+        with patch.object(main.Config, "MAX_CONCURRENT_USERS", 2), \
+             patch.object(main, "bootstrap", new=fake_bootstrap), \
+             patch.object(main, "build_user_task", new=lambda mode, user, *a, **k: fake_handle(user)):
+            # 2 webhook chạy song song (mode serve) vẫn chung 1 giới hạn MAX_CONCURRENT_USERS
+            await asyncio.gather(main.run_mode("daily", "a"), main.run_mode("daily", "b"))
+
+    asyncio.run(run())
+    assert len(peak) == 6
+    assert max(peak) == 2
+
+
+def test_run_mode_raises_handler_errors_only_when_asked():
+    calls = []
+
+    async def fake_bootstrap(mode, filter_tele_id=None, http_client=None, shared=None):
+        return [{"name": "A", "email": "a@x", "password": "p"}, {"name": "B", "email": "b@x", "password": "p"}], {}, None
+
+    def fake_login(email, password, name):
+        calls.append(name)
+        raise RuntimeError(f"Garmin 500 ({name})")
+
+    async def run(**kwargs):
+        with patch.object(main, "bootstrap", new=fake_bootstrap), \
+             patch.object(main, "login_garmin", side_effect=fake_login):
+            await main.run_mode("sync", **kwargs)
+
+    # CLI / serve: lỗi chỉ được log
+    asyncio.run(run())
+    # Worker: vẫn chạy hết các user rồi ném lại lỗi để hàng đợi retry
+    calls.clear()
+    try:
+        asyncio.run(run(raise_errors=True))
+    except RuntimeError as e:
+        assert "Garmin 500" in str(e)
+    else:
+        raise AssertionError("run_mode(raise_errors=True) phải ném lỗi của handler")
+    assert sorted(calls) == ["A", "B"]
+
+
+def test_run_mode_waits_only_for_its_own_voice_notes():
+    finished = []
+
+    async def fake_bootstrap(mode, filter_tele_id=None, http_client=None, shared=None):
+        return [{"name": filter_tele_id}], {}, None
+
+    async def voice(name, delay):
+        await asyncio.sleep(delay)
+        finished.append(name)
+
+    async def fake_handle(user):
+        main.spawn_background(voice(user["name"], 0.02))
+
+    async def run():
+        with patch.object(main, "bootstrap", new=fake_bootstrap), \
+             patch.object(main, "build_user_task", new=lambda mode, user, *a, **k: fake_handle(user)):
+            # Voice Note của 1 lượt khác (vd. webhook khác trong mode serve) chưa xong
+            other = asyncio.Event()
+            stuck = main.spawn_background(other.wait())
+            await asyncio.wait_for(main.run_mode("daily", "a"), timeout=1.0)
+            assert finished == ["a"] and not stuck.done()
+
+            # Mode worker: không chờ Voice Note, job được ack ngay
+            await asyncio.wait_for(main.run_mode("daily", "b", wait_background=False), timeout=1.0)
+            assert finished == ["a"]
+            other.set()
+            await main.drain_background_tasks()
+            assert finished == ["a", "b"]
+
+    asyncio.run(run())
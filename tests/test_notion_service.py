@@ -0,0 +1,218 @@
+"""
+Tests cho UserDirectory: phân trang next_cursor, cache theo version và index tra cứu.
+"""
+import os
+from unittest.mock import MagicMock, patch
+
+from app.services.notion_service import UserDirectory
+
+
+def _page(i, edited="2024-01-01T00:00:00.000Z"):
+    return {
+        "id": f"page-{i}",
+        "last_edited_time": edited,
+        "properties": {
+            "Name": {"title": [{"plain_text": f"User {i}"}]},
+            "Email": {"email": f"User{i}@Example.com"},
+            "Password": {"rich_text": [{"plain_text": "pw"}]},
+            "Telegram Chat ID": {"rich_text": [{"plain_text": str(1000 + i)}]},
+        },
+    }
+
+
+class FakeNotion:
+    """
+    Giả lập databases/query: trả roster theo trang 100 dòng và trả dòng sửa gần nhất cho probe.
+    """
+    def __init__(self, count, edited="2024-01-01T00:00:00.000Z"):
+        self.pages = [_page(i, edited) for i in range(count)]
+        self.edited = edited
+        self.newest_id = "page-0"
+        self.calls = []
+        self.fail = False
+
+    def post(self, url, headers=None, json=None):
+        self.calls.append(json)
+        response = MagicMock()
+        if self.fail:
+            response.status_code = 500
+            response.text = "boom"
+            return response
+        response.status_code = 200
+        if "sorts" in json:
+            response.json.return_value = {"results": [{"id": self.newest_id, "last_edited_time": self.edited}], "has_more": True}
+            return response
+        start = int(json.get("start_cursor") or 0)
+        end = start + json["page_size"]
+        response.json.return_value = {
+            "results": self.pages[start:end],
+            "has_more": end < len(self.pages),
+            "next_cursor": str(end) if end < len(self.pages) else None,
+        }
+        return response
+
+    def client(self):
+        ctx = MagicMock()
+        ctx.__enter__ = MagicMock(return_value=self)
+        ctx.__exit__ = MagicMock(return_value=False)
+        return ctx
+
+    def full_queries(self):
+        return [c for c in self.calls if "sorts" not in c]
+
+
+def _run(notion, directory, fn):
+    with patch("app.services.notion_service.Config") as cfg, \
+         patch("app.services.notion_service.httpx.Client", side_effect=lambda **kw: notion.client()):
+        cfg.NOTION_TOKEN = "token"
+        cfg.NOTION_DATABASE_ID = "db"
+        return fn(directory)
+
+
+def test_pages_through_next_cursor_and_indexes_users(tmp_path):
+    notion = FakeNotion(250)
+    directory = UserDirectory(cache_path=str(tmp_path / "users.json"), trust_ttl=300, max_age=3600)
+
+    users = _run(notion, directory, lambda d: d.get_users())
+
+    assert len(users) == 250
+    assert len(notion.full_queries()) == 3
+    assert notion.full_queries()[-1]["start_cursor"] == "200"
+    assert _run(notion, directory, lambda d: d.get_user_by_chat_id(1249))["name"] == "User 249"
+    assert _run(notion, directory, lambda d: d.get_user_by_email(" user7@example.COM "))["name"] == "User 7"
+
+
+def test_roster_with_passwords_is_never_mirrored_to_redis(tmp_path):
+    from app.services.redis_service import redis_service
+
+    notion = FakeNotion(3)
+    directory = UserDirectory(cache_path=str(tmp_path / "users.json"), trust_ttl=300, max_age=3600)
+    with patch.object(redis_service, "set_cache") as set_cache, patch.object(redis_service, "get_cache") as get_cache:
+        _run(notion, directory, lambda d: d.get_users(force_refresh=True))
+    set_cache.assert_not_called()
+    get_cache.assert_not_called()
+    assert oct(os.stat(tmp_path / "users.json").st_mode & 0o777) == "0o600"
+
+def test_trusted_cache_skips_notion_and_local_file_survives_restart(tmp_path):
+    notion = FakeNotion(3)
+    path = str(tmp_path / "users.json")
+    _run(notion, UserDirectory(cache_path=path, trust_ttl=300, max_age=3600), lambda d: d.get_users())
+    calls = len(notion.calls)
+
+    # Process mới (CI run khác): đọc từ file, không gọi Notion
+    user = _run(notion, UserDirectory(cache_path=path, trust_ttl=300, max_age=3600), lambda d: d.get_user_by_chat_id("1001"))
+
+    assert user["email"] == "User1@Example.com"
+    assert len(notion.calls) == calls
+
+
+def test_unchanged_version_only_probes_and_changed_version_reloads(tmp_path):
+    notion = FakeNotion(3)
+    directory = UserDirectory(cache_path=str(tmp_path / "users.json"), trust_ttl=0, max_age=3600)
+    _run(notion, directory, lambda d: d.get_users())
+    assert len(notion.full_queries()) == 1
+
+    _run(notion, directory, lambda d: d.get_users())
+    assert len(notion.full_queries()) == 1
+    assert directory.stats["probe_hits"] == 1
+
+    notion.pages.append(_page(3, "2024-02-01T00:00:00.000Z"))
+    notion.edited = "2024-02-01T00:00:00.000Z"
+    users = _run(notion, directory, lambda d: d.get_users())
+    assert len(users) == 4
+    assert len(notion.full_queries()) == 2
+
+
+def test_probe_catches_same_minute_edits_and_deleting_the_newest_row(tmp_path):
+    from datetime import datetime, timezone
+
+    # Notion làm tròn theo phút: dòng vừa sửa trong phút hiện tại
+    minute = datetime.now(timezone.utc).replace(second=0, microsecond=0).strftime("%Y-%m-%dT%H:%M:00.000Z")
+    notion = FakeNotion(3, edited=minute)
+    directory = UserDirectory(cache_path="", trust_ttl=0, max_age=3600)
+    _run(notion, directory, lambda d: d.get_users())
+
+    # Sửa thêm trong cùng phút: version y hệt nhưng roster tải trước khi phút kết thúc -> tải lại
+    notion.pages[1] = _page(1, minute)
+    notion.pages[1]["properties"]["Telegram Chat ID"]["rich_text"][0]["plain_text"] = "2001"
+    assert _run(notion, directory, lambda d: d.get_user_by_chat_id("2001"))["name"] == "User 1"
+    assert directory.stats["probe_hits"] == 0
+
+    # Phút đã qua: version cũ, chỉ probe
+    notion.edited = "2024-01-01T00:00:00.000Z"
+    _run(notion, directory, lambda d: d.get_users())
+    full = len(notion.full_queries())
+    _run(notion, directory, lambda d: d.get_users())
+    assert directory.stats["probe_hits"] == 1 and len(notion.full_queries()) == full
+
+    # Xóa dòng sửa gần nhất: dòng mới nhất còn lại có id khác -> tải lại
+    notion.pages.pop(0)
+    notion.newest_id = "page-2"
+    assert len(_run(notion, directory, lambda d: d.get_users())) == 2
+
+
+def test_roster_is_not_written_to_disk_without_cache_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    notion = FakeNotion(2)
+    _run(notion, UserDirectory(cache_path="", trust_ttl=300, max_age=3600), lambda d: d.get_users())
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_unknown_chat_id_revalidates_once_and_finds_new_user(tmp_path):
+    notion = FakeNotion(2)
+    directory = UserDirectory(cache_path=str(tmp_path / "users.json"), trust_ttl=300, max_age=3600)
+    _run(notion, directory, lambda d: d.get_users())
+
+    notion.pages.append(_page(5, "2024-03-01T00:00:00.000Z"))
+    notion.edited = "2024-03-01T00:00:00.000Z"
+    user = _run(notion, directory, lambda d: d.get_user_by_chat_id(1005))
+
+    assert user["name"] == "User 5"
+
+
+def test_notion_failure_falls_back_to_stale_snapshot(tmp_path):
+    notion = FakeNotion(2)
+    directory = UserDirectory(cache_path=str(tmp_path / "users.json"), trust_ttl=0, max_age=3600)
+    _run(notion, directory, lambda d: d.get_users())
+
+    notion.fail = True
+    users = _run(notion, directory, lambda d: d.get_users())
+
+    assert len(users) == 2
+    assert directory.stats["stale"] == 1
+
+
+def test_async_loader_shares_logic_with_sync_path(tmp_path):
+    import asyncio
+
+    notion = FakeNotion(150)
+
+    class AsyncClient:
+        async def post(self, url, headers=None, json=None, timeout=None):
+            return notion.post(url, headers=headers, json=json)
+
+    directory = UserDirectory(cache_path=str(tmp_path / "users.json"), trust_ttl=300, max_age=3600)
+    user = _run(notion, directory, lambda d: asyncio.run(d.aget_user_by_chat_id(AsyncClient(), "1149")))
+
+    assert user["name"] == "User 149"
+    assert len(notion.full_queries()) == 2
+
+
+def test_blocking_steps_run_off_the_event_loop_in_async_driver():
+    import asyncio
+    import threading
+    from app.services.notion_service import BlockingCall, run_notion_async, run_notion_sync
+
+    def steps():
+        worker = yield BlockingCall(threading.get_ident)
+        return worker
+
+    async def run():
+        return await run_notion_async(steps(), "token", client=None), threading.get_ident()
+
+    worker, loop_thread = asyncio.run(run())
+    assert worker != loop_thread
+    # Driver sync gọi thẳng, không mở httpx.Client khi không có request
+    with patch("app.services.notion_service.httpx.Client") as client_cls:
+        assert run_notion_sync(steps(), "token") == threading.get_ident()
+    client_cls.assert_not_called()
@@ -6,9 +6,16 @@ Tests for get_prompts_from_notion() focusing on:
 from unittest.mock import patch, MagicMock
 import pytest
 
+from app.services import prompt_service
 from app.services.prompt_service import get_prompts_from_notion
 
 
+@pytest.fixture(autouse=True)
+def fresh_registry(monkeypatch):
+    """Mỗi test dùng registry mới, không đọc/ghi snapshot local hay Redis."""
+    monkeypatch.setattr(prompt_service, "prompt_registry", prompt_service.PromptRegistry(cache_path="", use_redis=False))
+
+
 def _make_notion_response(rows: list[dict]) -> dict:
     """Build a fake Notion API response from a list of row dicts.
     Each row dict: {name: str, system_prompt: str, user_template: str, active: bool|None}
@@ -53,7 +60,7 @@ class TestMissingAskHelp:
             {"name": "battery_analysis", "active": True},
         ])
         with patch("app.services.prompt_service.Config") as mock_cfg, \
-             patch("app.services.prompt_service.httpx.Client") as mock_cls:
+             patch("app.services.notion_service.httpx.Client") as mock_cls:
             mock_cfg.NOTION_TOKEN = "fake-token"
             mock_cfg.NOTION_PROMPT_DATABASE_ID = "fake-db-id"
             mock_cfg.ROUTER9_COMBOS_MODEL = "gemini-pro"
@@ -69,7 +76,7 @@ class TestMissingAskHelp:
         """DB has zero rows → empty dict."""
         data = _make_notion_response([])
         with patch("app.services.prompt_service.Config") as mock_cfg, \
-             patch("app.services.prompt_service.httpx.Client") as mock_cls:
+             patch("app.services.notion_service.httpx.Client") as mock_cls:
             mock_cfg.NOTION_TOKEN = "fake-token"
             mock_cfg.NOTION_PROMPT_DATABASE_ID = "fake-db-id"
             mock_cfg.ROUTER9_COMBOS_MODEL = "gemini-pro"
@@ -99,7 +106,7 @@ class TestKeyNormalization:
             {"name": raw_name, "system_prompt": "sys", "user_template": "usr", "active": True}
         ])
         with patch("app.services.prompt_service.Config") as mock_cfg, \
-             patch("app.services.prompt_service.httpx.Client") as mock_cls:
+             patch("app.services.notion_service.httpx.Client") as mock_cls:
             mock_cfg.NOTION_TOKEN = "fake-token"
             mock_cfg.NOTION_PROMPT_DATABASE_ID = "fake-db-id"
             mock_cfg.ROUTER9_COMBOS_MODEL = "gemini-pro"
@@ -117,7 +124,7 @@ class TestKeyNormalization:
             {"name": "ask  help", "active": True}
         ])
         with patch("app.services.prompt_service.Config") as mock_cfg, \
-             patch("app.services.prompt_service.httpx.Client") as mock_cls:
+             patch("app.services.notion_service.httpx.Client") as mock_cls:
             mock_cfg.NOTION_TOKEN = "fake-token"
             mock_cfg.NOTION_PROMPT_DATABASE_ID = "fake-db-id"
             mock_cfg.ROUTER9_COMBOS_MODEL = "gemini-pro"
@@ -139,7 +146,7 @@ class TestActiveFilter:
             {"name": "ask_help", "active": False}
         ])
         with patch("app.services.prompt_service.Config") as mock_cfg, \
-             patch("app.services.prompt_service.httpx.Client") as mock_cls:
+             patch("app.services.notion_service.httpx.Client") as mock_cls:
             mock_cfg.NOTION_TOKEN = "fake-token"
             mock_cfg.NOTION_PROMPT_DATABASE_ID = "fake-db-id"
             mock_cfg.ROUTER9_COMBOS_MODEL = "gemini-pro"
@@ -155,7 +162,7 @@ class TestActiveFilter:
             {"name": "ask_help", "system_prompt": "Help sys", "user_template": "Help usr", "active": True}
         ])
         with patch("app.services.prompt_service.Config") as mock_cfg, \
-             patch("app.services.prompt_service.httpx.Client") as mock_cls:
+             patch("app.services.notion_service.httpx.Client") as mock_cls:
             mock_cfg.NOTION_TOKEN = "fake-token"
             mock_cfg.NOTION_PROMPT_DATABASE_ID = "fake-db-id"
             mock_cfg.ROUTER9_COMBOS_MODEL = "gemini-pro"
@@ -166,3 +173,113 @@ class TestActiveFilter:
         assert "ask_help" in prompts
         assert prompts["ask_help"]["system_prompt"] == "Help sys"
         assert prompts["ask_help"]["user_template"] == "Help usr"
+
+
+# ---------------------------------------------------------------------------
+# Registry: delta refresh theo last_edited_time, snapshot dự phòng, template compile sẵn
+# ---------------------------------------------------------------------------
+def _page(page_id, name, edited, user_template="usr {user_label}", active=True):
+    return {
+        "id": page_id,
+        "last_edited_time": edited,
+        "properties": {
+            "Name": {"title": [{"plain_text": name}]},
+            "System Prompt": {"rich_text": [{"plain_text": "sys"}]},
+            "User Template": {"rich_text": [{"plain_text": user_template}]},
+            "Active": {"checkbox": active},
+        },
+    }
+
+
+class _FakeNotion:
+    def __init__(self, pages):
+        self.pages = pages
+        self.payloads = []
+        self.error = None
+
+    def post(self, url, headers=None, json=None):
+        self.payloads.append(json)
+        if self.error:
+            raise self.error
+        since = (json.get("filter") or {}).get("last_edited_time", {}).get("on_or_after")
+        rows = [p for p in self.pages if not since or p["last_edited_time"] >= since]
+        response = MagicMock()
+        response.status_code = 200
+        response.json.return_value = {"results": rows, "has_more": False}
+        return response
+
+
+def _registry_run(registry, notion):
+    client = MagicMock()
+    client.__enter__ = MagicMock(return_value=notion)
+    client.__exit__ = MagicMock(return_value=False)
+    with patch("app.services.prompt_service.Config") as mock_cfg, \
+         patch("app.services.notion_service.httpx.Client", return_value=client):
+        mock_cfg.NOTION_TOKEN = "fake-token"
+        mock_cfg.NOTION_PROMPT_DATABASE_ID = "fake-db-id"
+        mock_cfg.ROUTER9_COMBOS_MODEL = "gemini-pro"
+        return registry.get_prompts()
+
+
+class TestPromptRegistry:
+    def test_second_run_only_queries_changed_pages(self, tmp_path):
+        notion = _FakeNotion([
+            _page("p1", "daily", "2024-01-01T00:00:00.000Z"),
+            _page("p2", "ask_help", "2024-01-02T00:00:00.000Z"),
+        ])
+        path = str(tmp_path / "prompts.json")
+        _registry_run(prompt_service.PromptRegistry(cache_path=path, use_redis=False), notion)
+        assert notion.payloads[0].get("filter") is None
+
+        # Lần chạy sau (process mới) chỉ hỏi các page sửa từ mốc version
+        notion.pages[0] = _page("p1", "daily", "2024-01-03T00:00:00.000Z", user_template="mới {goal}")
+        notion.pages[1] = _page("p2", "ask_help", "2024-01-02T00:00:00.000Z", active=False)  # chưa sửa thật
+        registry = prompt_service.PromptRegistry(cache_path=path, use_redis=False)
+        prompts = _registry_run(registry, notion)
+
+        assert notion.payloads[1]["filter"]["last_edited_time"]["on_or_after"] == "2024-01-02T00:00:00.000Z"
+        assert prompts["daily"]["user_template"] == "mới {goal}"
+        assert prompt_service.compile_template(prompts["daily"]["user_template"]).fields == {"goal"}
+        # Page p2 trả về cùng last_edited_time nên không bị parse lại
+        assert "ask_help" in prompts
+        assert registry.stats == {"full_loads": 0, "delta_loads": 1, "changed_pages": 1, "stale": 0}
+
+    def test_deactivated_page_is_removed_on_delta(self, tmp_path):
+        notion = _FakeNotion([_page("p1", "daily", "2024-01-01T00:00:00.000Z")])
+        registry = prompt_service.PromptRegistry(cache_path=str(tmp_path / "p.json"), use_redis=False)
+        _registry_run(registry, notion)
+
+        notion.pages[0] = _page("p1", "daily", "2024-01-05T00:00:00.000Z", active=False)
+        assert _registry_run(registry, notion) == {}
+
+    def test_slow_notion_falls_back_to_last_snapshot(self, tmp_path):
+        import httpx
+
+        notion = _FakeNotion([_page("p1", "daily", "2024-01-01T00:00:00.000Z")])
+        registry = prompt_service.PromptRegistry(cache_path=str(tmp_path / "p.json"), use_redis=False)
+        _registry_run(registry, notion)
+
+        notion.error = httpx.ReadTimeout("slow")
+        prompts = _registry_run(registry, notion)
+
+        assert prompts["daily"]["system_prompt"] == "sys"
+        assert registry.stats["stale"] == 1
+
+
+class TestPromptTemplate:
+    def test_fields_and_render(self):
+        template = prompt_service.compile_template("Chào {user_label}, HRV {r_data[hrv]} {{giữ nguyên}}")
+        assert template.fields == {"user_label", "r_data"}
+        assert template.render(user_label="An", r_data={"hrv": 50}, extra=1) == "Chào An, HRV 50 {giữ nguyên}"
+        assert prompt_service.compile_template(template.text) is template
+
+    def test_invalid_templates_are_flagged_once(self):
+        for text in ["mở { không đóng", "vị trí {}", "số {0}"]:
+            template = prompt_service.PromptTemplate(text)
+            assert template.error
+            with pytest.raises(ValueError):
+                template.render()
+
+    def test_missing_placeholder_raises_key_error(self):
+        with pytest.raises(KeyError):
+            prompt_service.PromptTemplate("{goal} {injury}").render(goal="x")
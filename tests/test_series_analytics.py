@@ -0,0 +1,44 @@
+import json
+
+from app.utils.series_analytics import describe_series, describe_body_battery, describe_steps, summarize_tool_payload, STRESS_ZONES
+
+
+def _points(values, start_minute=0, step=5):
+    return [{"time": f"{(start_minute + i * step) // 60:02d}:{(start_minute + i * step) % 60:02d}", "value": v}
+            for i, v in enumerate(values)]
+
+
+def test_describe_series_reports_extremes_change_point_and_zones():
+    points = _points([20] * 24 + [80] * 24, start_minute=8 * 60)
+
+    text = describe_series(points, "Stress", zones=STRESS_ZONES)
+
+    assert "48 mẫu (08:00–11:55)" in text
+    assert "Thấp nhất 20 lúc 08:00; cao nhất 80 lúc 10:00" in text
+    assert "Đổi xu hướng quanh 10:00: TB 20 → 80 (tăng)" in text
+    assert "Nghỉ ngơi (0-25) 2h00p" in text
+    assert "Cao (76-100) 2h00p" in text
+
+
+def test_describe_body_battery_finds_fastest_charge_and_drain():
+    values = [30, 35, 45, 60, 62, 62, 55, 40, 38, 37]
+    text = describe_body_battery(_points(values, start_minute=13 * 60, step=15), window_minutes=30)
+
+    assert "Sạc nhanh nhất (30 phút): 13:15–13:45 (+25)" in text
+    assert "Tụt nhanh nhất (30 phút): 14:15–14:45 (-22)" in text
+
+
+def test_describe_steps_and_unknown_tool():
+    entries = [
+        {"time": "07:00", "steps": 1200, "activity_level": "active"},
+        {"time": "07:15", "steps": 800, "activity_level": "active"},
+        {"time": "18:30", "steps": 300, "activity_level": "sedentary"},
+    ]
+    text = describe_steps(entries)
+
+    assert "tổng 2300 bước" in text
+    assert "07:00 (2000 bước)" in text
+    assert summarize_tool_payload("get_spo2_data", {"averageSpO2": 96}) is None
+    assert "Nhịp tim" in summarize_tool_payload("get_heart_rates", json.loads(json.dumps({
+        "restingHeartRate": 50, "heart_rate_readings": _points([60, 70, 80])
+    })))
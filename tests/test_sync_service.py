@@ -0,0 +1,67 @@
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+from app.services.sync_service import sync_user, SYNC_DAY_METHODS
+from app.services.timeseries_store import TimeSeriesStore, VN_TZ
+
+
+def _make_client(upload_ms):
+    client = MagicMock()
+    client.username = "runner@example.com"
+    client.get_device_last_used.return_value = {"lastUsedDeviceUploadTime": upload_ms, "lastUsedDeviceName": "FR965"}
+    for method_name in SYNC_DAY_METHODS:
+        getattr(client, method_name).return_value = {"method": method_name}
+    client.get_activities_by_date.return_value = []
+    return client
+
+
+def test_sync_user_uses_watermark_and_serves_open_day_from_store(tmp_path):
+    store = TimeSeriesStore(path=str(tmp_path / "store.sqlite3"), settle_hours=6)
+    now = datetime.now(VN_TZ)
+    today = now.strftime("%Y-%m-%d")
+    upload_ms = int(now.timestamp() * 1000)
+
+    with patch("app.services.sync_service.timeseries_store", store), \
+         patch("app.services.garmin_service.timeseries_store", store):
+        client = _make_client(upload_ms)
+
+        written = sync_user(client, "Test User", days_back=3)
+        assert written > 0
+        assert store.get_sync_state("runner@example.com") == upload_ms
+        assert client.get_heart_rates.call_count == 3
+
+        # Không có upload mới -> không gọi lại Garmin
+        client.reset_mock()
+        assert sync_user(client, "Test User", days_back=3) == 0
+        client.get_heart_rates.assert_not_called()
+
+        # Report mode đọc dữ liệu hôm nay trực tiếp từ store
+        assert store.fetch(client, "get_heart_rates", today) == {"method": "get_heart_rates"}
+        client.get_heart_rates.assert_not_called()
+
+        # Thiết bị upload thêm -> dữ liệu hôm nay không còn dùng được, sync chỉ kéo lại các ngày chưa đóng
+        store.note_watermark("runner@example.com", upload_ms + 60000)
+        store.fetch(client, "get_heart_rates", today)
+        client.get_heart_rates.assert_called_once_with(today)
+
+        client = _make_client(upload_ms + 60000)
+        sync_user(client, "Test User", days_back=3)
+        first_open = datetime.fromtimestamp(upload_ms / 1000 - 6 * 3600, VN_TZ).date()
+        expected = [d.isoformat() for d in (first_open, now.date())]
+        assert [c.args[0] for c in client.get_heart_rates.call_args_list] == sorted(set(expected))
+
+
+def test_fetch_activities_only_requests_missing_days(tmp_path):
+    store = TimeSeriesStore(path=str(tmp_path / "store.sqlite3"), settle_hours=6)
+    client = MagicMock()
+    client.username = "runner@example.com"
+    client.get_activities_by_date.return_value = [
+        {"activityName": "Run", "startTimeLocal": "2026-07-03 06:00:00"},
+    ]
+    store.note_watermark("runner@example.com", int(VN_TZ.localize(datetime(2026, 7, 10)).timestamp() * 1000))
+
+    first = store.fetch_activities(client, "2026-07-01", "2026-07-05")
+    second = store.fetch_activities(client, "2026-07-01", "2026-07-05")
+
+    assert first == second == [{"activityName": "Run", "startTimeLocal": "2026-07-03 06:00:00"}]
+    client.get_activities_by_date.assert_called_once_with("2026-07-01", "2026-07-05", "")
@@ -0,0 +1,64 @@
+import re
+
+from app.utils.telegram_html import (
+    html_to_plain,
+    markdown_to_telegram_html,
+    render_telegram_chunks,
+)
+
+
+def _balanced(html_text):
+    stack = []
+    for closing, tag in re.findall(r"<(/?)(b|i|code)>", html_text):
+        if closing:
+            if not stack or stack.pop() != tag:
+                return False
+        else:
+            stack.append(tag)
+    return not stack
+
+
+def test_converts_headers_bold_italic_and_code_in_one_pass():
+    text = "## Tổng quan **hôm nay**\n* HRV *ổn định*, _nghỉ ngơi_ tốt\n`a<b` & snake_case_name"
+    assert markdown_to_telegram_html(text) == (
+        "<b>Tổng quan hôm nay</b>\n"
+        "* HRV <b>ổn định</b>, <i>nghỉ ngơi</i> tốt\n"
+        "<code>a&lt;b</code> &amp; snake_case_name"
+    )
+
+
+def test_unmatched_and_crossed_markers_never_produce_unbalanced_tags():
+    for text in ["**mở mà không đóng", "*a _b* c_", "***t***", "x ** y", "****", "_a **b_ c**"]:
+        assert _balanced(markdown_to_telegram_html(text)), text
+
+
+def test_chunks_prefer_paragraph_boundaries():
+    text = ("a" * 3000) + "\n\n" + ("b" * 3000)
+    assert render_telegram_chunks(text) == ["a" * 3000, "b" * 3000]
+
+
+def test_long_line_is_split_with_tags_closed_and_reopened():
+    text = "**" + ("từ " * 3000) + "**"
+    chunks = render_telegram_chunks(text, limit=1000)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert len(chunk) <= 1000
+        assert chunk.startswith("<b>") and chunk.endswith("</b>")
+        assert _balanced(chunk)
+    assert "".join(html_to_plain(c) for c in chunks).split() == ["từ"] * 3000
+
+
+def test_chunk_limit_counts_emoji_as_two_units():
+    chunks = render_telegram_chunks("🔥" * 3000)
+    assert [len(c) for c in chunks] == [2048, 952]
+
+
+def test_empty_text_produces_no_chunks():
+    assert render_telegram_chunks("") == []
+    assert render_telegram_chunks("\n\n") == []
+
+
+def test_long_line_split_never_cuts_inside_an_entity():
+    chunks = render_telegram_chunks("a<b&" * 500, limit=100)
+    assert all(len(c) <= 100 for c in chunks)
+    assert "".join(html_to_plain(c) for c in chunks) == "a<b&" * 500
@@ -0,0 +1,242 @@
+import asyncio
+import threading
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from app.config import Config
+from app.services import telegram_service
+from app.services.telegram_service import TelegramStreamingMessage
+
+
+def _mock_bot():
+    bot = MagicMock()
+    bot.send_message = AsyncMock(return_value=MagicMock(message_id=42))
+    bot.edit_message_text = AsyncMock()
+    return bot
+
+
+def _fast_limits():
+    return patch.multiple(Config, TELEGRAM_CHAT_RATE=1000, TELEGRAM_CHAT_BURST=1000)
+
+
+def test_streaming_message_throttles_edits_and_finishes_with_html():
+    bot = _mock_bot()
+
+    async def run():
+        stream = TelegramStreamingMessage("token", 123, "Test", min_interval=0.05).start()
+
+        def producer():
+            text = ""
+            for i in range(50):
+                text += f"dòng {i}\n"
+                stream.push(text)
+                threading.Event().wait(0.005)
+
+        await asyncio.to_thread(producer)
+        await asyncio.sleep(0.1)
+        delivered = await stream.finish("**Xong**")
+        return stream, delivered
+
+    with _fast_limits(), patch.object(telegram_service.telegram_client, "get_bot", return_value=bot):
+        stream, delivered = asyncio.run(run())
+
+    assert delivered and stream.delivered
+    bot.send_message.assert_awaited_once()
+    # Số lần sửa ít hơn nhiều so với số lần push
+    assert 1 <= bot.edit_message_text.await_count < 20
+    final = bot.edit_message_text.await_args
+    assert final.kwargs["text"] == "<b>Xong</b>"
+    assert final.kwargs["parse_mode"] == "HTML"
+    assert final.kwargs["message_id"] == 42
+
+
+def test_streaming_message_failure_replaces_partial_text():
+    bot = _mock_bot()
+
+    async def run():
+        stream = TelegramStreamingMessage("token", 123, "Test", min_interval=0).start()
+        stream.push("đang viết")
+        await asyncio.sleep(0.05)
+        return await stream.finish(None)
+
+    with _fast_limits(), patch.object(telegram_service.telegram_client, "get_bot", return_value=bot):
+        assert asyncio.run(run()) is False
+    assert "AI Coach" in bot.edit_message_text.await_args.kwargs["text"]
+
+
+def test_streaming_message_splits_long_report_and_keeps_keyboard_on_last():
+    bot = _mock_bot()
+
+    async def run():
+        stream = TelegramStreamingMessage("token", 123, "Test", min_interval=0).start()
+        return await stream.finish(("**a**" * 1000) + "\n\n" + ("b" * 3000))
+
+    with _fast_limits(), patch.object(telegram_service.telegram_client, "get_bot", return_value=bot):
+        assert asyncio.run(run()) is True
+
+    texts = [call.kwargs["text"] for call in bot.send_message.await_args_list]
+    assert len(texts) == 3
+    assert all(len(text) <= 4096 for text in texts)
+    assert texts[-1] == "b" * 3000
+    assert bot.send_message.await_args_list[0].kwargs["reply_markup"] is None
+    assert bot.send_message.await_args_list[-1].kwargs["reply_markup"] is not None
+
+
+def test_telegram_client_reuses_one_pool_and_counts_requests():
+    import json
+    from telegram.request import HTTPXRequest
+    from app.services.telegram_service import TelegramClient, send_progress_update
+
+    message = {"message_id": 1, "date": 0, "chat": {"id": 123, "type": "private"}, "text": "x"}
+    fake_response = (200, json.dumps({"ok": True, "result": message}).encode())
+
+    client = TelegramClient()
+
+    async def run():
+        with _fast_limits(), patch.object(telegram_service, "telegram_client", client), \
+             patch.object(HTTPXRequest, "do_request", new_callable=AsyncMock, return_value=fake_response):
+            first = client.get_bot("123:abc")
+            for i in range(3):
+                await send_progress_update("123:abc", "⏳", 100 + i, "Test")
+            assert client.get_bot("123:abc") is first
+            request = next(iter(client._bots.values()))[1]
+            await client.shutdown()
+            return request
+
+    request = asyncio.run(run())
+    assert request._client.is_closed
+    assert client.stats["pools"] == 1
+    assert client.request_count() == 3
+    assert client._bots == {}
+
+
+def _retry_after(seconds):
+    from telegram.error import RetryAfter
+    return RetryAfter(seconds)
+
+
+def test_outbox_rate_limits_per_chat_and_supersedes_progress():
+    from app.services.telegram_service import TelegramOutbox, PRIORITY_PROGRESS
+
+    outbox = TelegramOutbox()
+    sent = []
+
+    def action(label):
+        async def run(bot):
+            sent.append((label, asyncio.get_running_loop().time()))
+            return label
+        return run
+
+    async def run():
+        progress = [
+            asyncio.create_task(outbox.send("t", 1, action(f"p{i}"), priority=PRIORITY_PROGRESS, supersede_key=("progress", 1)))
+            for i in range(5)
+        ]
+        await asyncio.sleep(0)
+        report = asyncio.create_task(outbox.send("t", 1, action("report")))
+        other = asyncio.create_task(outbox.send("t", 2, action("other")))
+        results = await asyncio.gather(*progress, report, other)
+        await outbox.drain()
+        return results
+
+    with patch.multiple(Config, TELEGRAM_CHAT_RATE=20, TELEGRAM_CHAT_BURST=1, TELEGRAM_GLOBAL_RATE=1000), \
+         patch.object(telegram_service.telegram_client, "get_bot", return_value=MagicMock()):
+        results = asyncio.run(run())
+
+    # Progress cũ bị thay thế, báo cáo làm progress còn chờ trở nên thừa
+    assert results[-2:] == ["report", "other"]
+    labels = [label for label, _ in sent]
+    assert "report" in labels and "other" in labels
+    assert sum(1 for label in labels if label.startswith("p")) <= 1
+    chat1 = [t for label, t in sent if label != "other"]
+    if len(chat1) == 2:
+        assert chat1[1] - chat1[0] >= 0.04
+    assert outbox.stats["superseded"] >= 4
+
+
+def test_outbox_honours_retry_after_and_retries_reports():
+    from app.services.telegram_service import TelegramOutbox
+
+    outbox = TelegramOutbox()
+    attempts = []
+
+    async def flaky(bot):
+        attempts.append(asyncio.get_running_loop().time())
+        if len(attempts) == 1:
+            raise _retry_after(0.2)
+        return "ok"
+
+    async def run():
+        result = await outbox.send("t", 7, flaky)
+        await outbox.drain()
+        return result
+
+    with patch.multiple(Config, TELEGRAM_CHAT_RATE=1000, TELEGRAM_CHAT_BURST=1000), \
+         patch.object(telegram_service.telegram_client, "get_bot", return_value=MagicMock()):
+        assert asyncio.run(run()) == "ok"
+
+    assert len(attempts) == 2
+    assert attempts[1] - attempts[0] >= 0.19
+    assert outbox.stats["retried"] == 1
+
+
+def test_outbox_surfaces_non_network_errors_without_hanging():
+    import pytest
+    from telegram.error import InvalidToken
+    from app.services.telegram_service import TelegramOutbox
+
+    outbox = TelegramOutbox()
+    attempts = []
+
+    async def bad_token(bot):
+        attempts.append("token")
+        raise InvalidToken()
+
+    async def bad_payload(bot):
+        attempts.append("payload")
+        raise ValueError("payload hỏng")
+
+    async def run():
+        for action, error in ((bad_token, InvalidToken), (bad_payload, ValueError)):
+            with pytest.raises(error):
+                await asyncio.wait_for(outbox.send("t", 7, action), timeout=2)
+        await outbox.drain()
+
+    with _fast_limits(), patch.object(telegram_service.telegram_client, "get_bot", return_value=MagicMock()):
+        asyncio.run(run())
+
+    # Lỗi không phải lỗi mạng: không retry
+    assert attempts == ["token", "payload"]
+    assert outbox.stats["failed"] == 2
+
+
+def test_throttled_chat_does_not_hold_shared_workers():
+    from app.services.telegram_service import TelegramOutbox
+
+    outbox = TelegramOutbox()
+    sent = []
+
+    def action(label):
+        async def run(bot):
+            sent.append((label, asyncio.get_running_loop().time()))
+            return label
+        return run
+
+    async def run():
+        start = asyncio.get_running_loop().time()
+        jobs = [asyncio.create_task(outbox.send("t", 1, action(f"a{i}"))) for i in range(3)]
+        await asyncio.sleep(0)
+        jobs.append(asyncio.create_task(outbox.send("t", 2, action("b"))))
+        await asyncio.gather(*jobs)
+        await outbox.drain()
+        return start
+
+    # 1 worker, chat 1 chỉ được 5 tin/giây: tin của chat 2 không phải chờ sau các lượt chờ của chat 1
+    with patch.multiple(Config, TELEGRAM_CHAT_RATE=5, TELEGRAM_CHAT_BURST=1, TELEGRAM_GLOBAL_RATE=1000, TELEGRAM_OUTBOX_WORKERS=1), \
+         patch.object(telegram_service.telegram_client, "get_bot", return_value=MagicMock()):
+        start = asyncio.run(run())
+
+    times = dict(sent)
+    assert times["b"] - start < 0.1
+    chat1 = [label for label, _ in sent if label != "b"]
+    assert chat1 == ["a0", "a1", "a2"]
+    assert times["a2"] - times["a1"] >= 0.15 and times["a1"] - times["a0"] >= 0.15
@@ -0,0 +1,76 @@
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from app.services.timeseries_store import TimeSeriesStore, VN_TZ
+
+
+def _ms(*args):
+    return int(VN_TZ.localize(datetime(*args)).timestamp() * 1000)
+
+
+def _make_client(username="runner@example.com"):
+    client = MagicMock()
+    client.username = username
+    client.get_heart_rates.return_value = {"heartRateValues": [[1783357200000, 60]]}
+    return client
+
+
+def test_closed_day_is_fetched_once_then_served_from_store(tmp_path):
+    store = TimeSeriesStore(path=str(tmp_path / "store.sqlite3"), settle_hours=6)
+    store.note_watermark("runner@example.com", _ms(2026, 7, 8, 7, 0))
+    client = _make_client()
+
+    first = store.fetch(client, "get_heart_rates", "2026-07-07")
+    second = store.fetch(client, "get_heart_rates", "2026-07-07")
+
+    assert first == second == {"heartRateValues": [[1783357200000, 60]]}
+    client.get_heart_rates.assert_called_once_with("2026-07-07")
+
+    # Store mới trên cùng file vẫn đọc lại được
+    reopened = TimeSeriesStore(path=str(tmp_path / "store.sqlite3"), settle_hours=6)
+    assert reopened.get("runner@example.com", "heart_rates", "2026-07-07") == first
+
+
+def test_open_day_and_unknown_user_bypass_store(tmp_path):
+    store = TimeSeriesStore(path=str(tmp_path / "store.sqlite3"), settle_hours=6)
+    today = datetime.now(VN_TZ).strftime("%Y-%m-%d")
+
+    client = _make_client()
+    store.fetch(client, "get_heart_rates", today)
+    store.fetch(client, "get_heart_rates", today)
+    assert client.get_heart_rates.call_count == 2
+
+    anonymous = _make_client(username=None)
+    store.fetch(anonymous, "get_heart_rates", "2026-07-07")
+    store.fetch(anonymous, "get_heart_rates", "2026-07-07")
+    assert anonymous.get_heart_rates.call_count == 2
+
+
+def test_is_closed_day_follows_device_watermark():
+    store = TimeSeriesStore(path="", settle_hours=6)
+
+    assert store.is_closed_day("2026-07-07", _ms(2026, 7, 8, 3, 0)) is False
+    assert store.is_closed_day("2026-07-07", _ms(2026, 7, 8, 7, 0)) is True
+    assert store.is_closed_day("2026-07-07", None) is False
+    assert store.is_closed_day("not-a-date", _ms(2026, 7, 8, 7, 0)) is False
+
+
+def test_late_device_sync_refreshes_partial_past_day(tmp_path):
+    store = TimeSeriesStore(path=str(tmp_path / "store.sqlite3"), settle_hours=6)
+    client = _make_client()
+
+    # Đồng hồ upload lần cuối lúc 22:00, ngày đã qua từ lâu theo giờ hệ thống nhưng dữ liệu vẫn thiếu
+    store.note_watermark("runner@example.com", _ms(2026, 7, 7, 22, 0))
+    store.fetch(client, "get_heart_rates", "2026-07-07")
+    store.fetch(client, "get_heart_rates", "2026-07-07")
+    assert client.get_heart_rates.call_count == 1
+
+    # 2 ngày sau đồng hồ mới đồng bộ: lấy lại, và lần này ngày đã đóng
+    client.get_heart_rates.return_value = {"heartRateValues": [[1783357200000, 60], [1783360800000, 72]]}
+    store.note_watermark("runner@example.com", _ms(2026, 7, 9, 20, 0))
+    assert len(store.fetch(client, "get_heart_rates", "2026-07-07")["heartRateValues"]) == 2
+    assert client.get_heart_rates.call_count == 2
+
+    store.note_watermark("runner@example.com", _ms(2026, 7, 10, 8, 0))
+    assert len(store.fetch(client, "get_heart_rates", "2026-07-07")["heartRateValues"]) == 2
+    assert client.get_heart_rates.call_count == 2
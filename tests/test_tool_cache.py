@@ -0,0 +1,52 @@
+from unittest.mock import patch
+
+from app.services.tool_cache import ToolResultCache
+
+
+def test_make_key_normalizes_args_and_ignores_task_text():
+    a = ToolResultCache.make_key("u@x.com", "get_heart_rates", {"date": "2026-07-07", "start_time": "7:00", "task": "max HR"}, 123)
+    b = ToolResultCache.make_key("u@x.com", "get_heart_rates", {"start_time": "07:00", "date": "2026-07-07", "end_time": None, "task": "min HR"}, 123)
+    c = ToolResultCache.make_key("u@x.com", "get_heart_rates", {"date": "2026-07-07", "start_time": "07:00", "task": "max HR"}, 456)
+
+    assert a == b
+    assert a != c  # watermark mới -> khóa mới
+
+
+def test_make_key_separates_full_resolution_from_worker_payload():
+    # Không có task: phân tích cục bộ trên dữ liệu đủ độ phân giải; có task: time-series đã giảm mẫu
+    full = ToolResultCache.make_key("u@x.com", "get_heart_rates", {"date": "2026-07-07"}, 123)
+    worker = ToolResultCache.make_key("u@x.com", "get_heart_rates", {"date": "2026-07-07", "task": "max HR"}, 123)
+    assert full != worker
+    assert full == ToolResultCache.make_key("u@x.com", "get_heart_rates", {"date": "2026-07-07", "task": ""}, 123)
+
+
+def test_ttl_depends_on_requested_dates():
+    with patch("app.services.tool_cache.Config") as mock_cfg:
+        mock_cfg.TOOL_CACHE_TTL_PAST = 1000
+        mock_cfg.TOOL_CACHE_TTL_TODAY = 10
+        mock_cfg.TOOL_CACHE_TTL_DEFAULT = 100
+
+        assert ToolResultCache.ttl_for({"date": "2026-07-06"}, today_iso="2026-07-07") == 1000
+        assert ToolResultCache.ttl_for({"start_date": "2026-07-01", "end_date": "2026-07-07"}, today_iso="2026-07-07") == 10
+        assert ToolResultCache.ttl_for({}, today_iso="2026-07-07") == 100
+
+
+@patch("app.services.tool_cache.redis_service")
+def test_lru_eviction_falls_back_to_redis(mock_redis):
+    mock_redis.get_cache.return_value = None
+    cache = ToolResultCache(max_entries=2)
+
+    cache.set("k1", {"raw": "1"}, 60)
+    cache.set("k2", {"raw": "2"}, 60)
+    cache.set("k3", {"raw": "3"}, 60)
+
+    assert cache.get("k3") == {"raw": "3"}
+    mock_redis.get_cache.assert_not_called()
+
+    mock_redis.get_cache.return_value = {"raw": "1"}
+    assert cache.get("k1") == {"raw": "1"}
+    mock_redis.get_cache.assert_called_once_with("k1")
+
+    cache.record("hits")
+    cache.record("misses")
+    assert cache.hit_rate() == 0.5
@@ -0,0 +1,56 @@
+import os
+import time
+from unittest.mock import patch
+
+from app.services.tts_cache import TTSCache
+
+
+def _clip(data):
+    return {"data": data, "filename": "voice.ogg", "mime_type": "audio/ogg", "duration": 3}
+
+
+def test_tts_cache_roundtrip_and_key_depends_on_voice_and_model(tmp_path):
+    cache = TTSCache(cache_dir=str(tmp_path), max_bytes=10_000)
+    key = cache.make_key("Xin chào", "Sadachbia", "tts-model")
+    assert key != cache.make_key("Xin chào", "Kore", "tts-model")
+    assert key != cache.make_key("Xin chào", "Sadachbia", "other-model")
+
+    with patch("app.services.tts_cache.redis_service") as mock_redis:
+        mock_redis.get_cache.return_value = None
+        assert cache.get(key) is None
+        cache.set(key, _clip(b"OggS" * 10))
+        assert cache.get(key) == _clip(b"OggS" * 10)
+
+    assert cache.stats == {"hits": 1, "redis_hits": 0, "misses": 1}
+    # Clip nhỏ được đẩy lên Redis dạng base64
+    redis_key, redis_value, _ = mock_redis.set_cache.call_args.args
+    assert redis_key == f"tts_cache:{key}" and isinstance(redis_value["data"], str)
+
+
+def test_tts_cache_evicts_least_recently_used(tmp_path):
+    cache = TTSCache(cache_dir=str(tmp_path), max_bytes=3_500)
+    with patch("app.services.tts_cache.redis_service") as mock_redis:
+        mock_redis.get_cache.return_value = None
+        for name in ("a", "b", "c"):
+            cache.set(name, _clip(name.encode() * 1000))
+            past = time.time() - 100 + ord(name)
+            os.utime(cache._path(name), (past, past))
+        # "a" vừa được dùng nên không bị xóa trước
+        assert cache.get("a") is not None
+        cache.set("d", _clip(b"d" * 1000))
+
+        remaining = sorted(f[0] for f in os.listdir(tmp_path))
+    assert remaining == ["a", "c", "d"]
+    assert cache._total_bytes <= 3_500
+
+
+def test_tts_cache_restores_from_redis(tmp_path):
+    import base64
+    cache = TTSCache(cache_dir=str(tmp_path), max_bytes=10_000)
+    stored = {"data": base64.b64encode(b"OggS").decode(), "filename": "voice.ogg", "mime_type": "audio/ogg", "duration": 1}
+    with patch("app.services.tts_cache.redis_service") as mock_redis:
+        mock_redis.get_cache.return_value = stored
+        clip = cache.get("k")
+    assert clip["data"] == b"OggS"
+    assert os.path.exists(cache._path("k"))
+    assert cache.stats["redis_hits"] == 1
@@ -0,0 +1,73 @@
+import asyncio
+import importlib.util
+import os
+
+import pytest
+
+from app.services.webhook_server import WebhookServer, parse_dispatch_payload
+
+_spec = importlib.util.spec_from_file_location(
+    "replay_webhook", os.path.join(os.path.dirname(__file__), "..", "scripts", "replay_webhook.py")
+)
+replay_webhook = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(replay_webhook)
+
+
+def test_parse_payload_accepts_flat_and_repository_dispatch_shapes():
+    assert parse_dispatch_payload({"mode": "ask", "user_id": 123, "question": "HRV?"}) == ("ask", "123", "HRV?")
+    assert parse_dispatch_payload(
+        {"event_type": "telegram_command", "client_payload": {"mode": "daily", "user_id": "9", "question": ""}}
+    ) == ("daily", "9", None)
+    with pytest.raises(ValueError):
+        parse_dispatch_payload({"mode": "rm -rf"})
+
+
+def test_replay_client_drives_jobs_through_the_server():
+    calls = []
+
+    async def dispatch(mode, user_id, question):
+        await asyncio.sleep(0.01)
+        calls.append((mode, user_id, question))
+
+    async def run():
+        server = await WebhookServer(dispatch, host="127.0.0.1", port=0, secret="s3cret").start()
+        base = f"http://127.0.0.1:{server.port}"
+        payloads = [
+            {"mode": "ask", "user_id": "1", "question": "Ngủ thế nào?"},
+            {"event_type": "telegram_command", "client_payload": {"mode": "battery", "user_id": "2"}},
+            {"mode": "nope", "user_id": "3"},
+        ]
+        results = await replay_webhook.replay(f"{base}/dispatch", payloads, secret="s3cret", concurrency=3)
+        unauthorized = await replay_webhook.replay(f"{base}/dispatch", payloads[:1], secret="wrong")
+        health = await replay_webhook.replay(f"{base}/health", [{}])
+        await server.close(drain_timeout=5)
+        return server, sorted(status for status, _ in results), unauthorized, health
+
+    server, statuses, unauthorized, health = asyncio.run(run())
+
+    assert statuses == [202, 202, 400]
+    assert unauthorized[0][0] == 401
+    # /health chỉ nhận GET
+    assert health[0][0] == 405
+    assert sorted(calls) == [("ask", "1", "Ngủ thế nào?"), ("battery", "2", None)]
+    assert server.stats["completed"] == 2 and server.stats["rejected"] == 2
+
+
+def test_server_without_secret_stays_local_and_refuses_broadcasts():
+    calls = []
+
+    async def dispatch(mode, user_id, question):
+        calls.append((mode, user_id))
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await WebhookServer(dispatch, host="0.0.0.0", port=0, secret="").start()
+
+        server = await WebhookServer(dispatch, host="127.0.0.1", port=0, secret="").start()
+        url = f"http://127.0.0.1:{server.port}/dispatch"
+        results = await replay_webhook.replay(url, [{"mode": "daily"}, {"mode": "daily", "user_id": "1"}])
+        await server.close(drain_timeout=5)
+        return [status for status, _ in results]
+
+    assert asyncio.run(run()) == [403, 202]
+    assert calls == [("daily", "1")]